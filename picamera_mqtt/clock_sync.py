@@ -0,0 +1,75 @@
+"""NTP-style estimation of clock offsets between MQTT clients."""
+import collections
+import time
+
+
+class ClockOffsetEstimator(object):
+    """Estimates the offset of a remote clock and the round-trip time to it.
+
+    Each sample is an NTP-style exchange of four timestamps: t0 when the
+    request was sent, t1 when the remote received it, t2 when the remote sent
+    its response, and t3 when the response was received. As in NTP's clock
+    filter, the offset is taken from the recent sample with the smallest
+    round-trip time, since it is the least affected by queuing delays.
+    The offset is positive when the remote clock is ahead of the local clock.
+    """
+
+    def __init__(self, window=8):
+        self.samples = collections.deque(maxlen=window)
+        self.last_update = None
+
+    def add_sample(self, t0, t1, t2, t3):
+        round_trip_time = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        self.samples.append((round_trip_time, offset))
+        self.last_update = t3
+
+    @property
+    def has_estimate(self):
+        return bool(self.samples)
+
+    @property
+    def best_sample(self):
+        return min(self.samples)
+
+    @property
+    def round_trip_time(self):
+        if not self.samples:
+            return None
+        return self.best_sample[0]
+
+    @property
+    def offset(self):
+        if not self.samples:
+            return None
+        return self.best_sample[1]
+
+    def to_remote_time(self, local_time):
+        """Convert a time on the local clock to the remote clock."""
+        return local_time + (self.offset or 0)
+
+    def to_local_time(self, remote_time):
+        """Convert a time on the remote clock to the local clock."""
+        return remote_time - (self.offset or 0)
+
+    def summary(self):
+        return {
+            'offset': self.offset,
+            'round_trip_time': self.round_trip_time,
+            'samples': len(self.samples),
+            'last_update': self.last_update
+        }
+
+
+def wait_precisely(target_time, spin_interval=0.002):
+    """Block until the target wall-clock time with millisecond precision.
+
+    Sleeps for most of the wait, then spins for the last few milliseconds to
+    avoid the imprecision of the OS scheduler.
+    """
+    while True:
+        remaining = target_time - time.time()
+        if remaining <= 0:
+            return
+        if remaining > spin_interval:
+            time.sleep(remaining - spin_interval)
@@ -0,0 +1,54 @@
+"""Binary framing of image messages for transport over MQTT.
+
+A frame is a fixed-size prelude (magic bytes, format version, and header
+length), followed by a json header and then the raw message body.
+"""
+import json
+import struct
+
+frame_magic = b'PCMQ'
+frame_version = 1
+frame_prelude = struct.Struct('>4sBI')
+header_string_encoding = 'utf-8'
+
+
+class FramingError(ValueError):
+    """Raised when a payload is not a well-formed binary frame."""
+    pass
+
+
+def is_frame(payload):
+    """Check whether a message payload starts with the frame magic bytes."""
+    return bytes(payload[:len(frame_magic)]) == frame_magic
+
+
+def encode_frame(header, body=b''):
+    """Build a binary frame from a json-serializable header and body bytes."""
+    header_bytes = json.dumps(header).encode(header_string_encoding)
+    prelude = frame_prelude.pack(frame_magic, frame_version, len(header_bytes))
+    return b''.join((prelude, header_bytes, body))
+
+
+def decode_frame(payload):
+    """Split a binary frame into its header and a view of its body.
+
+    The body is returned as a memoryview into the payload, so no copy of the
+    body is made.
+    """
+    view = memoryview(payload)
+    if len(view) < frame_prelude.size:
+        raise FramingError('Frame is shorter than its prelude')
+    (magic, version, header_length) = frame_prelude.unpack_from(view)
+    if magic != frame_magic:
+        raise FramingError('Frame has bad magic bytes: {}'.format(magic))
+    if version > frame_version:
+        raise FramingError('Unsupported frame version: {}'.format(version))
+    header_end = frame_prelude.size + header_length
+    if len(view) < header_end:
+        raise FramingError('Frame is shorter than its header')
+    header_bytes = bytes(view[frame_prelude.size:header_end])
+    try:
+        header = json.loads(header_bytes.decode(header_string_encoding))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise FramingError('Malformed frame header: {}'.format(e))
+    return (header, view[header_end:])
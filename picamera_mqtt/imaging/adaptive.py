@@ -0,0 +1,105 @@
+"""Adaptation of image transport quality to the available bandwidth."""
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TransportAdapter(object):
+    """Chooses transport quality and downscaling to fit a bandwidth budget.
+
+    Throughput is estimated from how long published images take to be
+    acknowledged by the broker. Messages which are published back-to-back
+    queue behind each other, so each message is only timed from when the
+    link became free for it: from the later of its publish and the previous
+    acknowledgement. The budget for each image is the number of
+    bytes which can be sent within the target latency at the estimated
+    throughput, optionally capped by a target rate in bytes per second. When
+    images overshoot the budget, quality is reduced first and then the image
+    is downscaled; when they're well under budget, the image is upscaled first
+    and then quality is restored.
+    """
+
+    def __init__(
+        self, target_latency=1.0, target_rate=None,
+        min_quality=30, quality_step=10, min_scale=0.25, scale_step=0.75,
+        headroom=0.5, smoothing=0.3
+    ):
+        self.target_latency = target_latency
+        self.target_rate = target_rate
+        self.min_quality = min_quality
+        self.quality_step = quality_step
+        self.min_scale = min_scale
+        self.scale_step = scale_step
+        self.headroom = headroom
+        self.smoothing = smoothing
+
+        self.throughput = None
+        self.last_ack_time = None
+        self.last_size = None
+        self.new_sample = False
+        self.quality_reduction = 0
+        self.scale = 1.0
+
+    def record_publish(self, size, publish_time, ack_time):
+        """Update the throughput estimate with an acknowledged publish."""
+        self.last_size = size
+        self.new_sample = True
+        start_time = publish_time
+        if self.last_ack_time is not None:
+            start_time = max(start_time, self.last_ack_time)
+        self.last_ack_time = max(ack_time, self.last_ack_time or ack_time)
+        duration = ack_time - start_time
+        if duration <= 0:
+            return
+        throughput = size / duration
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput += self.smoothing * (throughput - self.throughput)
+
+    @property
+    def budget(self):
+        """The number of bytes which each image should fit within."""
+        rates = [
+            rate for rate in (self.throughput, self.target_rate)
+            if rate is not None
+        ]
+        if not rates:
+            return None
+        return min(rates) * self.target_latency
+
+    def adapt(self, quality):
+        """Adjust the quality reduction and scale based on the last image."""
+        budget = self.budget
+        if budget is None or not self.new_sample:
+            return
+        self.new_sample = False
+        if self.last_size > budget:
+            if quality - self.quality_reduction > self.min_quality:
+                self.quality_reduction += self.quality_step
+            else:
+                self.scale = max(self.min_scale, self.scale * self.scale_step)
+        elif self.last_size < budget * self.headroom:
+            if self.scale < 1.0:
+                self.scale = min(1.0, self.scale / self.scale_step)
+            elif self.quality_reduction > 0:
+                self.quality_reduction = max(
+                    0, self.quality_reduction - self.quality_step
+                )
+
+    def choose(self, quality):
+        """Choose the quality and scale for the next image.
+
+        The quality is reduced from the requested quality, but never below
+        the minimum quality.
+        """
+        self.adapt(quality)
+        adapted_quality = max(
+            min(self.min_quality, quality), quality - self.quality_reduction
+        )
+        return {
+            'quality': adapted_quality,
+            'scale': self.scale,
+            'throughput': self.throughput,
+            'budget': self.budget
+        }
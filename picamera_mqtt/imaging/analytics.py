@@ -0,0 +1,133 @@
+"""Image quality metrics computed off the receive path in a process pool."""
+import concurrent.futures
+import functools
+import logging
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+channel_names = ['red', 'green', 'blue']
+luma_weights = [0.299, 0.587, 0.114]
+# Encoded formats which can be decoded for analysis, unlike raw formats
+image_formats = ['jpeg', 'jpg', 'png', 'gif', 'bmp']
+
+
+def analyze_image(image_bytes, histogram_bins=32, max_dimension=None):
+    """Compute focus and exposure metrics of an encoded image.
+
+    The metrics are sharpness (variance of the Laplacian of the luma), the
+    mean and a histogram of each color channel, and the fraction of pixels
+    with any channel clipped to black or white. If max_dimension is given,
+    the image is downscaled first for speed, which lowers the sharpness.
+    """
+    import numpy as np
+
+    image = Image.open(BytesIO(image_bytes))
+    if max_dimension is not None:
+        image.draft('RGB', (max_dimension, max_dimension))
+    image = image.convert('RGB')
+    if max_dimension is not None:
+        image.thumbnail((max_dimension, max_dimension))
+    pixels = np.asarray(image)
+
+    luma = pixels @ np.array(luma_weights)
+    laplacian = (
+        luma[:-2, 1:-1] + luma[2:, 1:-1] + luma[1:-1, :-2] + luma[1:-1, 2:]
+        - 4 * luma[1:-1, 1:-1]
+    )
+    binned = (pixels.astype(np.uint16) * histogram_bins) >> 8
+    return {
+        'width': image.size[0],
+        'height': image.size[1],
+        'sharpness': float(laplacian.var()) if laplacian.size else 0.0,
+        'mean': {
+            name: float(pixels[:, :, index].mean())
+            for (index, name) in enumerate(channel_names)
+        },
+        'histograms': {
+            name: np.bincount(
+                binned[:, :, index].ravel(), minlength=histogram_bins
+            ).tolist()
+            for (index, name) in enumerate(channel_names)
+        },
+        'clipped_fraction': {
+            'black': float(np.any(pixels == 0, axis=2).mean()),
+            'white': float(np.any(pixels == 255, axis=2).mean())
+        }
+    }
+
+
+class ImageAnalyzer(object):
+    """Analyzes images in a process pool without blocking the caller.
+
+    At most max_pending images are analyzed or queued for analysis at a time;
+    images submitted beyond that are skipped rather than queued, so that
+    analysis never holds up receiving images. Results are passed to a
+    callback in a pool management thread.
+    """
+
+    def __init__(
+        self, workers=1, max_pending=8, histogram_bins=32, max_dimension=None
+    ):
+        self.max_pending = max_pending
+        self.histogram_bins = histogram_bins
+        self.max_dimension = max_dimension
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers
+        )
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.counters = {'analyzed': 0, 'skipped': 0, 'failed': 0}
+
+    def submit(self, load_image, callback):
+        """Queue an image for analysis, unless too many are pending.
+
+        The image's bytes are only loaded, by calling load_image, once the
+        image is certain to be queued. Returns whether the image was queued.
+        """
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.counters['skipped'] += 1
+                return False
+            self.pending += 1
+        try:
+            future = self.executor.submit(
+                analyze_image, load_image(),
+                histogram_bins=self.histogram_bins,
+                max_dimension=self.max_dimension
+            )
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+                self.counters['failed'] += 1
+            logger.exception('Failed to queue image for analysis')
+            return False
+        future.add_done_callback(functools.partial(self.on_done, callback))
+        return True
+
+    def on_done(self, callback, future):
+        with self.lock:
+            self.pending -= 1
+        try:
+            metrics = future.result()
+        except concurrent.futures.CancelledError:
+            return
+        except Exception:
+            self.counters['failed'] += 1
+            logger.exception('Failed to analyze image')
+            return
+        self.counters['analyzed'] += 1
+        callback(metrics)
+
+    def stop(self):
+        """Finish analyzing pending images and shut down the pool."""
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['pending'] = self.pending
+        return stats
@@ -0,0 +1,446 @@
+"""Append-only archives of captured images and their metadata.
+
+An archive is a directory of segment files, each holding a sequence of
+records, plus an index file. Each record is a fixed-size prelude (magic
+bytes, metadata length, and image length), followed by the compact json
+metadata of a capture and then its raw image bytes. The index has one json
+line per record with its location, so that any record can be read with a
+single seek without scanning the segments. If the index is missing or
+behind the segments (e.g. after a crash), it is rebuilt from the segments.
+"""
+import bisect
+import datetime
+import json
+import logging
+import os
+import shutil
+import struct
+import threading
+
+from picamera_mqtt.util import files
+
+logger = logging.getLogger(__name__)
+
+record_magic = b'PCAR'
+record_prelude = struct.Struct('>4sII')
+metadata_string_encoding = 'utf-8'
+segment_name_format = 'segment-{:06d}.pcar'
+index_name = 'index.jsonl'
+copy_buffer_size = 1024 * 1024
+
+
+class ArchiveError(ValueError):
+    """Raised when an archive record is malformed."""
+    pass
+
+
+def build_capture_filename(capture):
+    """Build the base filename of a capture's image and metadata files."""
+    return '{} {} {}'.format(
+        capture['metadata']['client_name'],
+        capture['metadata']['image_id'],
+        capture['metadata']['capture_time']['datetime']
+    )
+
+
+def parse_capture_filename(filename):
+    """Parse the camera, image id, and datetime from a capture filename.
+
+    Returns None if the filename wasn't built by build_capture_filename.
+    """
+    parts = filename.rsplit(' ', 3)
+    if len(parts) != 4:
+        return None
+    (client_name, image_id, date, time) = parts
+    try:
+        image_id = int(image_id)
+    except ValueError:
+        return None
+    return (client_name, image_id, '{} {}'.format(date, time))
+
+
+def parse_datetime(datetime_string):
+    """Convert a capture datetime string to a unix timestamp."""
+    for time_format in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(
+                datetime_string, time_format
+            ).timestamp()
+        except ValueError:
+            pass
+    return None
+
+
+def build_index_entry(capture, segment, offset, metadata_size, image_size):
+    """Build the index entry locating a capture record."""
+    return {
+        'client_name': capture['metadata']['client_name'],
+        'image_id': capture['metadata']['image_id'],
+        'time': capture['metadata']['capture_time']['time'],
+        'segment': segment,
+        'offset': offset,
+        'metadata_size': metadata_size,
+        'image_size': image_size
+    }
+
+
+class CaptureArchive(object):
+    """A segmented, append-only archive of captures with an index.
+
+    Captures are looked up by camera and image id in constant time, and by
+    camera and capture time with a binary search over that camera's captures.
+    Image ids aren't unique, since the frames of a burst share one and hosts
+    restart their ids from 1, so several captures can have the same id.
+    Appends are serialized with a lock, so captures can be appended from
+    several threads; reads open their own file handles.
+
+    An archive opened as read_only never modifies its files, so it can be
+    read while another process appends to it: records which aren't in the
+    index yet are only indexed in memory, and torn records are skipped
+    instead of being truncated away.
+    """
+
+    def __init__(
+        self, path, max_segment_size=256 * 1024 * 1024, read_only=False
+    ):
+        self.path = path
+        self.max_segment_size = max_segment_size
+        self.read_only = read_only
+        self.lock = threading.Lock()
+
+        self.entries = []
+        self.by_id = {}
+        self.by_camera = {}
+        self.segment = 0
+        self.segment_file = None
+        self.index_file = None
+
+        if not read_only:
+            files.ensure_path(path)
+        self.load_index()
+        self.recover()
+        if not read_only:
+            self.index_file = open(os.path.join(path, index_name), 'a')
+
+    # Paths
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, segment_name_format.format(segment))
+
+    def list_segments(self):
+        """List the numbers of the segment files in the archive."""
+        segments = []
+        for filename in os.listdir(self.path):
+            (name, extension) = os.path.splitext(filename)
+            if extension == '.pcar' and name.startswith('segment-'):
+                segments.append(int(name[len('segment-'):]))
+        return sorted(segments)
+
+    # Index
+
+    def add_entry(self, entry):
+        self.entries.append(entry)
+        camera = entry['client_name']
+        self.by_id.setdefault((camera, entry['image_id']), []).append(entry)
+        (times, camera_entries) = self.by_camera.setdefault(camera, ([], []))
+        position = bisect.bisect_right(times, entry['time'])
+        times.insert(position, entry['time'])
+        camera_entries.insert(position, entry)
+
+    def load_index(self):
+        index_path = os.path.join(self.path, index_name)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, 'r' if self.read_only else 'r+') as f:
+            lines = f.read().split('\n')
+            if lines[-1] and not self.read_only:
+                # Drop a partially-written last line; its record is recovered
+                # from the segment
+                f.truncate(f.tell() - len(lines[-1]))
+            for line in lines[:-1]:
+                try:
+                    self.add_entry(json.loads(line))
+                except (json.JSONDecodeError, KeyError):
+                    logger.warning('Skipping malformed archive index line')
+
+    def recover(self):
+        """Index any records which were written after the last index update.
+
+        A partially-written record at the end of the last segment is
+        truncated away, unless the archive is read-only.
+        """
+        indexed_ends = {}
+        for entry in self.entries:
+            end = (
+                entry['offset'] + record_prelude.size
+                + entry['metadata_size'] + entry['image_size']
+            )
+            indexed_ends[entry['segment']] = max(
+                indexed_ends.get(entry['segment'], 0), end
+            )
+        recovered = []
+        segments = self.list_segments()
+        for segment in segments:
+            start = indexed_ends.get(segment, 0)
+            if start == os.path.getsize(self.segment_path(segment)):
+                continue
+            for (metadata, offset, metadata_size, image_size, end) in (
+                self.scan_segment(segment, start)
+            ):
+                entry = build_index_entry(
+                    metadata, segment, offset, metadata_size, image_size
+                )
+                self.add_entry(entry)
+                recovered.append(entry)
+        if recovered and not self.read_only:
+            logger.warning('Recovered {} unindexed archive records'.format(
+                len(recovered)
+            ))
+            with open(os.path.join(self.path, index_name), 'a') as f:
+                for entry in recovered:
+                    f.write(json.dumps(entry) + '\n')
+        if segments:
+            self.segment = segments[-1]
+
+    def scan_segment(self, segment, start=0):
+        """Yield the records of a segment file, starting from an offset.
+
+        Scanning stops at the first malformed or truncated record, which is
+        truncated away unless the archive is read-only.
+        """
+        path = self.segment_path(segment)
+        with open(path, 'rb' if self.read_only else 'r+b') as f:
+            f.seek(start)
+            offset = start
+            while True:
+                try:
+                    (metadata, image_size) = read_record_metadata(f)
+                except ArchiveError as e:
+                    self.skip_torn_record(f, path, offset, e)
+                    return
+                if metadata is None:
+                    return
+                end = f.seek(image_size, os.SEEK_CUR)
+                if end > os.path.getsize(path):
+                    self.skip_torn_record(f, path, offset, 'incomplete image')
+                    return
+                metadata_size = end - offset - record_prelude.size - image_size
+                yield (metadata, offset, metadata_size, image_size, end)
+                offset = end
+
+    def skip_torn_record(self, f, path, offset, error):
+        if self.read_only:
+            # The record may still be being written by another process
+            logger.debug(
+                'Skipping incomplete record in {} at offset {}: {}'
+                .format(path, offset, error)
+            )
+            return
+        logger.warning(
+            'Truncating {} at offset {}: {}'.format(path, offset, error)
+        )
+        f.truncate(offset)
+
+    # Writing
+
+    def append(self, capture, image=None, image_file=None):
+        """Append a capture and its image to the archive.
+
+        The image is given either as bytes or as the path of a file to copy
+        it from. Returns the index entry of the record.
+        """
+        if self.read_only:
+            raise ValueError('Cannot append to a read-only archive')
+        metadata_bytes = json.dumps(
+            capture, separators=(',', ':')
+        ).encode(metadata_string_encoding)
+        if image_file is not None:
+            image_size = os.path.getsize(image_file)
+        else:
+            image_size = len(image)
+        with self.lock:
+            segment_file = self.open_segment()
+            offset = segment_file.tell()
+            segment_file.write(record_prelude.pack(
+                record_magic, len(metadata_bytes), image_size
+            ))
+            segment_file.write(metadata_bytes)
+            if image_file is not None:
+                with open(image_file, 'rb') as f:
+                    shutil.copyfileobj(f, segment_file, copy_buffer_size)
+            else:
+                segment_file.write(image)
+            segment_file.flush()
+            entry = build_index_entry(
+                capture, self.segment, offset, len(metadata_bytes), image_size
+            )
+            self.index_file.write(json.dumps(entry) + '\n')
+            self.index_file.flush()
+            self.add_entry(entry)
+        return entry
+
+    def open_segment(self):
+        """Get the segment file to append to, starting a new one if full."""
+        if (
+            self.segment_file is not None
+            and self.segment_file.tell() >= self.max_segment_size
+        ):
+            self.segment_file.close()
+            self.segment_file = None
+            self.segment += 1
+        if self.segment_file is None:
+            self.segment_file = open(self.segment_path(self.segment), 'ab')
+            if self.segment_file.tell() >= self.max_segment_size:
+                return self.open_segment()
+        return self.segment_file
+
+    def close(self):
+        with self.lock:
+            if self.segment_file is not None:
+                self.segment_file.close()
+                self.segment_file = None
+            if self.index_file is not None:
+                self.index_file.close()
+                self.index_file = None
+
+    # Reading
+
+    def get_entries(self, client_name, image_id):
+        """Look up the index entries of captures by camera and image id.
+
+        Entries are in order of archiving.
+        """
+        return list(self.by_id.get((client_name, image_id), []))
+
+    def find_entry(self, client_name, time):
+        """Look up the index entry of the capture closest to a time."""
+        if client_name not in self.by_camera:
+            return None
+        (times, camera_entries) = self.by_camera[client_name]
+        position = bisect.bisect_left(times, time)
+        candidates = camera_entries[max(0, position - 1):position + 1]
+        return min(candidates, key=lambda entry: abs(entry['time'] - time))
+
+    def query(self, client_name=None, start_time=None, end_time=None):
+        """List the index entries of captures, optionally filtered.
+
+        Entries are in order of capture time for a single camera, and in
+        order of archiving otherwise.
+        """
+        if client_name is None:
+            return [
+                entry for entry in self.entries
+                if (start_time is None or entry['time'] >= start_time)
+                and (end_time is None or entry['time'] <= end_time)
+            ]
+        if client_name not in self.by_camera:
+            return []
+        (times, camera_entries) = self.by_camera[client_name]
+        start = 0 if start_time is None else bisect.bisect_left(
+            times, start_time
+        )
+        end = len(times) if end_time is None else bisect.bisect_right(
+            times, end_time
+        )
+        return camera_entries[start:end]
+
+    def read_entry(self, segment, offset):
+        """Read the index entry and metadata of the record at a location.
+
+        This doesn't need the record to be in the index.
+        """
+        with open(self.segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            (capture, image_size) = read_record_metadata(f)
+            metadata_size = f.tell() - offset - record_prelude.size
+        if capture is None:
+            raise ArchiveError('No record in segment {} at offset {}'.format(
+                segment, offset
+            ))
+        entry = build_index_entry(
+            capture, segment, offset, metadata_size, image_size
+        )
+        return (entry, capture)
+
+    def read_metadata(self, entry):
+        """Read the metadata of the capture at an index entry."""
+        with open(self.segment_path(entry['segment']), 'rb') as f:
+            f.seek(entry['offset'] + record_prelude.size)
+            metadata_bytes = f.read(entry['metadata_size'])
+        return json.loads(metadata_bytes.decode(metadata_string_encoding))
+
+    def read_image(self, entry):
+        """Read the image bytes of the capture at an index entry."""
+        with open(self.segment_path(entry['segment']), 'rb') as f:
+            f.seek(
+                entry['offset'] + record_prelude.size + entry['metadata_size']
+            )
+            return f.read(entry['image_size'])
+
+    def read(self, entry):
+        """Read the metadata and image bytes of the capture at an entry."""
+        return (self.read_metadata(entry), self.read_image(entry))
+
+    # Exporting
+
+    def export(
+        self, output_dir, entries=None,
+        build_filename=build_capture_filename
+    ):
+        """Export captures as separate image and json metadata files.
+
+        The files are laid out as the Host saves them without an archive.
+        Deduplicated captures are restored with the image they refer to.
+        Returns the number of captures exported.
+        """
+        files.ensure_path(output_dir)
+        if entries is None:
+            entries = self.entries
+        count = 0
+        for entry in entries:
+            (capture, image) = self.read(entry)
+            duplicate_of = capture['metadata'].get('duplicate_of')
+            if duplicate_of is not None:
+                image_entry = self.find_entry(
+                    duplicate_of['client_name'], duplicate_of['capture_time']
+                )
+                if image_entry is None:
+                    logger.warning(
+                        'Skipping duplicate of missing capture: {}'
+                        .format(duplicate_of)
+                    )
+                    continue
+                image = self.read_image(image_entry)
+            capture_filename = build_filename(capture)
+            image_filename = '{}.{}'.format(capture_filename, capture['format'])
+            files.bytes_save(image, os.path.join(output_dir, image_filename))
+            capture['image'] = image_filename
+            files.json_dump(capture, os.path.join(
+                output_dir, '{}.json'.format(capture_filename)
+            ))
+            count += 1
+        return count
+
+
+def read_record_metadata(f):
+    """Read the prelude and metadata of the record at a file's position.
+
+    Returns the metadata and the size of the image which follows it, or
+    (None, None) at the end of the file.
+    """
+    prelude = f.read(record_prelude.size)
+    if not prelude:
+        return (None, None)
+    if len(prelude) < record_prelude.size:
+        raise ArchiveError('Record is shorter than its prelude')
+    (magic, metadata_size, image_size) = record_prelude.unpack(prelude)
+    if magic != record_magic:
+        raise ArchiveError('Record has bad magic bytes: {}'.format(magic))
+    metadata_bytes = f.read(metadata_size)
+    if len(metadata_bytes) < metadata_size:
+        raise ArchiveError('Record is shorter than its metadata')
+    try:
+        metadata = json.loads(metadata_bytes.decode(metadata_string_encoding))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ArchiveError('Malformed record metadata: {}'.format(e))
+    return (metadata, image_size)
@@ -0,0 +1,101 @@
+"""Versioning of camera params, so they're only sent when they change.
+
+Each distinct set of camera params read from a camera gets a version id,
+which is unique across restarts of the camera client. Params messages carry
+either the full params of a version, or the changes from a base version:
+
+    {'version': ..., 'params': {...}}
+    {'version': ..., 'base_version': ..., 'changed': {...}, 'removed': [...]}
+
+Images then refer to their params by version id.
+"""
+import collections
+import threading
+
+
+def diff_params(old_params, new_params):
+    """Find the top-level params which changed between two sets of params."""
+    changed = {
+        key: value for (key, value) in new_params.items()
+        if key not in old_params or old_params[key] != value
+    }
+    removed = [key for key in old_params if key not in new_params]
+    return (changed, removed)
+
+
+def build_full_message(version, params):
+    return {'version': version, 'params': params}
+
+
+def build_diff_message(version, base_version, base_params, params):
+    (changed, removed) = diff_params(base_params, params)
+    return {
+        'version': version,
+        'base_version': base_version,
+        'changed': changed,
+        'removed': removed
+    }
+
+
+class ParamsVersions(object):
+    """A bounded cache of the recent versions of a camera's params.
+
+    Versions which were requested but didn't arrive in time can be marked as
+    missing, e.g. if the camera restarted or no longer has them, so that they
+    aren't requested again.
+    """
+
+    def __init__(self, max_versions=32, max_missing=256):
+        self.max_versions = max_versions
+        self.max_missing = max_missing
+        self.versions = collections.OrderedDict()
+        self.missing = collections.OrderedDict()
+        self.latest = None
+        self.lock = threading.Lock()
+
+    def add(self, version, params):
+        with self.lock:
+            self.versions[version] = params
+            self.versions.move_to_end(version)
+            self.missing.pop(version, None)
+            while len(self.versions) > self.max_versions:
+                self.versions.popitem(last=False)
+            self.latest = version
+
+    def get(self, version):
+        with self.lock:
+            return self.versions.get(version)
+
+    def apply_message(self, message):
+        """Add the version described by a params message.
+
+        Returns whether the version could be reconstructed; a diff can't be
+        applied if its base version isn't in the cache.
+        """
+        version = message['version']
+        if 'params' in message:
+            self.add(version, message['params'])
+            return True
+        base_params = self.get(message['base_version'])
+        if base_params is None:
+            return False
+        params = dict(base_params)
+        params.update(message['changed'])
+        for key in message['removed']:
+            params.pop(key, None)
+        self.add(version, params)
+        return True
+
+    def is_missing(self, version):
+        with self.lock:
+            return version in self.missing
+
+    def mark_missing(self, version):
+        """Remember that a version failed to arrive, unless it's cached."""
+        with self.lock:
+            if version in self.versions:
+                return
+            self.missing[version] = True
+            self.missing.move_to_end(version)
+            while len(self.missing) > self.max_missing:
+                self.missing.popitem(last=False)
@@ -0,0 +1,328 @@
+"""SQLite index of captured image metadata for fast queries."""
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from picamera_mqtt.imaging import archive
+from picamera_mqtt.util import files
+
+logger = logging.getLogger(__name__)
+
+columns = [
+    ('client_name', 'TEXT NOT NULL'),
+    ('image_id', 'INTEGER'),
+    ('command_time', 'REAL'),
+    ('capture_time', 'REAL'),
+    ('receive_time', 'REAL'),
+    ('format', 'TEXT'),
+    ('size', 'INTEGER'),
+    ('path', 'TEXT'),
+    ('metadata_path', 'TEXT'),
+    ('archive_segment', 'INTEGER'),
+    ('archive_offset', 'INTEGER'),
+    ('burst_frame', 'INTEGER'),
+    ('zoom', 'REAL'),
+    ('iso', 'INTEGER'),
+    ('exposure_mode', 'TEXT'),
+    ('shutter_speed', 'INTEGER'),
+    ('shutter_speed_nominal', 'REAL'),
+    ('awb_mode', 'TEXT'),
+    ('awb_gain_red', 'REAL'),
+    ('awb_gain_blue', 'REAL'),
+    ('analog_gain', 'REAL'),
+    ('digital_gain', 'REAL'),
+    ('resolution_width', 'INTEGER'),
+    ('resolution_height', 'INTEGER'),
+    ('camera_params', 'TEXT')
+]
+column_names = [name for (name, column_type) in columns]
+schema = [
+    'CREATE TABLE IF NOT EXISTS captures ({}, UNIQUE ({}))'.format(
+        ', '.join(
+            '{} {}'.format(name, column_type)
+            for (name, column_type) in columns
+        ),
+        'client_name, image_id, capture_time, burst_frame'
+    ),
+    'CREATE INDEX IF NOT EXISTS captures_camera_time '
+    'ON captures (client_name, capture_time)',
+    'CREATE INDEX IF NOT EXISTS captures_camera_image '
+    'ON captures (client_name, image_id)',
+    'CREATE INDEX IF NOT EXISTS captures_time ON captures (capture_time)',
+    'CREATE INDEX IF NOT EXISTS captures_path ON captures (path)',
+    'CREATE INDEX IF NOT EXISTS captures_metadata_path '
+    'ON captures (metadata_path)'
+]
+insert_statement = 'INSERT OR REPLACE INTO captures ({}) VALUES ({})'.format(
+    ', '.join(column_names), ', '.join('?' for name in column_names)
+)
+
+
+# Rows
+
+def parse_time(time_string):
+    """Parse a time given as a unix timestamp or an ISO 8601 datetime."""
+    try:
+        return float(time_string)
+    except ValueError:
+        pass
+    for time_format in (
+        '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M',
+        '%Y-%m-%d %H:%M', '%Y-%m-%d'
+    ):
+        try:
+            return datetime.datetime.strptime(
+                time_string, time_format
+            ).timestamp()
+        except ValueError:
+            pass
+    raise ValueError('Unrecognized time: {}'.format(time_string))
+
+
+def get_time(metadata, key):
+    timestamp = metadata.get(key)
+    if timestamp is None:
+        return None
+    return timestamp['time']
+
+
+def get_fraction(fraction):
+    if fraction is None:
+        return None
+    return fraction['numerator'] / fraction['denominator']
+
+
+def build_row(
+    capture, path=None, metadata_path=None, size=None, archive_entry=None
+):
+    """Build the index row of a capture's metadata."""
+    metadata = capture['metadata']
+    camera_params = capture.get('camera_params') or {}
+    if not isinstance(camera_params, dict):
+        camera_params = {}
+    shutter_speed = camera_params.get('shutter_speed') or {}
+    awb_gains = camera_params.get('awb_gains') or {}
+    resolution = camera_params.get('resolution') or {}
+    row = {
+        'client_name': metadata['client_name'],
+        'image_id': metadata.get('image_id'),
+        'command_time': get_time(metadata, 'command_time'),
+        'capture_time': get_time(metadata, 'capture_time'),
+        'receive_time': get_time(metadata, 'receive_time'),
+        'format': capture.get('format'),
+        'size': size,
+        'path': path,
+        'metadata_path': metadata_path,
+        'archive_segment': None,
+        'archive_offset': None,
+        'burst_frame': metadata.get('burst', {}).get('frame_index', -1),
+        'zoom': camera_params.get('zoom'),
+        'iso': camera_params.get('iso'),
+        'exposure_mode': camera_params.get('exposure_mode'),
+        'shutter_speed': shutter_speed.get('actual'),
+        'shutter_speed_nominal': shutter_speed.get('nominal'),
+        'awb_mode': camera_params.get('awb_mode'),
+        'awb_gain_red': get_fraction(awb_gains.get('red')),
+        'awb_gain_blue': get_fraction(awb_gains.get('blue')),
+        'analog_gain': get_fraction(camera_params.get('analog_gain')),
+        'digital_gain': get_fraction(camera_params.get('digital_gain')),
+        'resolution_width': resolution.get('width'),
+        'resolution_height': resolution.get('height'),
+        'camera_params': json.dumps(camera_params)
+    }
+    if archive_entry is not None:
+        row['archive_segment'] = archive_entry['segment']
+        row['archive_offset'] = archive_entry['offset']
+        row['size'] = archive_entry['image_size']
+    return row
+
+
+def build_sidecar_row(metadata_path):
+    """Build the index row of a json metadata sidecar file.
+
+    Returns None if the file isn't capture metadata.
+    """
+    try:
+        capture = files.json_load(metadata_path)
+        capture['metadata']['client_name']
+    except (ValueError, KeyError, TypeError):
+        return None
+    image_path = None
+    size = None
+    if isinstance(capture.get('image'), str):
+        image_path = os.path.join(
+            os.path.dirname(metadata_path), capture['image']
+        )
+        try:
+            size = os.path.getsize(image_path)
+        except FileNotFoundError:
+            pass
+    return build_row(
+        capture, path=image_path, metadata_path=metadata_path, size=size
+    )
+
+
+def build_archive_rows(archive_path):
+    """Build the index rows of all captures in an archive."""
+    capture_archive = archive.CaptureArchive(archive_path, read_only=True)
+    rows = [
+        build_row(
+            capture_archive.read_metadata(entry), path=archive_path,
+            archive_entry=entry
+        )
+        for entry in capture_archive.entries
+    ]
+    capture_archive.close()
+    return rows
+
+
+# Index
+
+class CaptureIndex(object):
+    """A SQLite database of capture metadata.
+
+    Rows can be added from several threads; writes are serialized with a
+    lock. The database uses write-ahead logging so that it can be queried by
+    other processes while the host is writing to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            for statement in schema:
+                self.connection.execute(statement)
+            self.connection.commit()
+
+    def add(self, capture, **kwargs):
+        """Index a capture; kwargs are passed to build_row."""
+        self.add_rows([build_row(capture, **kwargs)])
+
+    def add_rows(self, rows):
+        with self.lock:
+            self.connection.executemany(insert_statement, [
+                [row[name] for name in column_names] for row in rows
+            ])
+            self.connection.commit()
+
+    def query(
+        self, client_names=None, start_time=None, end_time=None,
+        where=None, parameters=(), order_by='capture_time', limit=None
+    ):
+        """Select indexed captures, as a list of dicts.
+
+        Captures are filtered by camera names and a capture time range, and
+        optionally by a SQL where clause with its own parameters.
+        """
+        conditions = []
+        query_parameters = []
+        if client_names:
+            conditions.append('client_name IN ({})'.format(
+                ', '.join('?' for name in client_names)
+            ))
+            query_parameters.extend(client_names)
+        if start_time is not None:
+            conditions.append('capture_time >= ?')
+            query_parameters.append(start_time)
+        if end_time is not None:
+            conditions.append('capture_time <= ?')
+            query_parameters.append(end_time)
+        if where:
+            conditions.append('({})'.format(where))
+            query_parameters.extend(parameters)
+        statement = 'SELECT * FROM captures'
+        if conditions:
+            statement += ' WHERE ' + ' AND '.join(conditions)
+        if order_by:
+            statement += ' ORDER BY {}'.format(order_by)
+        if limit is not None:
+            statement += ' LIMIT {:d}'.format(limit)
+        with self.lock:
+            rows = self.connection.execute(
+                statement, query_parameters
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def remove_paths(self, paths, batch_size=256):
+        """Remove the captures whose image or metadata files are deleted.
+
+        Paths are removed in batches, so that captures can still be added
+        between batches while many paths are removed.
+        """
+        paths = list(paths)
+        for start in range(0, len(paths), batch_size):
+            batch = paths[start:start + batch_size]
+            placeholders = ', '.join('?' for path in batch)
+            with self.lock:
+                self.connection.execute(
+                    'DELETE FROM captures WHERE path IN ({}) '
+                    'OR metadata_path IN ({})'.format(
+                        placeholders, placeholders
+                    ), batch + batch
+                )
+                self.connection.commit()
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM captures'
+            ).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def rebuild(self, capture_dir, workers=None, batch_size=256):
+        """Index all captures saved under a directory.
+
+        Json sidecar files are parsed in parallel in a process pool, and
+        archives (directories with an archive index) are read in full.
+        Returns the number of captures indexed.
+        """
+        metadata_paths = []
+        archive_paths = []
+        for (dir_path, dir_names, filenames) in os.walk(capture_dir):
+            dir_names[:] = [name for name in dir_names if name != '.partial']
+            if archive.index_name in filenames:
+                archive_paths.append(dir_path)
+            metadata_paths.extend(
+                os.path.join(dir_path, filename) for filename in filenames
+                if filename.endswith('.json')
+            )
+        logger.info(
+            'Indexing {} metadata files and {} archives in {}...'
+            .format(len(metadata_paths), len(archive_paths), capture_dir)
+        )
+
+        count = 0
+        batch = []
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers
+        ) as executor:
+            row_lists = executor.map(
+                build_archive_rows, archive_paths
+            )
+            rows = executor.map(
+                build_sidecar_row, metadata_paths, chunksize=batch_size
+            )
+            for row in rows:
+                if row is None:
+                    continue
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    self.add_rows(batch)
+                    count += len(batch)
+                    batch = []
+            for archive_rows in row_lists:
+                batch.extend(archive_rows)
+        if batch:
+            self.add_rows(batch)
+            count += len(batch)
+        return count
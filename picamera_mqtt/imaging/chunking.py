@@ -0,0 +1,89 @@
+"""Splitting of images into sequenced chunks and their reassembly."""
+import logging
+import os
+
+from picamera_mqtt import framing
+
+logger = logging.getLogger(__name__)
+
+
+# Sending
+
+def count_chunks(size, chunk_size):
+    """Count the chunks needed to send some number of bytes."""
+    return max(1, -(-size // chunk_size))
+
+
+def build_manifest(transfer_id, capture, size, chunk_size):
+    """Build the manifest frame describing a chunked image transfer."""
+    return framing.encode_frame({
+        'transfer_id': transfer_id,
+        'capture': capture,
+        'size': size,
+        'chunk_size': chunk_size,
+        'chunk_count': count_chunks(size, chunk_size)
+    })
+
+
+def build_chunk(transfer_id, image_bytes, chunk_size, index):
+    """Build the frame for one chunk of an image."""
+    view = memoryview(image_bytes)
+    return framing.encode_frame({
+        'transfer_id': transfer_id,
+        'index': index,
+        'chunk_size': chunk_size,
+        'chunk_count': count_chunks(len(view), chunk_size)
+    }, view[index * chunk_size:(index + 1) * chunk_size])
+
+
+def is_manifest(header):
+    """Check whether a chunk topic frame header is a transfer manifest."""
+    return 'capture' in header
+
+
+# Receiving
+
+class ChunkAssembler(object):
+    """Reassembles the chunks of an image directly into a file on disk.
+
+    Chunks can arrive in any order and more than once; each chunk is written
+    at its offset in the file as it arrives, so the full image is never held
+    in memory.
+    """
+
+    def __init__(self, path, chunk_size, chunk_count):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chunk_count = chunk_count
+        self.received = set()
+        self.file = open(path, 'wb')
+
+    @property
+    def complete(self):
+        return len(self.received) == self.chunk_count
+
+    def missing(self):
+        """List the indices of chunks which haven't arrived yet."""
+        return [
+            index for index in range(self.chunk_count)
+            if index not in self.received
+        ]
+
+    def write_chunk(self, index, data):
+        """Write a chunk at its offset in the file."""
+        if index in self.received or not 0 <= index < self.chunk_count:
+            return
+        self.file.seek(index * self.chunk_size)
+        self.file.write(data)
+        self.received.add(index)
+
+    def close(self):
+        self.file.close()
+
+    def discard(self):
+        """Close and delete the partially-assembled file."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,259 @@
+"""Lazy loading of saved captures as arrays, for analysis."""
+import collections
+import concurrent.futures
+import os
+import threading
+
+from PIL import Image
+
+from picamera_mqtt.imaging import archive
+from picamera_mqtt.util import files
+
+max_time_zone_offset = 24 * 60 * 60
+
+
+def match_params(camera_params, params):
+    """Check whether camera params have the given values."""
+    if not isinstance(camera_params, dict):
+        return False
+    return all(
+        key in camera_params and camera_params[key] == value
+        for (key, value) in params.items()
+    )
+
+
+def find_captures(
+    capture_dir, client_names=None, start_time=None, end_time=None,
+    params=None, where=None
+):
+    """Find the captures saved as files by the Host, in order of time.
+
+    Captures are filtered by camera and capture time by their filenames
+    before their json metadata files are read, and then by camera params
+    values and a predicate on the metadata. Images aren't read. Each capture
+    is returned as its metadata, with the paths of its image and metadata
+    files as image_path and metadata_path.
+    """
+    captures = []
+    for (dir_path, dir_names, filenames) in os.walk(capture_dir):
+        dir_names[:] = [name for name in dir_names if name != '.partial']
+        for filename in filenames:
+            (name, extension) = os.path.splitext(filename)
+            if extension != '.json':
+                continue
+            parsed = archive.parse_capture_filename(name)
+            if parsed is None:
+                continue
+            if client_names is not None and parsed[0] not in client_names:
+                continue
+            # Filename datetimes are in the camera's local time zone
+            approximate_time = archive.parse_datetime(parsed[2])
+            if approximate_time is not None and not (
+                (
+                    start_time is None
+                    or approximate_time >= start_time - max_time_zone_offset
+                ) and (
+                    end_time is None
+                    or approximate_time <= end_time + max_time_zone_offset
+                )
+            ):
+                continue
+            metadata_path = os.path.join(dir_path, filename)
+            try:
+                capture = files.json_load(metadata_path)
+                capture_time = capture['metadata']['capture_time']['time']
+            except (ValueError, KeyError, TypeError):
+                continue
+            if (
+                (start_time is not None and capture_time < start_time)
+                or (end_time is not None and capture_time > end_time)
+            ):
+                continue
+            if params is not None and not match_params(
+                capture.get('camera_params'), params
+            ):
+                continue
+            if where is not None and not where(capture):
+                continue
+            duplicate_of = capture['metadata'].get('duplicate_of')
+            if capture.get('image') is not None:
+                capture['image_path'] = os.path.join(
+                    dir_path, capture['image']
+                )
+            elif duplicate_of is not None:
+                capture['image_path'] = os.path.join(
+                    capture_dir, duplicate_of['path']
+                )
+            else:
+                continue
+            capture['metadata_path'] = metadata_path
+            captures.append(capture)
+    captures.sort(key=lambda capture: (
+        capture['metadata']['capture_time']['time'],
+        capture['metadata']['client_name']
+    ))
+    return captures
+
+
+def load_array(image_path, mode='RGB'):
+    """Decode an image file to an array."""
+    import numpy as np
+
+    with Image.open(image_path) as image:
+        if mode is not None and image.mode != mode:
+            image = image.convert(mode)
+        return np.asarray(image)
+
+
+class ArrayCache(object):
+    """A thread-safe LRU cache of arrays, bounded by their total size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.arrays = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+    def get(self, key):
+        with self.lock:
+            array = self.arrays.get(key)
+            if array is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['hits'] += 1
+            self.arrays.move_to_end(key)
+            return array
+
+    def put(self, key, array):
+        if array.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.arrays:
+                self.bytes -= self.arrays.pop(key).nbytes
+            self.arrays[key] = array
+            self.bytes += array.nbytes
+            while self.bytes > self.max_bytes:
+                (evicted_key, evicted) = self.arrays.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.counters['evicted'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.arrays.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['arrays'] = len(self.arrays)
+            stats['bytes'] = self.bytes
+        return stats
+
+
+class CaptureDataset(object):
+    """The captures saved by the Host in a directory, as decoded arrays.
+
+    Captures are found when the dataset is first used, from their metadata
+    files; see find_captures for the filters. Images are only decoded when
+    they're accessed, and decoded arrays are kept in an LRU cache of at most
+    cache_bytes bytes, so deduplicated captures and repeated accesses don't
+    decode the same image again. Iterating over the dataset decodes the next
+    prefetch images ahead of time in a pool of threads.
+
+        dataset = CaptureDataset(capture_dir, client_names=['camera_1'])
+        for (capture, array) in dataset:
+            ...
+    """
+
+    def __init__(
+        self, capture_dir, client_names=None, start_time=None, end_time=None,
+        params=None, where=None, mode='RGB', cache_bytes=256 * 1024 * 1024,
+        prefetch=8, workers=4
+    ):
+        self.capture_dir = capture_dir
+        self.filters = {
+            'client_names': client_names,
+            'start_time': start_time,
+            'end_time': end_time,
+            'params': params,
+            'where': where
+        }
+        self.mode = mode
+        self.prefetch = prefetch
+        self.workers = workers
+        self.cache = ArrayCache(cache_bytes)
+        self._captures = None
+
+    @property
+    def captures(self):
+        """The metadata of the captures, found on first use."""
+        if self._captures is None:
+            self._captures = find_captures(self.capture_dir, **self.filters)
+        return self._captures
+
+    def __len__(self):
+        return len(self.captures)
+
+    def __getitem__(self, index):
+        """Get a capture's metadata and decoded image array."""
+        capture = self.captures[index]
+        return (capture, self.load(capture))
+
+    def load(self, capture):
+        """Decode a capture's image, or get it from the cache."""
+        image_path = capture['image_path']
+        array = self.cache.get(image_path)
+        if array is None:
+            array = load_array(image_path, mode=self.mode)
+            array.setflags(write=False)
+            self.cache.put(image_path, array)
+        return array
+
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, captures=None):
+        """Yield captures with their arrays, prefetching in a thread pool."""
+        if captures is None:
+            captures = self.captures
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers
+        ) as executor:
+            try:
+                for capture in captures:
+                    pending.append(
+                        (capture, executor.submit(self.load, capture))
+                    )
+                    if len(pending) > self.prefetch:
+                        (capture, future) = pending.popleft()
+                        yield (capture, future.result())
+                while pending:
+                    (capture, future) = pending.popleft()
+                    yield (capture, future.result())
+            finally:
+                for (capture, future) in pending:
+                    future.cancel()
+
+    def select(
+        self, client_names=None, start_time=None, end_time=None, params=None,
+        where=None
+    ):
+        """List the already-found captures which match further filters."""
+        return [
+            capture for capture in self.captures
+            if (
+                client_names is None
+                or capture['metadata']['client_name'] in client_names
+            ) and (
+                start_time is None
+                or capture['metadata']['capture_time']['time'] >= start_time
+            ) and (
+                end_time is None
+                or capture['metadata']['capture_time']['time'] <= end_time
+            ) and (
+                params is None
+                or match_params(capture.get('camera_params'), params)
+            ) and (where is None or where(capture))
+        ]
@@ -0,0 +1,137 @@
+"""Detection of near-duplicate images with perceptual hashing."""
+import logging
+import os
+import shutil
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+from picamera_mqtt.util import files
+
+logger = logging.getLogger(__name__)
+
+
+def difference_hash(image_bytes, hash_size=8):
+    """Compute the difference hash of an encoded image, as an integer.
+
+    The image is decoded at reduced size to grayscale, shrunk to
+    hash_size + 1 by hash_size pixels, and each bit of the hash records
+    whether a pixel is brighter than its left neighbor.
+    """
+    import numpy as np
+
+    image = Image.open(BytesIO(image_bytes))
+    # Let the JPEG decoder downscale while decoding, which is much faster
+    image.draft('L', (hash_size * 8, hash_size * 8))
+    image = image.convert('L').resize(
+        (hash_size + 1, hash_size), Image.BILINEAR
+    )
+    pixels = np.asarray(image, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distance(hash_1, hash_2):
+    """Count the bits which differ between two hashes."""
+    return bin(hash_1 ^ hash_2).count('1')
+
+
+class FrameDeduplicator(object):
+    """Finds images nearly identical to the last stored image of a camera.
+
+    Each image is compared with the last image from its camera which was
+    stored in full, not with the previous image, so that slow drifts are
+    still stored. Duplicates are described by a reference to that stored
+    image; references never point to other duplicates, so each chain of
+    references has a single link. At most max_references consecutive
+    duplicates are allowed before an image is stored in full anyway.
+    """
+
+    def __init__(self, threshold=4, hash_size=8, max_references=None):
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.max_references = max_references
+        self.lock = threading.Lock()
+        self.stored = {}
+        self.counters = {'stored': 0, 'duplicates': 0}
+
+    def check(self, client_name, image_bytes, reference):
+        """Check whether an image is a duplicate.
+
+        Returns the hash of the image and, if it's a duplicate, the reference
+        to the stored image it duplicates, along with their distance.
+        Otherwise, the reference to the image is remembered as the camera's
+        last stored image.
+        """
+        image_hash = difference_hash(image_bytes, hash_size=self.hash_size)
+        with self.lock:
+            stored = self.stored.get(client_name)
+            if stored is not None and (
+                self.max_references is None
+                or stored['references'] < self.max_references
+            ):
+                distance = hamming_distance(image_hash, stored['hash'])
+                if distance <= self.threshold:
+                    stored['references'] += 1
+                    self.counters['duplicates'] += 1
+                    return (image_hash, dict(
+                        stored['reference'], distance=distance
+                    ))
+            self.stored[client_name] = {
+                'hash': image_hash,
+                'reference': reference,
+                'references': 0
+            }
+            self.counters['stored'] += 1
+        return (image_hash, None)
+
+    def forget(self, paths):
+        """Stop referring to stored images whose files were deleted.
+
+        The next image from each of their cameras is then stored in full.
+        """
+        paths = set(paths)
+        with self.lock:
+            for (client_name, stored) in list(self.stored.items()):
+                if stored['reference'].get('path') in paths:
+                    del self.stored[client_name]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+def restore_duplicates(capture_dir, link=False):
+    """Restore the images of deduplicated captures saved in a directory.
+
+    The image referred to by each deduplicated capture's metadata file is
+    copied (or hard-linked) next to the metadata file, and the metadata is
+    updated to point to it. Returns the number of captures restored.
+    """
+    count = 0
+    for (dir_path, dir_names, filenames) in os.walk(capture_dir):
+        for filename in filenames:
+            if not filename.endswith('.json'):
+                continue
+            metadata_path = os.path.join(dir_path, filename)
+            try:
+                capture = files.json_load(metadata_path)
+                duplicate_of = capture['metadata']['duplicate_of']
+            except (ValueError, KeyError, TypeError):
+                continue
+            if capture.get('image') is not None:
+                continue
+            image_filename = '{}.{}'.format(
+                os.path.splitext(filename)[0], capture['format']
+            )
+            image_path = os.path.join(dir_path, image_filename)
+            reference_path = os.path.join(capture_dir, duplicate_of['path'])
+            if link:
+                os.link(reference_path, image_path)
+            else:
+                shutil.copyfile(reference_path, image_path)
+            capture['image'] = image_filename
+            files.json_dump(capture, metadata_path)
+            count += 1
+    return count
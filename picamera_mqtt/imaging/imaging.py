@@ -2,14 +2,107 @@
 """Camera abstraction layer."""
 
 import base64
+import bisect
+import collections
 import datetime
+import threading
 import time
 from io import BytesIO
 
 from PIL import Image
 
+# Names of the format of ring buffer frames, which are MJPEG frames
+jpeg_formats = ['jpeg', 'jpg']
+
+
+def wait_until(target_time):
+    """Sleep until the specified wall-clock time."""
+    delay = target_time - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+
+class FrameRing(object):
+    """A bounded ring of the most recent encoded frames from a camera.
+
+    Each frame is stored with the wall-clock time at which it was captured
+    and, if available, the camera's own sensor timestamp in microseconds.
+    """
+
+    def __init__(self, size=8):
+        self.frames = collections.deque(maxlen=size)
+        self.condition = threading.Condition()
+
+    def add_frame(self, frame_bytes, capture_time, sensor_timestamp=None):
+        with self.condition:
+            self.frames.append((capture_time, sensor_timestamp, frame_bytes))
+            self.condition.notify_all()
+
+    def closest(self, target_time):
+        """Get the stored frame captured closest to the target time."""
+        with self.condition:
+            if not self.frames:
+                return None
+            return min(
+                self.frames, key=lambda frame: abs(frame[0] - target_time)
+            )
+
+    def next_after(self, target_time, timeout=None):
+        """Get the first frame captured at or after the target time.
+
+        Blocks until such a frame arrives, or returns None on timeout.
+        """
+        with self.condition:
+            frame = self.find_after(target_time)
+            if frame is None:
+                self.condition.wait_for(
+                    lambda: self.find_after(target_time) is not None,
+                    timeout=timeout
+                )
+                frame = self.find_after(target_time)
+            return frame
+
+    def find_after(self, target_time):
+        capture_times = [frame[0] for frame in self.frames]
+        index = bisect.bisect_left(capture_times, target_time)
+        if index == len(capture_times):
+            return None
+        return self.frames[index]
+
+
+class PiCameraRingOutput(object):
+    """A picamera custom output which fills a frame ring from a recording."""
+
+    def __init__(self, pi_camera, ring):
+        self.pi_camera = pi_camera
+        self.ring = ring
+        self.buffer = BytesIO()
+
+    def write(self, data):
+        self.buffer.write(data)
+        frame = self.pi_camera.frame
+        if frame.complete:
+            receive_time = time.time()
+            sensor_timestamp = frame.timestamp
+            capture_time = receive_time
+            if sensor_timestamp is not None:
+                # Convert from the camera's clock to the wall clock
+                camera_time = self.pi_camera.timestamp
+                capture_time -= (camera_time - sensor_timestamp) / 1000000.0
+            self.ring.add_frame(
+                self.buffer.getvalue(), capture_time, sensor_timestamp
+            )
+            self.buffer = BytesIO()
+        return len(data)
+
+    def flush(self):
+        pass
+
 
 class BaseCamera(object):
+    ring = None
+    resolution = None
+
     def set_roi(self, zoom=None):
         pass
 
@@ -39,6 +132,77 @@ class BaseCamera(object):
     def capture_pil(self, format='jpeg', **format_args):
         pass
 
+    def capture_bytes(self, format='jpeg', resize=None, **format_args):
+        image_pil = self.capture_pil(format=format, **format_args)
+        if resize is not None:
+            image_pil = image_pil.resize(tuple(resize))
+        return pil_to_bytes(image_pil, format=format, **format_args)
+
+    def start_ring_buffer(self, size=8, quality=80, resize=None):
+        pass
+
+    def stop_ring_buffer(self):
+        pass
+
+    def capture_ring(self, target_time, policy='closest', timeout=1):
+        """Get a frame from the ring buffer relative to a target time.
+
+        The closest policy returns the stored frame nearest to the target
+        time, while the next policy waits for the first frame at or after it.
+        Returns a (capture time, sensor timestamp, image bytes) tuple, or None
+        if no suitable frame is available.
+        """
+        if self.ring is None:
+            return None
+        if policy == 'closest':
+            return self.ring.closest(target_time)
+        elif policy == 'next':
+            return self.ring.next_after(target_time, timeout=timeout)
+        raise ValueError('Unknown ring buffer policy: {}'.format(policy))
+
+    def capture_preview(self, resize=(320, 240), quality=20):
+        """Capture a low-resolution, low-quality preview image."""
+        return self.capture_bytes(resize=resize, quality=quality)
+
+    def capture_ring_sequence(self, start_time, count, interval=0, timeout=1):
+        """Get a sequence of consecutive or spaced frames from the ring buffer.
+
+        Returns a list of (capture time, sensor timestamp, image bytes) tuples,
+        which is cut short if a frame doesn't arrive in time.
+        """
+        frames = []
+        previous_time = None
+        for index in range(count):
+            target_time = start_time + index * interval
+            if previous_time is not None:
+                target_time = max(target_time, previous_time + 1e-6)
+            frame = self.capture_ring(
+                target_time, policy='next', timeout=timeout + interval
+            )
+            if frame is None:
+                break
+            frames.append(frame)
+            previous_time = frame[0]
+        return frames
+
+    def capture_sequence_bytes(
+        self, count, interval=0, format='jpeg', use_video_port=True,
+        resize=None, **format_args
+    ):
+        """Capture a sequence of images at the requested interval.
+
+        Returns a list of (capture time, sensor timestamp, image bytes) tuples.
+        """
+        frames = []
+        start_time = time.time()
+        for index in range(count):
+            wait_until(start_time + index * interval)
+            capture_time = time.time()
+            frames.append((capture_time, None, self.capture_bytes(
+                format=format, resize=resize, **format_args
+            )))
+        return frames
+
     def get_params(self):
         return {}
 
@@ -89,6 +253,10 @@ class Camera(BaseCamera):
             return
         self.pi_camera.resolution = (width, height)
 
+    @property
+    def resolution(self):
+        return tuple(self.pi_camera.resolution)
+
     def set_awb_gains(self, red=None, blue=None):
         if red is None and blue is None:
             return
@@ -112,9 +280,78 @@ class Camera(BaseCamera):
         stream.seek(0)
         return stream
 
+    def capture_bytes(self, format='jpeg', resize=None, **format_args):
+        # The camera's encoder handles resizing, so no re-encode is needed
+        if resize is not None:
+            resize = tuple(resize)
+        return self.capture_buffer(
+            format=format, resize=resize, **format_args
+        ).getvalue()
+
     def capture_pil(self, format='jpeg', **format_args):
         return Image.open(self.capture_buffer(format=format, **format_args))
 
+    def capture_preview(self, resize=(320, 240), quality=20):
+        """Capture a low-resolution, low-quality preview image.
+
+        The preview is taken from the video port, so the still port's
+        configuration isn't disturbed.
+        """
+        return self.capture_buffer(
+            format='jpeg', use_video_port=True, resize=tuple(resize),
+            quality=quality
+        ).getvalue()
+
+    def capture_sequence_bytes(
+        self, count, interval=0, format='jpeg', use_video_port=True,
+        resize=None, **format_args
+    ):
+        """Capture a sequence of images at the requested interval.
+
+        Uses a single picamera capture sequence, which avoids the overhead
+        of setting up a separate capture for each image.
+        Returns a list of (capture time, sensor timestamp, image bytes) tuples.
+        """
+        streams = []
+
+        def outputs():
+            start_time = time.time()
+            for index in range(count):
+                wait_until(start_time + index * interval)
+                stream = BytesIO()
+                streams.append((time.time(), stream))
+                yield stream
+
+        if resize is not None:
+            resize = tuple(resize)
+        self.pi_camera.capture_sequence(
+            outputs(), format=format, use_video_port=use_video_port,
+            resize=resize, **format_args
+        )
+        return [
+            (capture_time, None, stream.getvalue())
+            for (capture_time, stream) in streams
+        ]
+
+    def start_ring_buffer(self, size=8, quality=80, resize=None):
+        """Keep the video port streaming frames into a ring of recent frames.
+
+        Stills can then be taken from the ring without any shutter lag.
+        """
+        if self.ring is not None:
+            return
+        self.ring = FrameRing(size=size)
+        self.pi_camera.start_recording(
+            PiCameraRingOutput(self.pi_camera, self.ring), format='mjpeg',
+            quality=quality, resize=resize
+        )
+
+    def stop_ring_buffer(self):
+        if self.ring is None:
+            return
+        self.pi_camera.stop_recording()
+        self.ring = None
+
     def get_params(self):
         return {
             'sensor_mode': self.pi_camera.sensor_mode,
@@ -213,6 +450,29 @@ class MockCamera(BaseCamera):
         )
         return Image.fromarray(image_array)
 
+    def start_ring_buffer(self, size=8, quality=80, resize=None):
+        """Fill a ring of recent frames with white noise at 15 fps."""
+        if self.ring is not None:
+            return
+        self.ring = FrameRing(size=size)
+        self.ring_thread = threading.Thread(
+            target=self.run_ring_buffer, args=(self.ring, quality, resize),
+            daemon=True
+        )
+        self.ring_thread.start()
+
+    def run_ring_buffer(self, ring, quality, resize):
+        while self.ring is ring:
+            capture_time = time.time()
+            ring.add_frame(
+                self.capture_bytes(quality=quality, resize=resize),
+                capture_time
+            )
+            time.sleep(max(0, 1 / 15 - (time.time() - capture_time)))
+
+    def stop_ring_buffer(self):
+        self.ring = None
+
     def get_params(self):
         return {
             'sensor_mode': 'mock white noise',
@@ -232,20 +492,73 @@ class MockCamera(BaseCamera):
 
 # Image representation conversion
 
+def bytes_to_base64(image_bytes, encoding='utf-8'):
+    return base64.b64encode(image_bytes).decode(encoding)
+
+
 def buffer_to_base64(image_buffer, encoding='utf-8'):
-    return base64.b64encode(image_buffer.getvalue()).decode(encoding)
+    return bytes_to_base64(image_buffer.getvalue(), encoding=encoding)
 
 
-def pil_to_base64(image_pil, encoding='utf-8', format='jpeg', **format_args):
+def pil_to_bytes(image_pil, format='jpeg', **format_args):
     image_buffer = BytesIO()
     image_pil.save(image_buffer, format=format, **format_args)
-    return buffer_to_base64(image_buffer, encoding=encoding)
+    return image_buffer.getvalue()
+
+
+def pil_to_base64(image_pil, encoding='utf-8', format='jpeg', **format_args):
+    return bytes_to_base64(
+        pil_to_bytes(image_pil, format=format, **format_args),
+        encoding=encoding
+    )
 
 
 def base64_to_pil(image_base64):
     return Image.open(BytesIO(base64.b64decode(image_base64)))
 
 
+# Image transforms
+
+def transformed_size(resolution, crop=None, resize=None):
+    """Compute the size of an image after cropping and resizing."""
+    if resize is not None:
+        return tuple(resize)
+    (width, height) = resolution
+    if crop is not None:
+        return (int(crop['w'] * width), int(crop['h'] * height))
+    return (width, height)
+
+
+def transform_pil(image_pil, crop=None, resize=None):
+    """Crop and then resize an image.
+
+    The crop is a dict of x, y, w, and h as fractions of the image size, like
+    the roi reported in camera params; the resize is a (width, height) pair.
+    """
+    if crop is not None:
+        (width, height) = image_pil.size
+        image_pil = image_pil.crop((
+            int(crop['x'] * width), int(crop['y'] * height),
+            int((crop['x'] + crop['w']) * width),
+            int((crop['y'] + crop['h']) * height)
+        ))
+    if resize is not None:
+        image_pil = image_pil.resize(tuple(resize))
+    return image_pil
+
+
+def transcode_bytes(
+    image_bytes, format='jpeg', crop=None, resize=None, **format_args
+):
+    """Decode an encoded image, transform it, and encode it again.
+
+    This is a module-level function so that it can run in a process pool.
+    """
+    image_pil = Image.open(BytesIO(image_bytes))
+    image_pil = transform_pil(image_pil, crop=crop, resize=resize)
+    return pil_to_bytes(image_pil, format=format, **format_args)
+
+
 # Command-line args
 
 def add_camera_params_arguments(arg_parser):
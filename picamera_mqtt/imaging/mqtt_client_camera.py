@@ -2,21 +2,34 @@
 
 import argparse
 import asyncio
+import base64
+import collections
 import datetime
+import functools
 import json
 import logging
 import logging.config
 import time
+import uuid
 
-from picamera_mqtt import deploy
-from picamera_mqtt.imaging import imaging
+from picamera_mqtt import deploy, framing
+from picamera_mqtt.clock_sync import wait_precisely
+from picamera_mqtt.imaging import chunking, imaging
+from picamera_mqtt.imaging.adaptive import TransportAdapter
+from picamera_mqtt.imaging.camera_params import (
+    ParamsVersions, build_diff_message, build_full_message
+)
 from picamera_mqtt.mqtt_clients import AsyncioClient, message_string_encoding
 from picamera_mqtt.protocol import (
-    control_topic, deployment_topic, imaging_topic, params_topic
+    binary_encoding, chunk_topic, control_topic, deployment_topic,
+    image_encodings, imaging_topic, json_encoding, params_topic,
+    preview_topic, retransmit_topic
 )
 from picamera_mqtt.util import config
+from picamera_mqtt.util.outbox import Outbox
 from picamera_mqtt.util.async import (
-    register_keyboard_interrupt_signals, run_function
+    log_task_exception, make_executor, register_keyboard_interrupt_signals,
+    run_function, run_in_executor
 )
 from picamera_mqtt.util.logging import logging_config
 
@@ -49,22 +62,145 @@ topics = {
         'local_namespace': True,
         'subscribe': True,
         'log': True
+    },
+    chunk_topic: {
+        'qos': 1,
+        'local_namespace': True,
+        'subscribe': False,
+        'log': False
+    },
+    retransmit_topic: {
+        'qos': 2,
+        'local_namespace': True,
+        'subscribe': True,
+        'log': True
+    },
+    preview_topic: {
+        'qos': 0,
+        'local_namespace': True,
+        'subscribe': False,
+        'log': False
     }
 }
 
 
+def encode_capture(capture, image_bytes, encoding):
+    """Serialize a capture and its image into an image message payload.
+
+    In the json encoding, the base64 image is the last field, and the
+    payload is assembled as bytes without building the whole json string.
+    """
+    if encoding == binary_encoding:
+        return framing.encode_frame(capture, image_bytes)
+    header = json.dumps(capture).encode(message_string_encoding)
+    return b''.join((
+        header[:-1], b', "image": "', base64.b64encode(image_bytes), b'"}'
+    ))
+
+
+def build_burst(frames):
+    """Concatenate a sequence of captured frames into a single image body.
+
+    Returns a list describing where each frame is in the body, along with
+    its capture time, and the body itself.
+    """
+    frames_info = []
+    offset = 0
+    for (index, (capture_time, sensor_timestamp, image_bytes)) in (
+        enumerate(frames)
+    ):
+        frames_info.append({
+            'index': index,
+            'offset': offset,
+            'length': len(image_bytes),
+            'capture_time': {
+                'time': capture_time,
+                'datetime': str(datetime.datetime.fromtimestamp(capture_time))
+            },
+            'sensor_timestamp': sensor_timestamp
+        })
+        offset += len(image_bytes)
+    return (frames_info, b''.join(frame[2] for frame in frames))
+
+
+def transcode_frames(frames, format, resize, format_params):
+    """Re-encode the images of captured frames.
+
+    This is a module-level function so that it can run in a process pool.
+    """
+    return [
+        (capture_time, sensor_timestamp, imaging.transcode_bytes(
+            image_bytes, format=format, resize=resize, **format_params
+        ))
+        for (capture_time, sensor_timestamp, image_bytes) in frames
+    ]
+
+
 class Imager(AsyncioClient):
     """Acquires images based on messages from the broker."""
 
-    def __init__(self, *args, pi_username='pi', camera_params={}, **kwargs):
+    def __init__(
+        self, *args, pi_username='pi', camera_params={},
+        image_encodings=image_encodings, pass_through=True,
+        encode_executor='thread', encode_workers=1, retransmit_cache_size=4,
+        ring_buffer=None, transport_adaptation=None, preview=None,
+        params_versioning=True, params_refresh_interval=10,
+        params_cache_size=32, outbox=None, outbox_drain_rate=10, **kwargs
+    ):
         """Initialize client state."""
         super().__init__(*args, **kwargs)
 
         self.camera_params = camera_params
+        self.image_encodings = image_encodings
+        self.pass_through = pass_through
+        # The camera can only do one thing at a time, so camera operations
+        # are serialized on a single thread off the event loop.
+        self.camera_executor = make_executor('thread', max_workers=1)
+        self.encode_executor = make_executor(
+            encode_executor, max_workers=encode_workers
+        )
+        # Recently-chunked images, kept for serving retransmit requests
+        self.sent_transfers = collections.OrderedDict()
+        self.retransmit_cache_size = retransmit_cache_size
+        if transport_adaptation is not None:
+            self.transport_adapter = TransportAdapter(**transport_adaptation)
+        else:
+            self.transport_adapter = None
         self.init_imaging()
+        self.ring_buffer = ring_buffer
+        if ring_buffer is not None:
+            self.camera.start_ring_buffer(**ring_buffer)
+        self.preview = preview
+        self.preview_task = None
+        # Preview ids restart with each session of the client
+        self.preview_session = uuid.uuid4().hex[:8]
+        self.preview_id = 0
+        # Images refer to camera params by version, and params are re-read
+        # from the camera at most once per refresh interval
+        self.params_versioning = params_versioning
+        self.params_refresh_interval = params_refresh_interval
+        self.params_session = uuid.uuid4().hex[:8]
+        self.params_count = 0
+        self.params_version = None
+        self.params_read_time = None
+        self.params_cache_size = params_cache_size
+        self.params_versions = ParamsVersions(max_versions=params_cache_size)
+        # Messages published while disconnected are stored on disk, and
+        # published at most outbox_drain_rate per second once reconnected
+        if outbox is not None:
+            self.outbox = Outbox(**outbox)
+            self.outbox_executor = make_executor('thread', max_workers=1)
+        else:
+            self.outbox = None
+            self.outbox_executor = None
+        self.outbox_drain_rate = outbox_drain_rate
+        self.drain_task = None
         self.control_handlers = {
             'acquire_image': self.acquire_image,
-            'set_params': self.set_params
+            'acquire_burst': self.acquire_burst,
+            'set_params': self.set_params,
+            'get_params': self.get_params,
+            'set_preview': self.set_preview
         }
 
         self.pi_username = pi_username
@@ -84,9 +220,27 @@ class Imager(AsyncioClient):
         if self.client_name in self.camera_params:
             self.camera.set_params(**self.camera_params[self.client_name])
 
-    def on_disconnect(self, client, userdata, rc):
-        """When the client disconnects, handle it."""
-        super().on_disconnect(client, userdata, rc)
+    def track_image_publish(self, published, size, publish_time=None):
+        """Time how long an image message takes to be acknowledged."""
+        if publish_time is None:
+            publish_time = time.time()
+        published.add_done_callback(functools.partial(
+            self.on_image_published, publish_time, size, self.disconnected
+        ))
+
+    def on_image_published(self, publish_time, size, disconnected, published):
+        """When the broker acknowledges an image message, handle it."""
+        if published.cancelled():
+            return
+        if published.exception() is not None:
+            logger.error('Failed to publish image: {}'.format(
+                published.exception()
+            ))
+            return
+        if self.transport_adapter is None or disconnected.done():
+            # Times across reconnections don't reflect the link's throughput
+            return
+        self.transport_adapter.record_publish(size, publish_time, time.time())
 
     def on_deployment_topic(self, client, userdata, msg):
         """Handle any device deployment messages."""
@@ -124,66 +278,644 @@ class Imager(AsyncioClient):
 
     def add_topic_handlers(self):
         """Add any topic handler message callbacks as needed."""
-        for topic_path in self.get_topic_paths(deployment_topic):
-            self.client.message_callback_add(
-                topic_path, self.on_deployment_topic
-            )
-        for topic_path in self.get_topic_paths(control_topic):
-            self.client.message_callback_add(
-                topic_path, self.on_control_topic
+        self.add_topic_handler(deployment_topic, self.on_deployment_topic)
+        self.add_topic_handler(control_topic, self.on_control_topic)
+        self.add_topic_handler(retransmit_topic, self.on_retransmit_topic)
+
+    def on_retransmit_topic(self, client, userdata, msg):
+        """Resend any requested parts of a chunked image transfer."""
+        payload = msg.payload.decode(message_string_encoding)
+        try:
+            request = json.loads(payload)
+            transfer_id = request['transfer_id']
+        except (json.JSONDecodeError, KeyError, TypeError):
+            logger.error('Malformed retransmit request: {}'.format(payload))
+            return
+        if transfer_id not in self.sent_transfers:
+            logger.error(
+                'Transfer {} is no longer available for retransmission'
+                .format(transfer_id)
             )
+            return
+        (capture, image_bytes, chunk_size) = self.sent_transfers[transfer_id]
+        qos = self.topics[chunk_topic]['qos']
+        if request.get('manifest', False):
+            self.publish_message(chunk_topic, chunking.build_manifest(
+                transfer_id, capture, len(image_bytes), chunk_size
+            ), qos=qos)
+        chunk_indices = request.get('chunks', [])
+        logger.info('Retransmitting {} chunks of transfer {}...'.format(
+            len(chunk_indices), transfer_id
+        ))
+        for index in chunk_indices:
+            self.publish_message(chunk_topic, chunking.build_chunk(
+                transfer_id, image_bytes, chunk_size, index
+            ), qos=qos)
 
-    def acquire_image(self, params):
+    async def acquire_image(self, params):
         """Capture an image and publish it over MQTT."""
+        command_time = time.time()
         metadata = params.get('metadata', {})
         metadata['client_name'] = self.client_name
         format = params.get('format', 'jpeg')
-        capture_format_params = params.get('format_params', {
-            'quality': 100
-        })
-        transport_format_params = params.get('format_params', {
-            'quality': 80
-        })
-        capture_time = {
-            'time': time.time(),
-            'datetime': str(datetime.datetime.now())
+        capture_format_params = params.get(
+            'capture_format_params', params.get('format_params', {
+                'quality': 100
+            })
+        )
+        transport_format_params = params.get(
+            'transport_format_params', params.get('format_params', {
+                'quality': 80
+            })
+        )
+        transforms = {
+            transform: params[transform]
+            for transform in ('crop', 'resize')
+            if params.get(transform) is not None
         }
+        adaptation = None
+        if (
+            self.transport_adapter is not None
+            and params.get('adapt_transport', True)
+        ):
+            adaptation = self.transport_adapter.choose(
+                transport_format_params.get('quality', 80)
+            )
+            transport_format_params = dict(
+                transport_format_params, quality=adaptation['quality']
+            )
+            if adaptation['scale'] < 1 and self.camera.resolution is not None:
+                (width, height) = imaging.transformed_size(
+                    self.camera.resolution, **transforms
+                )
+                transforms['resize'] = [
+                    max(1, int(width * adaptation['scale'])),
+                    max(1, int(height * adaptation['scale']))
+                ]
+            metadata['transport_adaptation'] = adaptation
+        # The camera can resize while encoding, but cropping needs a re-encode
+        pass_through = (
+            params.get('pass_through', self.pass_through)
+            and 'crop' not in transforms
+        )
+        if pass_through:
+            capture_format_params = transport_format_params
+        capture_at = params.get('capture_at')
+        if capture_at is not None:
+            await self.wait_for_capture_time(capture_at)
+        captured = None
+        if params.get('source', self.default_source) == 'ring':
+            if capture_at is not None:
+                await self.loop.run_in_executor(
+                    None, wait_precisely, capture_at
+                )
+                command_time = capture_at
+            captured = await self.capture_ring_image(
+                command_time, params.get('ring_policy', 'closest'),
+                params.get('ring_timeout', 1)
+            )
+            if captured is None:
+                logger.warning(
+                    'No frame available in the ring buffer, so capturing '
+                    'a still instead...'
+                )
+        if captured is not None:
+            (capture_time, image_bytes, params_info, ring_info) = captured
+            metadata['ring_buffer'] = ring_info
+            ring_quality = self.ring_buffer.get('quality', 80)
+            capture_format_params = {'quality': ring_quality}
+            # Ring frames are already encoded as JPEG, so any other format,
+            # transform, or quality reduction needs a re-encode
+            pass_through = (
+                pass_through and format in imaging.jpeg_formats
+                and not transforms and (
+                    adaptation is None
+                    or adaptation['quality'] >= ring_quality
+                )
+            )
+            if pass_through:
+                transport_format_params = capture_format_params
+        else:
+            (capture_time, image_bytes, params_info) = await run_in_executor(
+                self.loop, self.camera_executor, self.capture_image,
+                format, capture_format_params, transforms, pass_through,
+                capture_at=capture_at
+            )
         metadata['capture_time'] = capture_time
-        image_pil = self.camera.capture_pil(
-            format=format, **capture_format_params
+        if capture_at is not None:
+            metadata['capture_skew'] = capture_time['time'] - capture_at
+        if not pass_through:
+            image_bytes = await run_in_executor(
+                self.loop, self.encode_executor, imaging.transcode_bytes,
+                image_bytes, format=format, **transforms,
+                **transport_format_params
+            )
+        output = {
+            'metadata': metadata,
+            'format': format,
+            'transport_format_params': transport_format_params,
+            'transforms': transforms,
+            'pass_through': pass_through
+        }
+        if capture_format_params != transport_format_params:
+            output['capture_format_params'] = capture_format_params
+        output.update(params_info)
+        await self.publish_capture(output, image_bytes, params)
+
+    async def acquire_burst(self, params):
+        """Capture a sequence of images and publish them in one message."""
+        command_time = time.time()
+        metadata = params.get('metadata', {})
+        metadata['client_name'] = self.client_name
+        format = params.get('format', 'jpeg')
+        transport_format_params = params.get(
+            'transport_format_params', {'quality': 80}
         )
-        image_base64 = imaging.pil_to_base64(
-            image_pil, format=format, **transport_format_params
+        count = params.get('count', 1)
+        interval = params.get('interval', 0)
+        capture_at = params.get('capture_at')
+        if capture_at is not None:
+            await self.wait_for_capture_time(capture_at)
+            command_time = capture_at
+        if (
+            params.get('source', self.default_source) == 'ring'
+            and self.camera.ring is not None
+        ):
+            if capture_at is not None:
+                await self.loop.run_in_executor(
+                    None, wait_precisely, capture_at
+                )
+            frames = await self.loop.run_in_executor(None, functools.partial(
+                self.camera.capture_ring_sequence, command_time, count,
+                interval=interval, timeout=params.get('ring_timeout', 1)
+            ))
+            ring_quality = self.ring_buffer.get('quality', 80)
+            if (
+                format in imaging.jpeg_formats
+                and params.get('resize') is None
+                and transport_format_params.get('quality', 80) >= ring_quality
+            ):
+                transport_format_params = {'quality': ring_quality}
+            elif frames:
+                # Ring frames are JPEG at the ring's quality, so any other
+                # format, size, or lower quality needs a re-encode
+                frames = await run_in_executor(
+                    self.loop, self.encode_executor, transcode_frames,
+                    frames, format, params.get('resize'),
+                    transport_format_params
+                )
+        else:
+            frames = await run_in_executor(
+                self.loop, self.camera_executor, self.capture_burst,
+                capture_at, count, interval=interval, format=format,
+                use_video_port=params.get('use_video_port', True),
+                resize=params.get('resize'), **transport_format_params
+            )
+        if not frames:
+            logger.error('Burst acquisition didn\'t capture any images!')
+            return
+        params_info = await run_in_executor(
+            self.loop, self.camera_executor, self.read_camera_params
         )
+        (frames_info, burst_bytes) = build_burst(frames)
+        metadata['capture_time'] = frames_info[0]['capture_time']
+        if capture_at is not None:
+            metadata['capture_skew'] = (
+                metadata['capture_time']['time'] - capture_at
+            )
         output = {
             'metadata': metadata,
             'format': format,
-            'capture_format_params': capture_format_params,
             'transport_format_params': transport_format_params,
-            'camera_params': self.camera.get_params(),
-            'image': image_base64
+            'frames': frames_info
         }
-        output_json = json.dumps(output)
+        output.update(params_info)
+        logger.info('Captured burst of {} images'.format(len(frames)))
+        await self.publish_capture(output, burst_bytes, params)
+
+    def capture_burst(self, capture_at, count, **kwargs):
+        """Capture a sequence of images, starting at any scheduled time."""
+        if capture_at is not None:
+            wait_precisely(capture_at)
+        return self.camera.capture_sequence_bytes(count, **kwargs)
+
+    async def wait_for_capture_time(self, capture_at, margin=0.05):
+        """Sleep until shortly before a scheduled capture time.
+
+        The rest of the wait is done precisely right before the capture, off
+        the event loop.
+        """
+        delay = capture_at - time.time() - margin
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def publish_capture(self, capture, image_bytes, params):
+        """Publish a capture in the encoding or chunking the host asked for."""
+        chunk_size = params.get('chunk_size')
+        store = self.outbox is not None and not self.connected
+        if chunk_size and len(image_bytes) > chunk_size and not store:
+            await self.publish_chunked(capture, image_bytes, chunk_size)
+            return
+
+        encoding = self.negotiate_image_encoding(
+            params.get('image_encodings', [json_encoding])
+        )
+        payload = await run_in_executor(
+            self.loop, self.encode_executor, encode_capture,
+            capture, image_bytes, encoding
+        )
+        if store:
+            logger.info('Storing {} image in the outbox...'.format(encoding))
+            await run_in_executor(
+                self.loop, self.outbox_executor, self.outbox.put,
+                imaging_topic, payload
+            )
+            return
+
         for topic_path in self.get_topic_paths(imaging_topic):
-            logger.info('Publishing image to {}...'.format(topic_path))
-        self.publish_message(imaging_topic, output_json)
+            logger.info('Publishing {} image to {}...'.format(
+                encoding, topic_path
+            ))
+        # Waits while too many images are still being sent
+        self.track_image_publish(
+            await self.publish(imaging_topic, payload), len(payload)
+        )
+
+    async def publish_chunked(self, capture, image_bytes, chunk_size):
+        """Publish an image as a manifest followed by sequenced chunks.
+
+        The image is kept for a while afterwards so that the host can request
+        retransmission of any chunks which it didn't receive.
+        """
+        transfer_id = uuid.uuid4().hex
+        self.sent_transfers[transfer_id] = (capture, image_bytes, chunk_size)
+        while len(self.sent_transfers) > self.retransmit_cache_size:
+            self.sent_transfers.popitem(last=False)
+
+        chunk_count = chunking.count_chunks(len(image_bytes), chunk_size)
+        for topic_path in self.get_topic_paths(chunk_topic):
+            logger.info(
+                'Publishing image to {} as transfer {} in {} chunks...'
+                .format(topic_path, transfer_id, chunk_count)
+            )
+        # Lost chunks are retransmitted on request, so chunks don't need
+        # the QoS 2 handshake
+        qos = self.topics[chunk_topic]['qos']
+        publish_time = time.time()
+        self.publish_message(chunk_topic, chunking.build_manifest(
+            transfer_id, capture, len(image_bytes), chunk_size
+        ), qos=qos)
+        chunks_published = []
+        for index in range(chunk_count):
+            chunk = chunking.build_chunk(
+                transfer_id, image_bytes, chunk_size, index
+            )
+            chunks_published.append(
+                await self.publish(chunk_topic, chunk, qos=qos)
+            )
+            # Let the loop service other messages between chunks
+            await asyncio.sleep(0)
+        # The whole image is one sample, since the budget is per image
+        self.track_image_publish(
+            asyncio.gather(*chunks_published), len(image_bytes),
+            publish_time=publish_time
+        )
+
+    @property
+    def default_source(self):
+        """Take images from the ring buffer by default if it's running."""
+        if self.camera.ring is not None:
+            return 'ring'
+        return 'still'
+
+    async def capture_ring_image(self, command_time, policy, timeout):
+        """Take an image from the ring buffer of recent video port frames.
+
+        The image is either the buffered frame closest to the time when the
+        command was received, or the next frame to arrive after it.
+        """
+        frame = await self.loop.run_in_executor(None, functools.partial(
+            self.camera.capture_ring, command_time, policy=policy,
+            timeout=timeout
+        ))
+        if frame is None:
+            return None
+        (frame_time, sensor_timestamp, image_bytes) = frame
+        capture_time = {
+            'time': frame_time,
+            'datetime': str(datetime.datetime.fromtimestamp(frame_time))
+        }
+        params_info = await run_in_executor(
+            self.loop, self.camera_executor, self.read_camera_params
+        )
+        ring_info = {
+            'policy': policy,
+            'sensor_timestamp': sensor_timestamp,
+            'command_latency': frame_time - command_time
+        }
+        return (capture_time, image_bytes, params_info, ring_info)
 
-    def set_params(self, params):
+    def capture_image(
+        self, format, format_params, transforms, pass_through,
+        capture_at=None
+    ):
+        """Capture an image, along with its capture time and camera params.
+
+        This blocks on the camera, so it runs on the camera executor. In
+        pass-through mode the camera encodes directly into the transport
+        format, so the image never needs to be decoded and re-encoded. If a
+        capture time is scheduled, capture waits for it precisely.
+        """
+        if capture_at is not None:
+            wait_precisely(capture_at)
+        capture_time = {
+            'time': time.time(),
+            'datetime': str(datetime.datetime.now())
+        }
+        if pass_through:
+            image_bytes = self.camera.capture_bytes(
+                format=format, resize=transforms.get('resize'),
+                **format_params
+            )
+        else:
+            image_bytes = self.camera.capture_bytes(
+                format=format, **format_params
+            )
+        return (capture_time, image_bytes, self.read_camera_params())
+
+    def negotiate_image_encoding(self, requested_encodings):
+        """Choose the first requested image encoding which is supported.
+
+        Hosts which predate encoding negotiation don't request any encodings,
+        so they receive the json encoding.
+        """
+        for encoding in requested_encodings:
+            if encoding in self.image_encodings:
+                return encoding
+        return json_encoding
+
+    async def set_params(self, params):
         """Update camera parameters."""
         params.pop('action')
-        self.camera.set_params(**params)
-        params_obj = self.camera.get_params()
+        params_obj = await run_in_executor(
+            self.loop, self.camera_executor, self.update_camera_params, params
+        )
         params_message = json.dumps(params_obj)
         self.publish_message(params_topic, params_message)
 
+    async def get_params(self, params):
+        """Publish the full camera params of a version, or the latest."""
+        params_obj = await run_in_executor(
+            self.loop, self.camera_executor, self.build_params_message,
+            params.get('version')
+        )
+        self.publish_message(params_topic, json.dumps(params_obj))
+
+    def update_camera_params(self, params):
+        """Apply camera parameters and read them back from the camera."""
+        self.camera.set_params(**params)
+        if not self.params_versioning:
+            return self.camera.get_params()
+        self.refresh_camera_params(force=True, publish=False)
+        return self.build_params_message()
+
+    def read_camera_params(self):
+        """Get the camera params fields for an image message.
+
+        Images carry either the full camera params or, with versioning, just
+        the version of the params. This blocks on the camera, so it runs on
+        the camera executor.
+        """
+        if not self.params_versioning:
+            return {'camera_params': self.camera.get_params()}
+        return {'camera_params_version': self.refresh_camera_params()}
+
+    def refresh_camera_params(self, force=False, publish=True):
+        """Re-read the camera params if they're stale, versioning changes.
+
+        Changes are published as a diff from the previous version. Returns
+        the current params version. This runs on the camera executor.
+        """
+        now = time.time()
+        if not force and self.params_version is not None and (
+            now - self.params_read_time < self.params_refresh_interval
+        ):
+            return self.params_version
+        camera_params = self.camera.get_params()
+        self.params_read_time = now
+        previous_version = self.params_version
+        previous_params = self.params_versions.get(previous_version)
+        if previous_params == camera_params:
+            return self.params_version
+        self.params_count += 1
+        self.params_version = '{}.{}'.format(
+            self.params_session, self.params_count
+        )
+        if self.outbox is not None:
+            # Each image stored in the outbox may refer to its own version,
+            # which the host can request once the image is published
+            self.params_versions.max_versions = max(
+                self.params_cache_size, len(self.outbox) + 1
+            )
+        self.params_versions.add(self.params_version, camera_params)
+        if previous_params is None:
+            params_obj = build_full_message(self.params_version, camera_params)
+        else:
+            params_obj = build_diff_message(
+                self.params_version, previous_version, previous_params,
+                camera_params
+            )
+        logger.info('Camera params changed to version {}'.format(
+            self.params_version
+        ))
+        if publish and self.outbox is not None and not self.connected:
+            # Hosts need the diffs to look up the params of stored images
+            self.outbox.put(params_topic, json.dumps(params_obj))
+        elif publish:
+            self.loop.call_soon_threadsafe(
+                self.publish_message, params_topic, json.dumps(params_obj)
+            )
+        return self.params_version
+
+    def build_params_message(self, version=None):
+        """Build the message with the full camera params of a version.
+
+        If the version is unknown or not given, the latest params are used.
+        """
+        if not self.params_versioning:
+            return self.camera.get_params()
+        camera_params = self.params_versions.get(version)
+        if camera_params is None:
+            version = self.refresh_camera_params(publish=False)
+            camera_params = self.params_versions.get(version)
+        return build_full_message(version, camera_params)
+
+    async def publish_camera_params(self):
+        """Publish the full latest camera params."""
+        params_obj = await run_in_executor(
+            self.loop, self.camera_executor, self.build_params_message
+        )
+        self.publish_message(params_topic, json.dumps(params_obj))
+
+    def on_connect(self, client, userdata, flags, rc):
+        """When the client connects, handle it."""
+        super().on_connect(client, userdata, flags, rc)
+        if rc == 0 and self.params_versioning:
+            # Hosts need the full params before they can apply any diffs
+            task = self.loop.create_task(self.publish_camera_params())
+            task.add_done_callback(log_task_exception)
+        if rc == 0:
+            self.start_draining()
+
+    def on_disconnect(self, client, userdata, rc):
+        """When the client disconnects, handle it."""
+        super().on_disconnect(client, userdata, rc)
+        if self.outbox is not None:
+            # Messages which weren't acknowledged are published again later
+            self.outbox.release_all()
+
+    def start_draining(self):
+        """Start publishing the messages stored in the outbox, if any."""
+        if self.outbox is None or not len(self.outbox):
+            return
+        if self.drain_task is not None and not self.drain_task.done():
+            return
+        self.drain_task = self.loop.create_task(self.drain_outbox())
+        self.drain_task.add_done_callback(log_task_exception)
+
+    async def drain_outbox(self):
+        """Publish the messages stored in the outbox, at a limited rate.
+
+        Messages are removed from the outbox once the broker acknowledges
+        them; draining stops when the client disconnects.
+        """
+        logger.info('Publishing {} messages from the outbox...'.format(
+            len(self.outbox)
+        ))
+        interval = 1 / self.outbox_drain_rate if self.outbox_drain_rate else 0
+        while self.connected:
+            start_time = time.time()
+            message = await run_in_executor(
+                self.loop, self.outbox_executor, self.outbox.take
+            )
+            if message is None:
+                break
+            try:
+                # Waits while too many messages are still being sent
+                published = await self.publish(
+                    message['topic'], message['payload'], qos=message['qos']
+                )
+            except BaseException:
+                self.outbox.release(message['key'])
+                raise
+            published.add_done_callback(functools.partial(
+                self.on_outbox_published, message['key']
+            ))
+            await asyncio.sleep(max(0, interval - (time.time() - start_time)))
+        logger.info('Outbox stats: {}'.format(self.outbox.stats()))
+
+    def on_outbox_published(self, key, published):
+        """When the broker acknowledges a stored message, remove it."""
+        if published.cancelled() or published.exception() is not None:
+            self.outbox.release(key)
+            return
+        self.outbox.acknowledge(key)
+
     def run_control_command(self, control_command):
-        """Apply an imaging control command."""
+        """Apply an imaging control command without blocking the event loop.
+
+        Control handlers are coroutines, so the loop keeps servicing pings and
+        other messages while a command runs.
+        """
         logger.info('Running control command: {}'.format(control_command))
         action = control_command['action']
-        self.control_handlers[action](control_command)
+        task = self.loop.create_task(
+            self.control_handlers[action](control_command)
+        )
+        task.add_done_callback(log_task_exception)
+        return task
+
+    async def set_preview(self, params):
+        """Start, stop, or reconfigure the preview stream.
+
+        A missing or null interval stops the preview stream.
+        """
+        params.pop('action')
+        if params.get('interval') is None:
+            self.preview = None
+        else:
+            self.preview = params
+        self.start_preview()
+
+    def start_preview(self):
+        """Start publishing previews periodically, if configured to."""
+        if self.preview_task is not None:
+            self.preview_task.cancel()
+            self.preview_task = None
+        if self.preview is not None:
+            self.preview_task = self.loop.create_task(self.run_preview())
+            self.preview_task.add_done_callback(log_task_exception)
+
+    async def run_preview(self):
+        """Periodically publish a low-resolution preview image."""
+        interval = self.preview['interval']
+        resize = (
+            self.preview.get('width', 320), self.preview.get('height', 240)
+        )
+        quality = self.preview.get('quality', 20)
+        logger.info(
+            'Publishing {}x{} previews every {} sec...'
+            .format(resize[0], resize[1], interval)
+        )
+        while True:
+            start_time = time.time()
+            if not self.disconnected.done():
+                await self.publish_preview(resize, quality)
+            await asyncio.sleep(max(0, interval - (time.time() - start_time)))
+
+    async def publish_preview(self, resize, quality):
+        capture_time = time.time()
+        image_bytes = await run_in_executor(
+            self.loop, self.camera_executor, self.camera.capture_preview,
+            resize=resize, quality=quality
+        )
+        self.preview_id += 1
+        header = {
+            'client_name': self.client_name,
+            'preview_session': self.preview_session,
+            'preview_id': self.preview_id,
+            'capture_time': {
+                'time': capture_time,
+                'datetime': str(datetime.datetime.fromtimestamp(capture_time))
+            },
+            'format': 'jpeg',
+            'resolution': {'width': resize[0], 'height': resize[1]},
+            'quality': quality
+        }
+        self.publish_message(
+            preview_topic, framing.encode_frame(header, image_bytes)
+        )
+
+    def on_run(self):
+        """When the client starts the run loop, handle it."""
+        self.start_preview()
+
+    def on_quit(self):
+        """When the client quits the run loop, handle it."""
+        if self.preview_task is not None:
+            self.preview_task.cancel()
+        if self.drain_task is not None:
+            self.drain_task.cancel()
+        if self.outbox is not None:
+            self.outbox_executor.shutdown(wait=True)
+            self.outbox.close()
+        self.camera.stop_ring_buffer()
+        self.camera_executor.shutdown(wait=False)
+        if self.encode_executor is not None:
+            self.encode_executor.shutdown(wait=False)
 
     async def attempt_reconnect(self):
-        """Prepare the system for a reconnection attempt."""
+        """Try to recover the network after repeated connection failures."""
         await deploy.reconnect()
 
 
@@ -1,22 +1,40 @@
 """Test script to send control messages to a MQTT topic."""
 
+import base64
+import binascii
+import collections
 import datetime
+import functools
 import json
 import logging
 import logging.config
 import os
+import threading
 import time
 
+from picamera_mqtt import framing
+from picamera_mqtt.imaging import archive, chunking
+from picamera_mqtt.imaging.analytics import ImageAnalyzer, image_formats
+from picamera_mqtt.imaging.camera_params import ParamsVersions
+from picamera_mqtt.imaging.capture_index import CaptureIndex
+from picamera_mqtt.imaging.dedup import FrameDeduplicator
+from picamera_mqtt.imaging.retention import RetentionManager
 from picamera_mqtt.mqtt_clients import AsyncioClient, message_string_encoding
 from picamera_mqtt.protocol import (
-    connect_topic, control_topic, deployment_topic, imaging_topic, params_topic
+    chunk_topic, connect_topic, control_topic, deployment_topic,
+    image_encodings, imaging_topic, params_topic, preview_topic,
+    retransmit_topic
 )
 from picamera_mqtt.util import files
+from picamera_mqtt.util.pipeline import ReceivePipeline
+from picamera_mqtt.util.storage import StorageWriter, build_layout_dir
 
 
 # Set up logging
 logger = logging.getLogger(__name__)
 payload_log_max_len = 400
+json_image_key = b', "image": "'
+json_image_end = b'"}'
 
 # Configure messaging
 topics = {
@@ -49,25 +67,252 @@ topics = {
         'local_namespace': False,
         'subscribe': True,
         'log': True
+    },
+    chunk_topic: {
+        'qos': 1,
+        'local_namespace': True,
+        'subscribe': True,
+        'log': False
+    },
+    retransmit_topic: {
+        'qos': 2,
+        'local_namespace': True,
+        'subscribe': False,
+        'log': False
+    },
+    preview_topic: {
+        'qos': 0,
+        'local_namespace': True,
+        'subscribe': True,
+        'log': False
     }
 }
 
 
+class MalformedCaptureError(ValueError):
+    """Raised when an image message payload cannot be parsed."""
+    pass
+
+
+def parse_capture(payload):
+    """Parse an image message payload into a capture with image bytes.
+
+    Both binary frames and the legacy json encoding are accepted; the
+    encoding is detected from the payload itself.
+    """
+    if framing.is_frame(payload):
+        try:
+            (capture, image) = framing.decode_frame(payload)
+        except framing.FramingError as e:
+            raise MalformedCaptureError(str(e))
+        capture['image'] = image
+        return capture
+
+    try:
+        capture = parse_json_capture(payload)
+    except (
+        UnicodeDecodeError, json.JSONDecodeError, KeyError, TypeError,
+        binascii.Error
+    ):
+        payload_truncated = (
+            payload[:payload_log_max_len]
+            + (payload[payload_log_max_len:] and b'...')
+        )
+        raise MalformedCaptureError(str(payload_truncated))
+    return capture
+
+
+def parse_json_capture(payload):
+    """Parse a legacy json image message payload.
+
+    Cameras serialize the base64 image as the last field, so the json before
+    it is parsed on its own and the image is decoded directly from a view of
+    the payload, without decoding the whole payload into a string. Payloads
+    laid out differently are parsed in full.
+    """
+    image_start = -1
+    if isinstance(payload, bytes) and payload.endswith(json_image_end):
+        image_start = payload.rfind(json_image_key)
+    if image_start < 0:
+        capture = json.loads(payload.decode(message_string_encoding))
+        capture['image'] = base64.b64decode(capture['image'])
+        return capture
+
+    view = memoryview(payload)
+    capture = json.loads(
+        (bytes(view[:image_start]) + b'}').decode(message_string_encoding)
+    )
+    capture['image'] = binascii.a2b_base64(
+        view[image_start + len(json_image_key):-len(json_image_end)]
+    )
+    return capture
+
+
+def parse_capture_detached(payload):
+    """Parse an image message payload, copying the image out of the payload.
+
+    The capture can then be pickled, as when parsing in a process pool.
+    """
+    capture = parse_capture(payload)
+    capture['image'] = bytes(capture['image'])
+    return capture
+
+
+def build_burst_frame(capture, frame, frame_image):
+    """Build the capture for one image in a burst."""
+    frame_capture = dict(capture)
+    frame_capture['metadata'] = dict(capture['metadata'])
+    frame_capture['metadata']['capture_time'] = frame['capture_time']
+    frame_capture['metadata']['burst'] = {
+        'frame_index': frame['index'],
+        'sensor_timestamp': frame['sensor_timestamp']
+    }
+    frame_capture['image'] = frame_image
+    return frame_capture
+
+
 class Host(AsyncioClient):
     """Sends imaging control messages to broker and saves received images."""
 
-    def __init__(self, *args, capture_dir='', camera_params={}, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(
+        self, *args, capture_dir='', camera_params={},
+        image_encodings=image_encodings, chunk_size=None, chunk_timeout=5,
+        max_retransmits=3, clock_sync_interval=30,
+        receive_workers=2, receive_queue_size=16, receive_overflow='pause',
+        receive_parse_executor='thread', storage='files',
+        archive_segment_size=256 * 1024 * 1024, index_path=None,
+        storage_layout='flat', storage_durability='none',
+        storage_sync_interval=5, storage_queue_size=64, metadata_indent=2,
+        deduplication=None, retention=None, params_wait_timeout=2,
+        analytics=None, **kwargs
+    ):
+        super().__init__(
+            *args, clock_sync_interval=clock_sync_interval, **kwargs
+        )
         self.camera_params = camera_params
+        self.image_encodings = image_encodings
         self.image_ids = {target_name: 1 for target_name in self.target_names}
         self.capture_dir = capture_dir
+        self.chunk_size = chunk_size
+        self.chunk_timeout = chunk_timeout
+        self.max_retransmits = max_retransmits
+        self.transfers = {}
+        self.finished_transfers = collections.deque(maxlen=64)
+        self.storage_layout = storage_layout
+        self.metadata_indent = metadata_indent
+        self.archive = None
+        self.storage_writer = None
+        self.retention = None
+        if storage == 'archive':
+            if retention is not None:
+                raise ValueError('Archives do not support retention policies')
+            self.archive = archive.CaptureArchive(
+                capture_dir, max_segment_size=archive_segment_size
+            )
+        elif storage == 'files':
+            if retention is not None:
+                self.retention = RetentionManager(
+                    capture_dir, evict_callback=self.on_evict, **retention
+                )
+            # Image and metadata files are written behind in a thread
+            self.storage_writer = StorageWriter(
+                durability=storage_durability,
+                sync_interval=storage_sync_interval,
+                max_queue_size=storage_queue_size,
+                disk_full_callback=(
+                    None if self.retention is None
+                    else self.retention.make_space
+                )
+            )
+        else:
+            raise ValueError('Unknown storage backend: {}'.format(storage))
+        # Near-duplicate images are saved as references to earlier images
+        if deduplication is not None:
+            self.deduplicator = FrameDeduplicator(**deduplication)
+        else:
+            self.deduplicator = None
+        # Image quality metrics are computed in a process pool
+        if analytics is not None:
+            self.analyzer = ImageAnalyzer(**analytics)
+        else:
+            self.analyzer = None
+        self.analysis_lock = threading.Lock()
+        if index_path is not None:
+            self.capture_index = CaptureIndex(index_path)
+        else:
+            self.capture_index = None
+        # Recent versions of each camera's params, for filling in the params
+        # of images which only refer to a params version
+        self.camera_params_versions = {
+            target_name: ParamsVersions() for target_name in self.target_names
+        }
+        self.params_wait_timeout = params_wait_timeout
+        # Saved captures awaiting the params versions they refer to, by
+        # camera and version
+        self.pending_params = {}
+        self.pending_params_lock = threading.Lock()
+        # Only the latest preview from each camera is kept
+        self.previews = {}
+        # Received images are parsed and saved off the event loop
+        if receive_parse_executor == 'process':
+            parse_function = parse_capture_detached
+        else:
+            parse_function = parse_capture
+        self.receive_pipeline = ReceivePipeline(
+            self.loop, parse_function, self.on_received_capture,
+            max_queue_size=receive_queue_size, workers=receive_workers,
+            parse_executor=receive_parse_executor, overflow=receive_overflow,
+            pause_reading=self.helper.pause_reading,
+            resume_reading=self.helper.resume_reading
+        )
 
     def add_topic_handlers(self):
         """Add any topic handler message callbacks as needed."""
-        for topic_path in self.get_topic_paths(params_topic):
-            self.client.message_callback_add(topic_path, self.on_params_topic)
-        for topic_path in self.get_topic_paths(imaging_topic):
-            self.client.message_callback_add(topic_path, self.on_imaging_topic)
+        self.add_topic_handler(params_topic, self.on_params_topic)
+        self.add_topic_handler(imaging_topic, self.on_imaging_topic)
+        self.add_topic_handler(chunk_topic, self.on_chunk_topic)
+        self.add_topic_handler(connect_topic, self.on_connect_topic)
+        self.add_topic_handler(preview_topic, self.on_preview_topic)
+
+    def on_preview_topic(self, client, userdata, msg):
+        """Replace the stored preview of a camera with a newer one."""
+        target_name = msg.topic.split('/')[0]
+        try:
+            (header, image) = framing.decode_frame(msg.payload)
+        except framing.FramingError as e:
+            logger.error('Malformed preview: {}'.format(e))
+            return
+        previous = self.previews.get(target_name)
+        # Only previews from the same session of a camera can be out of
+        # order; a camera which restarted counts its previews from 1 again
+        if (
+            previous is not None
+            and previous[0]['client_name'] == header['client_name']
+            and previous[0].get('preview_session')
+            == header.get('preview_session')
+            and previous[0]['preview_id'] > header['preview_id']
+        ):
+            return
+        header['receive_time'] = time.time()
+        self.previews[target_name] = (header, image)
+        logger.debug('Received preview {} from {}'.format(
+            header['preview_id'], target_name
+        ))
+
+    def get_preview(self, target_name):
+        """Get the latest preview header and image bytes from a camera."""
+        return self.previews.get(target_name)
+
+    def on_connect_topic(self, client, userdata, msg):
+        """Sync clocks with any camera as soon as it (re)connects."""
+        target_name = msg.payload.decode(message_string_encoding)
+        logger.info('Client {} connected to the broker'.format(target_name))
+        # Previews from before a reconnection are stale
+        self.previews.pop(target_name, None)
+        if target_name not in self.target_names:
+            return
+        for i in range(self.clock_sync_samples):
+            self.loop.call_later(0.05 * i, self.request_clock_sync, target_name)
 
     def on_params_topic(self, client, userdata, msg):
         payload = msg.payload.decode(message_string_encoding)
@@ -76,86 +321,655 @@ class Host(AsyncioClient):
             'Received camera params response from target {}: {}'
             .format(target_name, payload)
         )
-
-    def on_imaging_topic(self, client, userdata, msg):
-        payload = msg.payload.decode(message_string_encoding)
-        receive_time = time.time()
-        receive_datetime = str(datetime.datetime.now())
         try:
-            capture = json.loads(payload)
+            params_obj = json.loads(payload)
         except json.JSONDecodeError:
-            payload_truncated = (
-                payload[:payload_log_max_len]
-                + (payload[payload_log_max_len:] and '...')
+            return
+        if not isinstance(params_obj, dict) or 'version' not in params_obj:
+            # Cameras without params versioning send bare params
+            return
+        versions = self.get_params_versions(target_name)
+        if not versions.apply_message(params_obj):
+            logger.warning(
+                'Missing base for camera params version {} from {}'
+                .format(params_obj['version'], target_name)
             )
-            logger.error('Malformed image: {}'.format(payload_truncated))
+            self.request_camera_params(target_name, params_obj['version'])
             return
-        capture['metadata']['receive_time'] = {
-            'time': receive_time,
-            'datetime': receive_datetime
-        }
+        self.resolve_pending_params(target_name, params_obj['version'])
 
-        self.save_captured_image(capture)
-        capture.pop('image', None)
-        self.save_captured_metadata(capture)
+    def get_params_versions(self, target_name):
+        return self.camera_params_versions.setdefault(
+            target_name, ParamsVersions()
+        )
+
+    def on_imaging_topic(self, client, userdata, msg):
+        """Queue a received image for parsing and saving."""
+        target_name = msg.topic.split('/')[0]
+        # Images from each camera are saved in the order they're received
+        self.receive_pipeline.put(msg.payload, {
+            'topic': msg.topic,
+            'receive_time': {
+                'time': time.time(),
+                'datetime': str(datetime.datetime.now())
+            }
+        }, key=target_name)
+
+    def on_received_capture(self, capture, context):
+        """Save a parsed capture; runs in the receive pipeline's workers."""
+        capture['metadata']['receive_time'] = context['receive_time']
+        self.on_capture(capture, context['topic'])
+
+    async def finish_processing(self):
+        """Save the received images which are still queued."""
+        await self.receive_pipeline.drain()
+
+    def on_quit(self):
+        """When the client quits the run loop, handle it."""
+        # Handlers which are still saving captures finish before storage
+        # is closed
+        self.receive_pipeline.stop()
+        logger.info('Receive pipeline stats: {}'.format(
+            self.receive_pipeline.stats()
+        ))
+        if self.analyzer is not None:
+            # Pending results are saved before storage is closed
+            self.analyzer.stop()
+            logger.info('Analytics stats: {}'.format(self.analyzer.stats()))
+        if self.archive is not None:
+            self.archive.close()
+        if self.storage_writer is not None:
+            self.storage_writer.close()
+            logger.info('Storage writer stats: {}'.format(
+                self.storage_writer.stats()
+            ))
+        if self.retention is not None:
+            self.retention.stop()
+            logger.info('Retention stats: {}'.format(self.retention.stats()))
+        if self.capture_index is not None:
+            self.capture_index.close()
+        if self.deduplicator is not None:
+            logger.info('Deduplication stats: {}'.format(
+                self.deduplicator.stats()
+            ))
+
+    def on_capture(self, capture, topic):
+        """Save a received capture."""
+        if 'frames' in capture:
+            self.on_burst(capture, topic)
+            return
+
+        params_pending = self.rehydrate_camera_params(capture)
+
+        clock_sync = capture['metadata'].get('clock_sync')
+        if clock_sync is not None and clock_sync['offset'] is not None:
+            # Report the capture time on the host's clock, for comparisons
+            # across cameras
+            host_capture_time = (
+                capture['metadata']['capture_time']['time']
+                - clock_sync['offset']
+            )
+            capture['metadata']['clock_sync'] = dict(
+                clock_sync, host_capture_time=host_capture_time,
+                host_skew=host_capture_time - clock_sync['capture_at']
+            )
+
+        if self.deduplicator is not None:
+            self.deduplicate_capture(capture)
+        duplicate_of = capture['metadata'].get('duplicate_of')
+        analysis_path = None
+        if (
+            self.analyzer is not None and duplicate_of is None
+            and capture.get('format') in image_formats
+        ):
+            # Queued before saving, which may move the image's file
+            analysis_path = self.analyze_capture(capture)
+        if self.archive is not None:
+            archive_entry = self.archive_capture(capture)
+            self.index_capture(
+                capture, path=self.capture_dir, archive_entry=archive_entry
+            )
+            if params_pending:
+                self.defer_camera_params(
+                    capture, path=self.capture_dir, archive_entry=archive_entry
+                )
+        else:
+            if duplicate_of is not None:
+                size = None
+                image_path = os.path.join(
+                    self.capture_dir, duplicate_of['path']
+                )
+            else:
+                if 'image_file' in capture:
+                    size = os.path.getsize(capture['image_file'])
+                else:
+                    size = len(capture['image'])
+                image_path = self.save_captured_image(capture)
+            capture.pop('image', None)
+            metadata_path = self.save_captured_metadata(capture)
+            self.index_capture(
+                capture, path=image_path, metadata_path=metadata_path,
+                size=size
+            )
+            if params_pending:
+                self.defer_camera_params(
+                    capture, path=image_path, metadata_path=metadata_path,
+                    size=size
+                )
+            if self.retention is not None:
+                file_sizes = {metadata_path: None}
+                if duplicate_of is None:
+                    file_sizes[image_path] = size
+                if analysis_path is not None:
+                    # Small enough not to count, but deleted on eviction
+                    file_sizes[analysis_path] = 0
+                self.retention.add(
+                    capture['metadata']['client_name'],
+                    capture['metadata']['capture_time']['time'], file_sizes,
+                    reference=None if duplicate_of is None else image_path
+                )
         capture['camera_params'] = '...'
         logger.debug('Received image on topic {}: {}'.format(
-            msg.topic, json.dumps(capture)
+            topic, json.dumps(capture)
+        ))
+
+    def rehydrate_camera_params(self, capture):
+        """Fill in params which a capture only refers to or left out.
+
+        If a capture refers to a camera params version which hasn't been
+        received, the full params of that version are requested from the
+        camera, and True is returned so that the capture can be saved
+        without waiting for them. Versions which never arrived aren't
+        requested again.
+        """
+        if 'transport_format_params' in capture:
+            # Format params are only sent once if they were the same
+            capture.setdefault(
+                'capture_format_params', capture['transport_format_params']
+            )
+        version = capture.get('camera_params_version')
+        if version is None or 'camera_params' in capture:
+            return
+        target_name = capture['metadata']['client_name']
+        versions = self.get_params_versions(target_name)
+        camera_params = versions.get(version)
+        if camera_params is None and versions.is_missing(version):
+            logger.warning(
+                'Camera params version {} from {} is missing, so the capture '
+                'is saved without it'.format(version, target_name)
+            )
+        elif camera_params is None:
+            with self.pending_params_lock:
+                if (target_name, version) not in self.pending_params:
+                    self.pending_params[(target_name, version)] = []
+                    self.loop.call_soon_threadsafe(
+                        self.request_pending_params, target_name, version
+                    )
+            capture['camera_params'] = None
+            return True
+        capture['camera_params'] = camera_params
+        return False
+
+    def request_pending_params(self, target_name, version):
+        """Request a params version, giving up on it after a timeout."""
+        self.request_camera_params(target_name, version)
+        self.loop.call_later(
+            self.params_wait_timeout, self.expire_pending_params,
+            target_name, version
+        )
+
+    def defer_camera_params(self, capture, **index_kwargs):
+        """Fill in a saved capture's params once their version arrives."""
+        target_name = capture['metadata']['client_name']
+        version = capture['camera_params_version']
+        # Later changes to the capture, e.g. for logging, aren't saved
+        capture = dict(capture)
+        with self.pending_params_lock:
+            pending = self.pending_params.get((target_name, version))
+            if pending is not None:
+                pending.append((capture, index_kwargs))
+                return
+        # The version arrived or expired while the capture was being saved
+        camera_params = self.get_params_versions(target_name).get(version)
+        if camera_params is not None:
+            self.fill_camera_params(
+                [(capture, index_kwargs)], camera_params
+            )
+
+    def resolve_pending_params(self, target_name, version):
+        """Fill in the params of saved captures awaiting a new version."""
+        with self.pending_params_lock:
+            pending = self.pending_params.pop((target_name, version), None)
+        if not pending:
+            return
+        camera_params = self.get_params_versions(target_name).get(version)
+        self.loop.run_in_executor(
+            None, self.fill_camera_params, pending, camera_params
+        )
+
+    def expire_pending_params(self, target_name, version):
+        """Stop awaiting a params version which never arrived."""
+        versions = self.get_params_versions(target_name)
+        if versions.get(version) is not None:
+            return
+        versions.mark_missing(version)
+        with self.pending_params_lock:
+            pending = self.pending_params.pop((target_name, version), [])
+        logger.error(
+            'Camera params version {} from {} never arrived, so {} captures '
+            'are saved without it'.format(version, target_name, len(pending))
+        )
+
+    def fill_camera_params(self, pending, camera_params):
+        """Save the params of captures which were saved without them.
+
+        Metadata files are rewritten and index rows are replaced; archived
+        records can't be rewritten, so only their index rows are updated.
+        """
+        for (capture, index_kwargs) in pending:
+            capture['camera_params'] = camera_params
+            metadata_path = index_kwargs.get('metadata_path')
+            if metadata_path is not None:
+                self.storage_writer.write_bytes(metadata_path, json.dumps(
+                    capture, indent=self.metadata_indent
+                ).encode(message_string_encoding))
+            self.index_capture(capture, **index_kwargs)
+
+    def deduplicate_capture(self, capture):
+        """Drop the image of a capture if it nearly duplicates a saved one.
+
+        The duplicate's metadata then refers to the saved image instead.
+        """
+        metadata = capture['metadata']
+        if 'image_file' in capture:
+            image = files.bytes_load(capture['image_file'])
+        else:
+            image = capture['image']
+        capture_filename = self.build_capture_filename(capture)
+        reference = {
+            'client_name': metadata['client_name'],
+            'image_id': metadata['image_id'],
+            'capture_time': metadata['capture_time']['time'],
+            'path': os.path.relpath(os.path.join(
+                self.build_capture_dir(capture),
+                '{}.{}'.format(capture_filename, capture['format'])
+            ), self.capture_dir)
+        }
+        try:
+            (image_hash, duplicate_of) = self.deduplicator.check(
+                metadata['client_name'], image, reference
+            )
+        except (OSError, ValueError) as e:
+            logger.error('Could not hash image for deduplication: {}'.format(e))
+            return
+        metadata['perceptual_hash'] = '{:x}'.format(image_hash)
+        if duplicate_of is None:
+            return
+        logger.info('Image {} from {} duplicates image {}'.format(
+            metadata['image_id'], metadata['client_name'],
+            duplicate_of['image_id']
         ))
+        metadata['duplicate_of'] = duplicate_of
+        capture['image'] = b''
+        image_file = capture.pop('image_file', None)
+        if image_file is not None:
+            os.remove(image_file)
+
+    def on_burst(self, capture, topic):
+        """Save each image of a received burst as a separate capture."""
+        frames = capture.pop('frames')
+        image_file = capture.pop('image_file', None)
+        if image_file is not None:
+            with open(image_file, 'rb') as f:
+                for frame in frames:
+                    f.seek(frame['offset'])
+                    frame_image = f.read(frame['length'])
+                    self.on_capture(
+                        build_burst_frame(capture, frame, frame_image), topic
+                    )
+            os.remove(image_file)
+            return
+
+        image = memoryview(capture.pop('image'))
+        for frame in frames:
+            frame_image = image[
+                frame['offset']:frame['offset'] + frame['length']
+            ]
+            self.on_capture(
+                build_burst_frame(capture, frame, frame_image), topic
+            )
+
+    def on_chunk_topic(self, client, userdata, msg):
+        """Write a received image chunk or manifest to its transfer."""
+        target_name = msg.topic.split('/')[0]
+        try:
+            (header, body) = framing.decode_frame(msg.payload)
+            transfer_id = header['transfer_id']
+            if transfer_id in self.finished_transfers:
+                # Late duplicate of a retransmitted chunk
+                return
+            transfer = self.get_transfer(target_name, header)
+            if chunking.is_manifest(header):
+                transfer['capture'] = header['capture']
+            else:
+                transfer['assembler'].write_chunk(header['index'], body)
+        except (framing.FramingError, KeyError, TypeError) as e:
+            logger.error('Malformed image chunk: {}'.format(e))
+            return
+        if (
+            transfer['capture'] is not None
+            and transfer['assembler'].complete
+        ):
+            self.finish_transfer(transfer_id, msg.topic)
+        else:
+            self.schedule_transfer_timeout(transfer_id)
+
+    def get_transfer(self, target_name, header):
+        """Look up a chunked image transfer, starting it if it's new.
+
+        Every chunk describes the chunk layout of its transfer, so chunks can
+        be written to disk even if they arrive before the manifest.
+        """
+        transfer_id = header['transfer_id']
+        if transfer_id in self.transfers:
+            return self.transfers[transfer_id]
+        partial_dir = os.path.join(self.capture_dir, '.partial')
+        files.ensure_path(partial_dir)
+        transfer = {
+            'target_name': target_name,
+            'capture': None,
+            'assembler': chunking.ChunkAssembler(
+                os.path.join(partial_dir, '{}.part'.format(transfer_id)),
+                header['chunk_size'], header['chunk_count']
+            ),
+            'retransmits': 0,
+            'timeout': None
+        }
+        self.transfers[transfer_id] = transfer
+        return transfer
+
+    def schedule_transfer_timeout(self, transfer_id):
+        """Restart the timer for requesting missing parts of a transfer."""
+        transfer = self.transfers[transfer_id]
+        if transfer['timeout'] is not None:
+            transfer['timeout'].cancel()
+        transfer['timeout'] = self.loop.call_later(
+            self.chunk_timeout, self.on_transfer_timeout, transfer_id
+        )
+
+    def on_transfer_timeout(self, transfer_id):
+        """Request retransmission of whatever a stalled transfer is missing."""
+        transfer = self.transfers[transfer_id]
+        transfer['timeout'] = None
+        if transfer['retransmits'] >= self.max_retransmits:
+            logger.error(
+                'Giving up on image transfer {} from {} after {} retransmits'
+                .format(
+                    transfer_id, transfer['target_name'],
+                    transfer['retransmits']
+                )
+            )
+            self.transfers.pop(transfer_id)
+            self.finished_transfers.append(transfer_id)
+            transfer['assembler'].discard()
+            return
+
+        transfer['retransmits'] += 1
+        request = {
+            'transfer_id': transfer_id,
+            'manifest': transfer['capture'] is None,
+            'chunks': transfer['assembler'].missing()
+        }
+        logger.info(
+            'Requesting retransmission of {} chunks of transfer {} from {}'
+            .format(
+                len(request['chunks']), transfer_id, transfer['target_name']
+            )
+        )
+        self.publish_message(
+            retransmit_topic, json.dumps(request),
+            local_namespace=transfer['target_name']
+        )
+        self.schedule_transfer_timeout(transfer_id)
+
+    def finish_transfer(self, transfer_id, topic):
+        """Save the capture from a completely-reassembled transfer."""
+        transfer = self.transfers.pop(transfer_id)
+        self.finished_transfers.append(transfer_id)
+        if transfer['timeout'] is not None:
+            transfer['timeout'].cancel()
+        transfer['assembler'].close()
+        capture = transfer['capture']
+        capture['image_file'] = transfer['assembler'].path
+        self.receive_pipeline.put_parsed(capture, {
+            'topic': topic,
+            'receive_time': {
+                'time': time.time(),
+                'datetime': str(datetime.datetime.now())
+            }
+        }, key=transfer['target_name'])
 
     def build_capture_filename(self, capture):
-        return '{} {} {}'.format(
+        return archive.build_capture_filename(capture)
+
+    def archive_capture(self, capture):
+        """Append a capture to the archive instead of saving it as files."""
+        image = capture.pop('image', None)
+        image_file = capture.pop('image_file', None)
+        entry = self.archive.append(capture, image=image, image_file=image_file)
+        if image_file is not None:
+            os.remove(image_file)
+        logger.info('Archived image in segment {} at offset {}'.format(
+            entry['segment'], entry['offset']
+        ))
+        return entry
+
+    def analyze_capture(self, capture):
+        """Queue a capture's image for analysis, without waiting.
+
+        Results are saved next to the metadata file, or appended to a json
+        lines file in the capture directory for archives. The image is only
+        read from its file if the analyzer has room for it. Returns the path
+        the results will be saved to, or None if the image was skipped.
+        """
+        metadata = capture['metadata']
+        reference = {
+            'client_name': metadata['client_name'],
+            'image_id': metadata['image_id'],
+            'capture_time': metadata['capture_time']['time']
+        }
+        if 'burst' in metadata:
+            reference['burst_frame'] = metadata['burst']['frame_index']
+        if self.archive is None:
+            analysis_path = '{}.analysis.json'.format(
+                os.path.splitext(self.build_metadata_path(capture))[0]
+            )
+        else:
+            analysis_path = os.path.join(self.capture_dir, 'analysis.jsonl')
+        if 'image_file' in capture:
+            load_image = functools.partial(
+                files.bytes_load, capture['image_file']
+            )
+        else:
+            load_image = functools.partial(bytes, capture['image'])
+        if not self.analyzer.submit(load_image, functools.partial(
+            self.on_analysis, reference, analysis_path
+        )):
+            logger.warning('Skipped analysis of image {} from {}'.format(
+                metadata['image_id'], metadata['client_name']
+            ))
+            return None
+        return analysis_path
+
+    def on_analysis(self, reference, analysis_path, metrics):
+        """When the analysis of a saved image finishes, save its results."""
+        result = dict(reference, analysis=metrics)
+        if self.archive is None:
+            self.storage_writer.write_bytes(analysis_path, json.dumps(
+                result, indent=self.metadata_indent
+            ).encode(message_string_encoding))
+            return
+        with self.analysis_lock:
+            with open(analysis_path, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+    def on_evict(self, paths):
+        """When saved captures are evicted, handle it."""
+        if self.capture_index is not None:
+            self.capture_index.remove_paths(paths)
+        if self.deduplicator is not None:
+            # New images mustn't refer to deleted images
+            self.deduplicator.forget(
+                os.path.relpath(path, self.capture_dir) for path in paths
+            )
+
+    def index_capture(self, capture, **kwargs):
+        """Add a saved capture to the metadata index, if there is one."""
+        if self.capture_index is None:
+            return
+        self.capture_index.add(capture, **kwargs)
+
+    def build_capture_dir(self, capture):
+        """Choose the directory of a capture's files from the layout."""
+        return build_layout_dir(
+            self.capture_dir, self.storage_layout,
             capture['metadata']['client_name'],
-            capture['metadata']['image_id'],
-            capture['metadata']['capture_time']['datetime']
+            capture['metadata']['capture_time']['time']
         )
 
     def save_captured_image(self, capture):
-        files.ensure_path(self.capture_dir)
         capture_filename = self.build_capture_filename(capture)
         image_filename = '{}.{}'.format(capture_filename, capture['format'])
-        image_base64 = capture['image']
-        image_path = os.path.join(self.capture_dir, image_filename)
-        files.b64_string_bytes_save(image_base64, image_path)
-        logger.info('Saved image to: {}'.format(image_path))
+        image_path = os.path.join(
+            self.build_capture_dir(capture), image_filename
+        )
+        if 'image_file' in capture:
+            # Chunked transfers are already reassembled on disk
+            self.storage_writer.move(capture.pop('image_file'), image_path)
+        else:
+            self.storage_writer.write_bytes(image_path, capture['image'])
+        logger.info('Saving image to: {}'.format(image_path))
+        return image_path
+
+    def build_metadata_path(self, capture):
+        return os.path.join(
+            self.build_capture_dir(capture), '{}.json'.format(
+                self.build_capture_filename(capture)
+            )
+        )
 
     def save_captured_metadata(self, capture):
-        files.ensure_path(self.capture_dir)
         capture_filename = self.build_capture_filename(capture)
-        image_filename = '{}.{}'.format(capture_filename, capture['format'])
-        capture['image'] = image_filename
-        metadata_path = os.path.join(
-            self.capture_dir, '{}.json'.format(capture_filename)
-        )
-        files.json_dump(capture, metadata_path)
-        logger.info('Saved metadata to: {}'.format(metadata_path))
+        if 'duplicate_of' in capture['metadata']:
+            capture['image'] = None
+        else:
+            capture['image'] = '{}.{}'.format(
+                capture_filename, capture['format']
+            )
+        metadata_path = self.build_metadata_path(capture)
+        # Serialize now, since the capture may be changed after queueing
+        self.storage_writer.write_bytes(metadata_path, json.dumps(
+            capture, indent=self.metadata_indent
+        ).encode(message_string_encoding))
+        logger.info('Saving metadata to: {}'.format(metadata_path))
+        return metadata_path
 
     def request_image(
         self, target_name, format='jpeg',
         capture_format_params={'quality': 100},
         transport_format_params={'quality': 80},
+        crop=None, resize=None, pass_through=None, chunk_size=None,
+        source=None, ring_policy=None, capture_at=None, extra_metadata={}
+    ):
+        return self.request_acquisition(target_name, {
+            'action': 'acquire_image',
+            'format': format,
+            'capture_format_params': capture_format_params,
+            'transport_format_params': transport_format_params,
+            'crop': crop,
+            'resize': resize,
+            'pass_through': pass_through,
+            'chunk_size': chunk_size,
+            'source': source,
+            'ring_policy': ring_policy,
+            'capture_at': capture_at
+        }, extra_metadata=extra_metadata)
+
+    def request_burst(
+        self, target_name, count, interval=0, format='jpeg',
+        transport_format_params={'quality': 80}, use_video_port=None,
+        resize=None, chunk_size=None, source=None, capture_at=None,
         extra_metadata={}
     ):
+        """Request a sequence of images captured back-to-back.
+
+        The images are captured interval seconds apart (or as fast as the
+        camera can go, by default) and sent back in a single message; each
+        image is saved as a separate capture with its own capture time.
+        """
+        return self.request_acquisition(target_name, {
+            'action': 'acquire_burst',
+            'count': count,
+            'interval': interval,
+            'format': format,
+            'transport_format_params': transport_format_params,
+            'use_video_port': use_video_port,
+            'resize': resize,
+            'chunk_size': chunk_size,
+            'source': source,
+            'capture_at': capture_at
+        }, extra_metadata=extra_metadata)
+
+    def request_synchronized_images(
+        self, target_names=None, delay=None, **kwargs
+    ):
+        """Request images from several cameras, all captured at one time.
+
+        The capture time is scheduled far enough in the future for the
+        command to reach every camera, and is translated into each camera's
+        clock with the estimated clock offsets.
+        """
+        if target_names is None:
+            target_names = self.target_names
+        if delay is None:
+            round_trip_times = [
+                estimator.round_trip_time
+                for estimator in self.clock_offsets.values()
+                if estimator.has_estimate
+            ]
+            delay = 0.2 + 2 * max(round_trip_times, default=0)
+        capture_at = time.time() + delay
+        return [
+            self.request_image(target_name, capture_at=capture_at, **kwargs)
+            for target_name in target_names
+        ]
+
+    def request_acquisition(self, target_name, params, extra_metadata={}):
+        """Send an acquisition control command to a camera."""
         if target_name not in self.target_names:
             logger.error(
                 'Unknown camera client target: {}'.format(target_name)
             )
             return
 
+        if params.get('chunk_size') is None:
+            params['chunk_size'] = self.chunk_size
         acquisition_obj = {
-            'action': 'acquire_image',
-            'format': format,
-            'capture_format_params': capture_format_params,
-            'transport_format_params': transport_format_params,
-            'metadata': {
-                'client_name': target_name,
-                'image_id': self.image_ids[target_name],
-                'command_time': {
-                    'time': time.time(),
-                    'datetime': str(datetime.datetime.now())
-                },
-            }
+            key: value for (key, value) in params.items() if value is not None
+        }
+        acquisition_obj['image_encodings'] = self.image_encodings
+        acquisition_obj['metadata'] = {
+            'client_name': target_name,
+            'image_id': self.image_ids[target_name],
+            'command_time': {
+                'time': time.time(),
+                'datetime': str(datetime.datetime.now())
+            },
         }
+        if 'capture_at' in acquisition_obj:
+            acquisition_obj['metadata']['clock_sync'] = self.schedule_capture(
+                target_name, acquisition_obj
+            )
         for (key, value) in extra_metadata.items():
             acquisition_obj['metadata'][key] = value
         acquisition_message = json.dumps(acquisition_obj)
@@ -171,6 +985,50 @@ class Host(AsyncioClient):
             control_topic, acquisition_message, local_namespace=target_name
         )
 
+    def set_preview(
+        self, target_name, interval=None, width=None, height=None,
+        quality=None
+    ):
+        """Start, stop (with no interval), or reconfigure a camera's previews."""
+        preview_obj = {'action': 'set_preview'}
+        preview_params = {
+            'interval': interval, 'width': width, 'height': height,
+            'quality': quality
+        }
+        for (key, value) in preview_params.items():
+            if value is not None:
+                preview_obj[key] = value
+        logger.info('Setting {} preview to: {}'.format(
+            target_name, preview_obj
+        ))
+        return self.publish_message(
+            control_topic, json.dumps(preview_obj), local_namespace=target_name
+        )
+
+    def schedule_capture(self, target_name, acquisition_obj):
+        """Translate a scheduled capture time into the target's clock.
+
+        Returns a record of the clock sync used for the translation.
+        """
+        capture_at = acquisition_obj['capture_at']
+        estimator = self.get_clock_offset(target_name)
+        if estimator is None:
+            logger.warning(
+                'No clock offset estimate for {}, so its capture may not be '
+                'synchronized!'.format(target_name)
+            )
+            return {
+                'capture_at': capture_at,
+                'offset': None,
+                'round_trip_time': None
+            }
+        acquisition_obj['capture_at'] = estimator.to_remote_time(capture_at)
+        return {
+            'capture_at': capture_at,
+            'offset': estimator.offset,
+            'round_trip_time': estimator.round_trip_time
+        }
+
     def set_params(self, target_name, **params):
         update_obj = {'action': 'set_params'}
         for (key, value) in params.items():
@@ -184,6 +1042,19 @@ class Host(AsyncioClient):
             control_topic, update_message, local_namespace=target_name
         )
 
+    def request_camera_params(self, target_name, version=None):
+        """Ask a camera for its full params of a version, or its latest."""
+        request_obj = {'action': 'get_params'}
+        if version is not None:
+            request_obj['version'] = version
+        logger.info('Requesting {} camera params version {}'.format(
+            target_name, version
+        ))
+        return self.publish_message(
+            control_topic, json.dumps(request_obj),
+            local_namespace=target_name
+        )
+
     def set_params_from_stored(self, target_name):
         return self.set_params(target_name, **self.camera_params[target_name])
 
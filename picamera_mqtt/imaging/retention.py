@@ -0,0 +1,419 @@
+"""Bounding of the disk usage of saved captures."""
+import bisect
+import logging
+import math
+import os
+import shutil
+import threading
+import time
+
+from picamera_mqtt.util import files
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionManager(object):
+    """Evicts saved captures to enforce retention policies and disk quotas.
+
+    Each saved capture is registered with its files and their sizes, so disk
+    usage per camera is tracked incrementally instead of by rescanning the
+    capture directory; only captures saved before the manager started are
+    found by a one-time scan of their json metadata files. Eviction runs in a
+    background thread, periodically and whenever a quota is exceeded:
+
+    - Captures older than max_age seconds are deleted.
+    - Captures older than full_age seconds are thinned to the first capture
+      from each camera in each thin_interval seconds (e.g. keep the last 7
+      days in full, and one image per hour before that).
+    - While a camera uses more than max_camera_bytes, or all cameras use more
+      than max_bytes, or the disk has less than min_free_bytes free, the
+      oldest captures are deleted.
+
+    When a capture is deleted while deduplicated captures still refer to its
+    image, the image is kept and handed over to the newest of them, so that
+    it's only deleted along with the last capture which refers to it.
+    """
+
+    def __init__(
+        self, capture_dir, max_bytes=None, max_camera_bytes=None,
+        max_age=None, full_age=None, thin_interval=None,
+        min_free_bytes=None, emergency_bytes=64 * 1024 * 1024,
+        check_interval=60, scan_existing=True, evict_callback=None
+    ):
+        self.capture_dir = capture_dir
+        self.max_bytes = max_bytes
+        self.max_camera_bytes = max_camera_bytes
+        self.max_age = max_age
+        self.full_age = full_age
+        self.thin_interval = thin_interval
+        self.min_free_bytes = min_free_bytes
+        self.emergency_bytes = emergency_bytes
+        self.check_interval = check_interval
+        self.evict_callback = evict_callback
+
+        self.lock = threading.RLock()
+        self.cameras = {}
+        self.dependents = {}
+        self.unsized = []
+        self.total_bytes = 0
+        self.counters = {'evicted': 0, 'evicted_bytes': 0, 'emergencies': 0}
+
+        self.start_time = time.time()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(
+            target=self.run, args=(scan_existing,), name='retention',
+            daemon=True
+        )
+        self.thread.start()
+
+    # Tracking
+
+    def get_camera(self, client_name):
+        if client_name not in self.cameras:
+            self.cameras[client_name] = {
+                'times': [],
+                'captures': [],
+                'bytes': 0,
+                'thinned_until': -math.inf
+            }
+        return self.cameras[client_name]
+
+    def add(self, client_name, capture_time, file_sizes, reference=None):
+        """Register a saved capture.
+
+        file_sizes maps the path of each of the capture's files to its size
+        in bytes, or to None if the size should be looked up later (e.g.
+        because the file hasn't been written yet). reference is the path of
+        the image which a deduplicated capture refers to.
+        """
+        capture = {
+            'client_name': client_name,
+            'time': capture_time,
+            'files': {
+                os.path.normpath(path): size
+                for (path, size) in file_sizes.items()
+            },
+            'bytes': 0,
+            'counted': set(),
+            'reference': reference,
+            'evicted': False
+        }
+        with self.lock:
+            camera = self.get_camera(client_name)
+            position = bisect.bisect_right(camera['times'], capture_time)
+            camera['times'].insert(position, capture_time)
+            camera['captures'].insert(position, capture)
+            if capture_time < camera['thinned_until']:
+                # Thin again from the interval of a late capture
+                camera['thinned_until'] = (
+                    math.floor(capture_time / self.thin_interval)
+                    * self.thin_interval
+                )
+            if reference is not None:
+                reference = os.path.normpath(reference)
+                capture['reference'] = reference
+                self.dependents.setdefault(reference, []).append(capture)
+            self.add_sizes(capture)
+            over_quota = self.over_quota(camera)
+        if over_quota:
+            self.wakeup.set()
+
+    def add_sizes(self, capture):
+        """Account for the sizes of a capture's files which are known."""
+        unsized = False
+        for (path, size) in capture['files'].items():
+            if size is None:
+                unsized = True
+            elif path not in capture['counted']:
+                capture['counted'].add(path)
+                capture['bytes'] += size
+                self.total_bytes += size
+                self.cameras[capture['client_name']]['bytes'] += size
+        if unsized:
+            self.unsized.append(capture)
+
+    def resolve_sizes(self):
+        """Look up the sizes of files registered without sizes."""
+        with self.lock:
+            unsized = self.unsized
+            self.unsized = []
+            for capture in unsized:
+                if capture['evicted']:
+                    continue
+                for (path, size) in capture['files'].items():
+                    if size is not None:
+                        continue
+                    try:
+                        capture['files'][path] = os.path.getsize(path)
+                    except FileNotFoundError:
+                        pass
+                self.add_sizes(capture)
+
+    def over_quota(self, camera):
+        return (
+            (
+                self.max_camera_bytes is not None
+                and camera['bytes'] > self.max_camera_bytes
+            ) or (
+                self.max_bytes is not None
+                and self.total_bytes > self.max_bytes
+            )
+        )
+
+    def scan(self):
+        """Register the captures already saved in the capture directory."""
+        count = 0
+        for (dir_path, dir_names, filenames) in os.walk(self.capture_dir):
+            dir_names[:] = [name for name in dir_names if name != '.partial']
+            for filename in filenames:
+                if not filename.endswith('.json'):
+                    continue
+                metadata_path = os.path.join(dir_path, filename)
+                if os.path.getmtime(metadata_path) >= self.start_time:
+                    # Saved since the manager started, so already registered
+                    continue
+                try:
+                    capture = files.json_load(metadata_path)
+                    metadata = capture['metadata']
+                    capture_time = metadata['capture_time']['time']
+                    client_name = metadata['client_name']
+                except (ValueError, KeyError, TypeError):
+                    continue
+                file_sizes = {
+                    metadata_path: os.path.getsize(metadata_path)
+                }
+                reference = None
+                if capture.get('image') is not None:
+                    image_path = os.path.join(dir_path, capture['image'])
+                    if os.path.exists(image_path):
+                        file_sizes[image_path] = os.path.getsize(image_path)
+                if 'duplicate_of' in metadata:
+                    reference = os.path.join(
+                        self.capture_dir, metadata['duplicate_of']['path']
+                    )
+                self.add(
+                    client_name, capture_time, file_sizes, reference=reference
+                )
+                count += 1
+        self.adopt_references()
+        logger.info(
+            'Found {} saved captures using {} bytes in {}'
+            .format(count, self.total_bytes, self.capture_dir)
+        )
+
+    def adopt_references(self):
+        """Hand over referenced images without metadata to their dependents.
+
+        Images which were handed over before a restart have no metadata
+        file of their own, so they aren't found by the scan.
+        """
+        with self.lock:
+            owned = set(
+                path
+                for camera in self.cameras.values()
+                for capture in camera['captures']
+                for path in capture['files']
+            )
+            for (path, dependents) in self.dependents.items():
+                if path in owned or not dependents:
+                    continue
+                try:
+                    size = os.path.getsize(path)
+                except FileNotFoundError:
+                    continue
+                owner = max(dependents, key=lambda capture: capture['time'])
+                owner['files'][path] = size
+                self.add_sizes(owner)
+
+    # Eviction
+
+    def run(self, scan_existing):
+        if scan_existing:
+            self.scan()
+        while not self.stopping:
+            try:
+                self.enforce()
+            except Exception:
+                logger.exception('Failed to enforce capture retention')
+            self.wakeup.wait(self.check_interval)
+            self.wakeup.clear()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+
+    def enforce(self):
+        """Evict captures as needed by the retention policies and quotas."""
+        self.resolve_sizes()
+        now = time.time()
+        evicted = []
+        with self.lock:
+            for camera in self.cameras.values():
+                if self.max_age is not None:
+                    while (
+                        camera['captures']
+                        and camera['times'][0] < now - self.max_age
+                    ):
+                        evicted.extend(self.evict(camera['captures'][0]))
+                if self.full_age is not None and self.thin_interval:
+                    evicted.extend(self.thin(camera, now - self.full_age))
+                while (
+                    self.max_camera_bytes is not None
+                    and camera['bytes'] > self.max_camera_bytes
+                    and camera['captures']
+                ):
+                    evicted.extend(self.evict(camera['captures'][0]))
+            while (
+                self.max_bytes is not None
+                and self.total_bytes > self.max_bytes
+            ):
+                evicted.extend(self.evict_oldest())
+        if self.min_free_bytes is not None:
+            free_bytes = shutil.disk_usage(self.capture_dir).free
+            if free_bytes < self.min_free_bytes:
+                with self.lock:
+                    freed = 0
+                    while freed < self.min_free_bytes - free_bytes:
+                        captures = self.evict_oldest()
+                        if not captures:
+                            break
+                        freed += sum(capture['bytes'] for capture in captures)
+                        evicted.extend(captures)
+        self.delete(evicted)
+
+    def thin(self, camera, thin_until):
+        """Keep one capture per interval among newly-aged captures."""
+        limit = (
+            math.floor(thin_until / self.thin_interval) * self.thin_interval
+        )
+        start = bisect.bisect_left(camera['times'], camera['thinned_until'])
+        end = bisect.bisect_left(camera['times'], limit)
+        camera['thinned_until'] = max(camera['thinned_until'], limit)
+        buckets = {}
+        for capture in camera['captures'][start:end]:
+            bucket = math.floor(capture['time'] / self.thin_interval)
+            kept = buckets.get(bucket)
+            # Prefer keeping captures which have their own image
+            if kept is None or (
+                kept['reference'] is not None and capture['reference'] is None
+            ):
+                buckets[bucket] = capture
+        kept_captures = set(id(capture) for capture in buckets.values())
+        evicted = []
+        for capture in list(camera['captures'][start:end]):
+            if id(capture) not in kept_captures:
+                evicted.extend(self.evict(capture))
+        return evicted
+
+    def evict_oldest(self):
+        """Evict the oldest capture from any camera."""
+        cameras = [
+            camera for camera in self.cameras.values() if camera['captures']
+        ]
+        if not cameras:
+            return []
+        camera = min(cameras, key=lambda camera: camera['times'][0])
+        return self.evict(camera['captures'][0])
+
+    def evict(self, capture):
+        """Stop tracking a capture.
+
+        Any of its images which deduplicated captures still refer to are
+        handed over to the newest of them. Returns the evicted captures,
+        whose remaining files should then be deleted.
+        """
+        if capture['evicted']:
+            return []
+        capture['evicted'] = True
+        camera = self.cameras[capture['client_name']]
+        position = bisect.bisect_left(camera['times'], capture['time'])
+        while camera['captures'][position] is not capture:
+            position += 1
+        del camera['times'][position]
+        del camera['captures'][position]
+        if capture['reference'] is not None:
+            siblings = self.dependents.get(capture['reference'], [])
+            if capture in siblings:
+                siblings.remove(capture)
+        for path in list(capture['files']):
+            dependents = self.dependents.get(path)
+            if dependents:
+                self.hand_over(capture, path, max(
+                    dependents, key=lambda dependent: dependent['time']
+                ))
+            else:
+                self.dependents.pop(path, None)
+        camera['bytes'] -= capture['bytes']
+        self.total_bytes -= capture['bytes']
+        return [capture]
+
+    def hand_over(self, capture, path, owner):
+        """Make another capture responsible for deleting one of its files."""
+        size = capture['files'].pop(path)
+        owner['files'][path] = size
+        if path in capture['counted']:
+            capture['counted'].remove(path)
+            capture['bytes'] -= size
+            self.cameras[capture['client_name']]['bytes'] -= size
+            owner['counted'].add(path)
+            owner['bytes'] += size
+            self.cameras[owner['client_name']]['bytes'] += size
+        elif size is None:
+            self.unsized.append(owner)
+
+    def delete(self, captures):
+        """Delete the files of evicted captures."""
+        if not captures:
+            return
+        paths = []
+        for capture in captures:
+            for path in capture['files']:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                paths.append(path)
+            self.counters['evicted'] += 1
+            self.counters['evicted_bytes'] += capture['bytes']
+        logger.info('Evicted {} captures ({} bytes)'.format(
+            len(captures), sum(capture['bytes'] for capture in captures)
+        ))
+        if self.evict_callback is not None:
+            self.evict_callback(paths)
+
+    def make_space(self):
+        """Immediately evict the oldest captures to recover from a full disk.
+
+        Returns the number of bytes freed.
+        """
+        self.counters['emergencies'] += 1
+        self.resolve_sizes()
+        evicted = []
+        freed = 0
+        with self.lock:
+            while freed < self.emergency_bytes:
+                captures = self.evict_oldest()
+                if not captures:
+                    break
+                freed += sum(capture['bytes'] for capture in captures)
+                evicted.extend(captures)
+        logger.warning('Disk is full, evicting {} bytes of captures'.format(
+            freed
+        ))
+        self.delete(evicted)
+        return freed
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['bytes'] = self.total_bytes
+            stats['camera_bytes'] = {
+                client_name: camera['bytes']
+                for (client_name, camera) in self.cameras.items()
+            }
+            stats['captures'] = sum(
+                len(camera['captures']) for camera in self.cameras.values()
+            )
+        return stats
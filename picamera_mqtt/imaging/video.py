@@ -0,0 +1,408 @@
+"""Streaming export of saved captures as MJPEG AVI videos.
+
+JPEG images are copied into the video without being decoded or re-encoded,
+and only one frame at a time is held in memory.
+"""
+import logging
+import os
+import shutil
+import struct
+import tempfile
+from io import BytesIO
+
+from PIL import Image
+
+from picamera_mqtt.imaging import archive
+from picamera_mqtt.imaging.capture_index import CaptureIndex
+from picamera_mqtt.imaging.dataset import max_time_zone_offset
+from picamera_mqtt.util import files
+
+logger = logging.getLogger(__name__)
+
+jpeg_start = b'\xff\xd8'
+jpeg_extensions = ['jpeg', 'jpg']
+
+# AVI 1.0 file structure
+chunk_header = struct.Struct('<4sI')
+list_header = struct.Struct('<4sI4s')
+main_header = struct.Struct('<14I')
+stream_header = struct.Struct('<4s4sIHHIIIIIIiIhhhh')
+stream_format = struct.Struct('<IiiHH4sIiiII')
+index_entry = struct.Struct('<4sIII')
+stream_list_size = (
+    4 + chunk_header.size + stream_header.size
+    + chunk_header.size + stream_format.size
+)
+header_list_size = (
+    4 + chunk_header.size + main_header.size
+    + chunk_header.size + stream_list_size
+)
+header_size = (
+    list_header.size + chunk_header.size + header_list_size
+    + list_header.size
+)
+frame_chunk_id = b'00dc'
+avi_has_index = 0x10
+index_keyframe = 0x10
+max_avi_size = 2 ** 31 - 2 ** 24
+
+
+# AVI files
+
+class MjpegAviWriter(object):
+    """Writes JPEG images as the frames of an MJPEG AVI file.
+
+    Frames are appended as they're added; the index is spooled to a
+    temporary file and the headers are filled in when the file is closed.
+    The frame size is read from the first frame unless it's given.
+    """
+
+    def __init__(self, path, fps=30, width=None, height=None):
+        self.path = path
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.frames = 0
+        self.movi_size = 4
+        self.max_frame_size = 0
+        self.file = open(path, 'wb')
+        self.file.write(bytes(header_size))
+        self.index = tempfile.TemporaryFile()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def size(self):
+        """The size of the file if it were closed now."""
+        return (
+            header_size - 4 + self.movi_size
+            + chunk_header.size + index_entry.size * self.frames
+        )
+
+    def add_frame(self, frame):
+        """Append a JPEG image, given as bytes or as the path of a file."""
+        if isinstance(frame, str):
+            with open(frame, 'rb') as f:
+                self.check_frame(f)
+                frame_size = os.fstat(f.fileno()).st_size
+                self.write_chunk_header(frame_size)
+                shutil.copyfileobj(f, self.file)
+        else:
+            with BytesIO(frame) as f:
+                self.check_frame(f)
+            frame_size = len(frame)
+            self.write_chunk_header(frame_size)
+            self.file.write(frame)
+        if frame_size % 2:
+            self.file.write(b'\0')
+        self.movi_size += chunk_header.size + frame_size + frame_size % 2
+        self.max_frame_size = max(self.max_frame_size, frame_size)
+        self.frames += 1
+
+    def check_frame(self, f):
+        """Check that a frame is a JPEG image, and find the frame size."""
+        if f.read(len(jpeg_start)) != jpeg_start:
+            raise ValueError('Frame is not a JPEG image')
+        f.seek(0)
+        if self.width is None or self.height is None:
+            with Image.open(f) as image:
+                (self.width, self.height) = image.size
+            f.seek(0)
+
+    def write_chunk_header(self, frame_size):
+        self.index.write(index_entry.pack(
+            frame_chunk_id, index_keyframe, self.movi_size, frame_size
+        ))
+        self.file.write(chunk_header.pack(frame_chunk_id, frame_size))
+
+    def build_header(self):
+        width = self.width or 0
+        height = self.height or 0
+        rate = int(round(self.fps * 1000))
+        return b''.join([
+            list_header.pack(b'RIFF', self.size - 8, b'AVI '),
+            list_header.pack(b'LIST', header_list_size, b'hdrl'),
+            chunk_header.pack(b'avih', main_header.size),
+            main_header.pack(
+                int(round(1000000 / self.fps)),
+                int(self.max_frame_size * self.fps), 0, avi_has_index,
+                self.frames, 0, 1, self.max_frame_size, width, height,
+                0, 0, 0, 0
+            ),
+            list_header.pack(b'LIST', stream_list_size, b'strl'),
+            chunk_header.pack(b'strh', stream_header.size),
+            stream_header.pack(
+                b'vids', b'MJPG', 0, 0, 0, 0, 1000, rate, 0, self.frames,
+                self.max_frame_size, -1, 0, 0, 0, width, height
+            ),
+            chunk_header.pack(b'strf', stream_format.size),
+            stream_format.pack(
+                stream_format.size, width, height, 1, 24, b'MJPG',
+                width * height * 3, 0, 0, 0, 0
+            ),
+            list_header.pack(b'LIST', self.movi_size, b'movi')
+        ])
+
+    def close(self):
+        """Write the index and headers, and close the file."""
+        if self.file.closed:
+            return
+        self.file.write(chunk_header.pack(
+            b'idx1', index_entry.size * self.frames
+        ))
+        self.index.seek(0)
+        shutil.copyfileobj(self.index, self.file)
+        self.index.close()
+        self.file.seek(0)
+        self.file.write(self.build_header())
+        self.file.close()
+
+
+# Frame sources
+
+def in_time_range(capture_time, start_time, end_time, slack=0):
+    """Check whether a time is in a range widened by slack on both ends."""
+    return (
+        (start_time is None or capture_time >= start_time - slack)
+        and (end_time is None or capture_time <= end_time + slack)
+    )
+
+
+def list_file_frames(capture_dir, client_name, start_time=None, end_time=None):
+    """List the JPEG captures of a camera saved as files.
+
+    Captures are found and ordered by their filenames, so only the metadata
+    files of deduplicated captures, and of captures near the ends of the
+    time range, need to be read. Filename datetimes are in the camera's
+    local time zone, so they're only used to filter captures which are
+    clearly in or out of the range. Returns a list of (capture time, image
+    path) tuples, with capture times from the filenames.
+    """
+    frames = []
+    for (dir_path, dir_names, filenames) in os.walk(capture_dir):
+        dir_names[:] = [name for name in dir_names if name != '.partial']
+        filename_set = set(filenames)
+        for filename in filenames:
+            (name, extension) = os.path.splitext(filename)
+            if extension != '.json' or name.endswith('.analysis'):
+                continue
+            parsed = archive.parse_capture_filename(name)
+            if parsed is None or parsed[0] != client_name:
+                continue
+            capture_time = archive.parse_datetime(parsed[2])
+            if capture_time is None or not in_time_range(
+                capture_time, start_time, end_time, slack=max_time_zone_offset
+            ):
+                continue
+            capture = None
+            if not in_time_range(
+                capture_time, start_time, end_time,
+                slack=-max_time_zone_offset
+            ):
+                # Check captures near the ends of the range by their metadata
+                try:
+                    capture = files.json_load(
+                        os.path.join(dir_path, filename)
+                    )
+                    if not in_time_range(
+                        capture['metadata']['capture_time']['time'],
+                        start_time, end_time
+                    ):
+                        continue
+                except (ValueError, KeyError, TypeError):
+                    continue
+            image_path = None
+            for image_extension in jpeg_extensions:
+                image_filename = '{}.{}'.format(name, image_extension)
+                if image_filename in filename_set:
+                    image_path = os.path.join(dir_path, image_filename)
+                    break
+            if image_path is None:
+                # Deduplicated captures refer to another capture's image
+                try:
+                    if capture is None:
+                        capture = files.json_load(
+                            os.path.join(dir_path, filename)
+                        )
+                    duplicate_of = capture['metadata']['duplicate_of']
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if capture.get('format') not in jpeg_extensions:
+                    continue
+                image_path = os.path.join(capture_dir, duplicate_of['path'])
+            frames.append(((parsed[2], parsed[1]), capture_time, image_path))
+    frames.sort(key=lambda frame: frame[0])
+    return [(capture_time, path) for (key, capture_time, path) in frames]
+
+
+def iter_archive_frames(
+    archive_path, client_name, start_time=None, end_time=None
+):
+    """Read the JPEG captures of a camera from an archive.
+
+    Yields (capture time, image bytes) tuples in order of capture time.
+    """
+    capture_archive = archive.CaptureArchive(archive_path, read_only=True)
+    try:
+        for entry in capture_archive.query(client_name, start_time, end_time):
+            image_entry = entry
+            if entry['image_size'] == 0:
+                capture = capture_archive.read_metadata(entry)
+                duplicate_of = capture['metadata'].get('duplicate_of')
+                if duplicate_of is None:
+                    continue
+                image_entry = capture_archive.find_entry(
+                    duplicate_of['client_name'], duplicate_of['capture_time']
+                )
+                if image_entry is None:
+                    logger.warning(
+                        'Skipping duplicate of missing capture: {}'
+                        .format(duplicate_of)
+                    )
+                    continue
+            yield (entry['time'], capture_archive.read_image(image_entry))
+    finally:
+        capture_archive.close()
+
+
+def iter_index_frames(
+    index_path, client_name, start_time=None, end_time=None
+):
+    """Read the JPEG captures of a camera found with a capture index.
+
+    Yields (capture time, image path or bytes) tuples in order of capture
+    time.
+    """
+    capture_index = CaptureIndex(index_path)
+    rows = capture_index.query(
+        client_names=[client_name], start_time=start_time, end_time=end_time,
+        where='format IN ({})'.format(
+            ', '.join('?' for extension in jpeg_extensions)
+        ),
+        parameters=jpeg_extensions
+    )
+    capture_index.close()
+    archives = {}
+    try:
+        for row in rows:
+            if row['archive_segment'] is None:
+                yield (row['capture_time'], row['path'])
+                continue
+            if row['path'] not in archives:
+                archives[row['path']] = archive.CaptureArchive(
+                    row['path'], read_only=True
+                )
+            capture_archive = archives[row['path']]
+            try:
+                (entry, capture) = capture_archive.read_entry(
+                    row['archive_segment'], row['archive_offset']
+                )
+            except (archive.ArchiveError, OSError) as e:
+                logger.warning('Skipping unreadable capture of {}: {}'.format(
+                    client_name, e
+                ))
+                continue
+            if entry['image_size'] == 0:
+                duplicate_of = capture['metadata'].get('duplicate_of')
+                entry = None
+                if duplicate_of is not None:
+                    entry = capture_archive.find_entry(
+                        duplicate_of['client_name'],
+                        duplicate_of['capture_time']
+                    )
+                if entry is None:
+                    logger.warning(
+                        'Skipping duplicate of missing capture: {}'
+                        .format(duplicate_of)
+                    )
+                    continue
+            yield (row['capture_time'], capture_archive.read_image(entry))
+    finally:
+        for capture_archive in archives.values():
+            capture_archive.close()
+
+
+def iter_frames(
+    capture_dir, client_name, start_time=None, end_time=None,
+    index_path=None
+):
+    """Find the JPEG captures of a camera, from an index if given."""
+    if index_path is not None:
+        return iter_index_frames(index_path, client_name, start_time, end_time)
+    if os.path.exists(os.path.join(capture_dir, archive.index_name)):
+        return iter_archive_frames(
+            capture_dir, client_name, start_time, end_time
+        )
+    return iter(
+        list_file_frames(capture_dir, client_name, start_time, end_time)
+    )
+
+
+def decimate(frames, step=1, min_interval=None):
+    """Keep every step-th frame, at least min_interval seconds apart."""
+    last_time = None
+    for (i, (capture_time, frame)) in enumerate(frames):
+        if i % step:
+            continue
+        if (
+            min_interval is not None and last_time is not None
+            and capture_time - last_time < min_interval
+        ):
+            continue
+        last_time = capture_time
+        yield (capture_time, frame)
+
+
+# Export
+
+def build_video_path(output_path, part):
+    if part == 0:
+        return output_path
+    (name, extension) = os.path.splitext(output_path)
+    return '{}-{:03d}{}'.format(name, part, extension)
+
+
+def export_video(
+    output_path, frames, fps=30, max_file_size=max_avi_size
+):
+    """Write frames to MJPEG AVI files.
+
+    Frames are (capture time, image path or bytes) tuples. Since AVI 1.0
+    files are limited to 2 GiB, the video is split into numbered parts
+    which are each at most max_file_size bytes. Frames which aren't JPEG
+    images are skipped. Returns the number of frames written.
+    """
+    part = 0
+    count = 0
+    writer = MjpegAviWriter(build_video_path(output_path, part), fps=fps)
+    try:
+        for (capture_time, frame) in frames:
+            if isinstance(frame, str):
+                frame_size = os.path.getsize(frame)
+            else:
+                frame_size = len(frame)
+            if writer.frames and (
+                writer.size + frame_size + chunk_header.size + 1
+                + index_entry.size > max_file_size
+            ):
+                writer.close()
+                part += 1
+                writer = MjpegAviWriter(
+                    build_video_path(output_path, part), fps=fps,
+                    width=writer.width, height=writer.height
+                )
+            try:
+                writer.add_frame(frame)
+            except (OSError, ValueError) as e:
+                logger.warning('Skipping frame at {}: {}'.format(
+                    capture_time, e
+                ))
+                continue
+            count += 1
+    finally:
+        writer.close()
+    return count
@@ -0,0 +1,211 @@
+"""Detection of dead broker connections from measured round-trip times."""
+import bisect
+import collections
+import math
+import threading
+import time
+
+
+class RttHistogram(object):
+    """A histogram of round-trip times with logarithmically-spaced buckets."""
+
+    def __init__(self, min_rtt=0.001, max_rtt=100, buckets_per_decade=10):
+        decades = math.log10(max_rtt / min_rtt)
+        self.bounds = [
+            min_rtt * 10 ** (i / buckets_per_decade)
+            for i in range(int(math.ceil(decades * buckets_per_decade)) + 1)
+        ]
+        self.counts = [0 for i in range(len(self.bounds) + 1)]
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, rtt):
+        self.counts[bisect.bisect_left(self.bounds, rtt)] += 1
+        self.count += 1
+        self.total += rtt
+        self.min = rtt if self.min is None else min(self.min, rtt)
+        self.max = rtt if self.max is None else max(self.max, rtt)
+
+    def percentile(self, percentile):
+        """Estimate a percentile, as the upper bound of its bucket."""
+        if not self.count:
+            return None
+        rank = percentile / 100 * self.count
+        cumulative = 0
+        for (index, count) in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                if index == len(self.bounds):
+                    return self.max
+                return min(self.bounds[index], self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max
+        }
+
+
+class LivenessMonitor(object):
+    """Decides whether a broker connection is alive.
+
+    Round-trip times are measured from existing traffic, as the delays
+    between publishing messages with QoS 1 or 2 and their acknowledgements,
+    and kept in a histogram for each connection. The connection is dead if
+    the oldest unacknowledged message is older than an adaptive timeout
+    (from a smoothed RTT and its variation, as for TCP retransmissions)
+    without any progress: progress is any data read from or written to the
+    socket. Only when there's no traffic for probe_interval seconds should
+    a probe message be published to measure the RTT.
+
+    Time spent with reading paused or with the event loop stalled doesn't
+    count towards the timeout, since acknowledgements can't be read then.
+    """
+
+    def __init__(
+        self, min_timeout=1, max_timeout=10, probe_interval=2,
+        check_interval=0.25, stall_tolerance=0.5, clock=time.monotonic
+    ):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.probe_interval = probe_interval
+        self.check_interval = check_interval
+        self.stall_tolerance = stall_tolerance
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.smoothed_rtt = None
+        self.rtt_variation = None
+        self.outstanding = collections.OrderedDict()
+        self.early_acks = collections.deque(maxlen=64)
+        self.histogram = RttHistogram()
+        self.connections = 0
+        self.last_progress = self.clock()
+        self.last_traffic = self.last_progress
+        self.last_check = None
+        self.counters = {'probes': 0, 'timeouts': 0, 'stalls': 0}
+
+    @property
+    def timeout(self):
+        if self.smoothed_rtt is None:
+            return self.max_timeout
+        return max(self.min_timeout, min(
+            self.max_timeout, self.smoothed_rtt + 4 * self.rtt_variation
+        ))
+
+    def reset(self):
+        """Start tracking a new connection.
+
+        Returns the RTT summary of the previous connection.
+        """
+        with self.lock:
+            summary = self.histogram.summary()
+            self.outstanding.clear()
+            self.early_acks.clear()
+            self.histogram = RttHistogram()
+            self.connections += 1
+            self.last_progress = self.clock()
+            self.last_traffic = self.last_progress
+            self.last_check = None
+        return summary
+
+    # Traffic
+
+    def sent(self, mid, qos):
+        """Record the publishing of a message which will be acknowledged."""
+        now = self.clock()
+        with self.lock:
+            self.last_traffic = now
+            if mid in self.early_acks:
+                # Acknowledged before it was recorded, by another thread
+                self.early_acks.remove(mid)
+                return
+            self.outstanding[mid] = (now, qos)
+
+    def acknowledged(self, mid):
+        """Record the acknowledgement of a message, as an RTT sample."""
+        now = self.clock()
+        with self.lock:
+            self.last_progress = now
+            self.last_traffic = now
+            sent = self.outstanding.pop(mid, None)
+            if sent is None:
+                self.early_acks.append(mid)
+                return
+            (send_time, qos) = sent
+            # QoS 2 needs two round trips for PUBREC and PUBCOMP
+            self.add_sample((now - send_time) / qos)
+
+    def add_sample(self, rtt):
+        self.histogram.add(rtt)
+        if self.smoothed_rtt is None:
+            self.smoothed_rtt = rtt
+            self.rtt_variation = rtt / 2
+        else:
+            self.rtt_variation = (
+                0.75 * self.rtt_variation
+                + 0.25 * abs(self.smoothed_rtt - rtt)
+            )
+            self.smoothed_rtt = 0.875 * self.smoothed_rtt + 0.125 * rtt
+
+    def progressed(self):
+        """Record that data was read from or written to the socket."""
+        now = self.clock()
+        with self.lock:
+            self.last_progress = now
+            self.last_traffic = now
+
+    def hold(self):
+        """Don't count the time until now towards the timeout."""
+        with self.lock:
+            self.last_progress = self.clock()
+
+    # Checks
+
+    def check(self):
+        """Check the connection, which should be done every check_interval.
+
+        Returns 'dead' if the connection timed out, 'probe' if a probe
+        should be published, or 'alive' otherwise.
+        """
+        now = self.clock()
+        with self.lock:
+            if (
+                self.last_check is not None
+                and now - self.last_check
+                > self.check_interval + self.stall_tolerance
+            ):
+                # Acknowledgements may be waiting to be read after a stall
+                self.counters['stalls'] += 1
+                self.last_progress = now
+            self.last_check = now
+            if self.outstanding:
+                (send_time, qos) = next(iter(self.outstanding.values()))
+                if now - max(send_time, self.last_progress) > self.timeout:
+                    self.counters['timeouts'] += 1
+                    return 'dead'
+                return 'alive'
+            if now - self.last_traffic >= self.probe_interval:
+                self.counters['probes'] += 1
+                # Don't probe again until the probe is recorded as sent
+                self.last_traffic = now
+                return 'probe'
+            return 'alive'
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['connections'] = self.connections
+            stats['outstanding'] = len(self.outstanding)
+            stats['smoothed_rtt'] = self.smoothed_rtt
+            stats['timeout'] = self.timeout
+            stats['rtt'] = self.histogram.summary()
+        return stats
@@ -1,12 +1,21 @@
 """MQTT client support for remote control."""
 import asyncio
+import collections
+import json
 import logging
 import socket
 import ssl
+import time
 
 import paho.mqtt.client as mqtt
 
+from picamera_mqtt.clock_sync import ClockOffsetEstimator
+from picamera_mqtt.liveness import LivenessMonitor
 from picamera_mqtt.protocol import connect_topic, ping_topic
+from picamera_mqtt.reconnect import (
+    ReconnectionTracker, dns_failure, network_failure, refused_failure
+)
+from picamera_mqtt.topic_router import TopicRouter, get_namespace
 
 logger = logging.getLogger(__name__)
 
@@ -20,10 +29,13 @@ def build_topic_paths(namespaces, topic):
 class AsyncioHelper(object):
     """A helper to adapt the MQTT client to asyncio event loop."""
 
-    def __init__(self, loop, client):
+    def __init__(self, loop, client, activity_callback=None):
         """Add socket callbacks to the client."""
         self.loop = loop
         self.client = client
+        self.activity_callback = activity_callback
+        self.sock = None
+        self.reading_paused = False
         self.client.on_socket_open = self.on_socket_open
         self.client.on_socket_close = self.on_socket_close
         self.client.on_socket_register_write = self.on_socket_register_write
@@ -33,18 +45,43 @@ class AsyncioHelper(object):
         """When the socket opens, add a reader callback to the loop."""
         logger.debug('Socket opened!')
 
-        self.loop.add_reader(sock, client.loop_read)
+        self.sock = sock
+        if not self.reading_paused:
+            self.loop.add_reader(sock, self.on_readable)
 
     def on_socket_close(self, client, userdata, sock):
         """When the socket closes, remove the reader callback from the loop."""
         logger.debug('Socket closed!')
         self.loop.remove_reader(sock)
+        self.sock = None
+
+    def pause_reading(self):
+        """Stop reading from the socket, so that TCP backpressure builds."""
+        self.reading_paused = True
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock)
+
+    def resume_reading(self):
+        """Resume reading from the socket."""
+        self.reading_paused = False
+        if self.sock is not None:
+            self.loop.add_reader(self.sock, self.on_readable)
+
+    def on_readable(self):
+        self.client.loop_read()
+        if self.activity_callback is not None:
+            self.activity_callback()
+
+    def on_writable(self):
+        self.client.loop_write()
+        if self.activity_callback is not None:
+            self.activity_callback()
 
     def on_socket_register_write(self, client, userdata, sock):
         """When the writer is registered, add it to the loop."""
         logger.debug('Watching socket for writability...')
 
-        self.loop.add_writer(sock, client.loop_write)
+        self.loop.add_writer(sock, self.on_writable)
 
     def on_socket_unregister_write(self, client, userdata, sock):
         """When the writer is unregistered, remove it from the loop."""
@@ -62,7 +99,10 @@ class AsyncioClient(object):
         use_tls=False, ca_certs=None, tls_version=ssl.PROTOCOL_TLSv1_2,
         topics={},
         client_name='asyncio client', target_names=['asyncio client'],
-        clean_session=True, ping_interval=2, ping_timeout=1
+        clean_session=True, ping_interval=2, ping_timeout=1, liveness=None,
+        clock_sync_interval=None, clock_sync_samples=4,
+        publish_window=16, publish_window_bytes=None, socket_send_buffer=2048,
+        reconnection=None, wildcard_subscriptions=False
     ):
         """Initialize client state."""
         self.loop = loop
@@ -78,7 +118,9 @@ class AsyncioClient(object):
         self.client.on_disconnect = self.on_disconnect
         self.client.on_publish = self.on_publish
         self.client.enable_logger(logger=logger)
-        self.helper = AsyncioHelper(self.loop, self.client)
+        self.helper = AsyncioHelper(
+            self.loop, self.client, activity_callback=self.on_socket_activity
+        )
 
         self.username = username
         self.password = password
@@ -98,32 +140,90 @@ class AsyncioClient(object):
             }
         else:
             self.topics = {}
+        # Locally-namespaced topics can be subscribed to as '+/topic' rather
+        # than once per target; messages from other namespaces are ignored
+        self.wildcard_subscriptions = wildcard_subscriptions
+        self.router = TopicRouter()
+        # Target names are fixed, so topic paths are only built once
+        self.topic_paths = {}
 
         self.ping_interval = ping_interval
         self.ping_timeout = ping_timeout
-        self.ping_mid = None
         self.disconnected = self.loop.create_future()
+        # Pings are only sent when there's no other traffic to time
+        liveness_params = {
+            'probe_interval': ping_interval, 'min_timeout': ping_timeout
+        }
+        liveness_params.update(liveness or {})
+        self.liveness = LivenessMonitor(**liveness_params)
+        self.liveness_handle = None
+        self.reconnection = ReconnectionTracker(**(reconnection or {}))
+
+        self.clock_sync_interval = clock_sync_interval
+        self.clock_sync_samples = clock_sync_samples
+        self.clock_sync_handle = None
+        self.clock_offsets = {}
+
+        self.socket_send_buffer = socket_send_buffer
+        # Messages from publish which await acknowledgement, by mid
+        self.publish_window = publish_window
+        self.publish_window_bytes = publish_window_bytes
+        self.inflight = {}
+        self.inflight_bytes = 0
+        self.window_waiters = collections.deque()
+
+    @property
+    def connected(self):
+        return self.reconnection.state == 'connected'
 
     def on_connect(self, client, userdata, flags, rc):
         """When the client connects, subscribe to the topic."""
         if rc != 0:
             logger.error('Bad connection, returned code: {}'.format(rc))
             return
+        outage = self.reconnection.on_connected()
+        logger.info('Connected after {:.1f} sec disconnected: {}'.format(
+            outage, self.reconnection.stats()
+        ))
+        subscriptions = []
         for (topic, params) in self.topics.items():
-            if params['subscribe']:
-                for topic_path in self.get_topic_paths(topic):
-                    logger.info(
-                        'Subscribing to {} topic...'.format(topic_path)
-                    )
-                    client.subscribe(topic_path, qos=params['qos'])
+            if not params['subscribe']:
+                continue
+            if self.wildcard_subscriptions and params['local_namespace']:
+                topic_paths = ['+/{}'.format(topic)]
+            else:
+                topic_paths = self.get_topic_paths(topic)
+            for topic_path in topic_paths:
+                logger.info('Subscribing to {} topic...'.format(topic_path))
+                subscriptions.append((topic_path, params['qos']))
+        # Clock sync messages for this client arrive on its own ping topic
+        own_ping_path = self.get_topic_paths(
+            ping_topic, local_namespace=self.client_name
+        )[0]
+        subscriptions.append((own_ping_path, 0))
+        client.subscribe(subscriptions)
+        self.add_topic_handler(
+            ping_topic, self.on_ping_topic, local_namespace=self.client_name
+        )
         self.add_topic_handlers()
         logger.info('Finished subscribing to topics!')
+        previous_rtt = self.liveness.reset()
+        if previous_rtt['count']:
+            logger.info('Round-trip times of previous connection: {}'.format(
+                previous_rtt
+            ))
+        if self.liveness_handle is None:
+            self.check_liveness()
         self.publish_message(
             connect_topic, self.client_name, local_namespace=False
         )
+        if self.clock_sync_interval is not None:
+            self.sync_clocks()
 
     def on_message(self, client, userdata, msg):
         """When the client receives a message, handle it."""
+        if self.router.dispatch(client, userdata, msg):
+            return
         if (
             msg.topic in self.topics
             and self.topics[msg.topic].get('log', False)
@@ -136,64 +236,190 @@ class AsyncioClient(object):
         """When the client disconnects, handle it."""
         if rc != 0:
             logger.error('Disconnected, returned code: {}'.format(rc))
-        self.disconnected.set_result(rc)
+            self.reconnection.on_disconnected(
+                'disconnected with code {}'.format(rc)
+            )
+        if not self.disconnected.done():
+            self.disconnected.set_result(rc)
+        self.loop.call_soon_threadsafe(self.fail_publishes)
 
     def on_publish(self, client, userdata, mid):
         """When the client publishes a message, handle it."""
-        if mid == self.ping_mid:
-            logger.debug('Ping {} published to broker'.format(mid))
-            self.ping_mid = None
+        self.liveness.acknowledged(mid)
+        # Deferred, since paho may call this before publish returns the mid
+        self.loop.call_soon_threadsafe(self.resolve_publish, mid)
+
+    def on_socket_activity(self):
+        """When data is read from or written to the socket, handle it."""
+        self.liveness.progressed()
+
+    def check_liveness(self):
+        """Check the connection periodically, and ping it when idle."""
+        self.liveness_handle = self.loop.call_later(
+            self.liveness.check_interval, self.check_liveness
+        )
+        if self.disconnected.done():
+            return
+        if self.helper.reading_paused:
+            self.liveness.hold()
+        status = self.liveness.check()
+        if status == 'probe':
+            self.publish_message(
+                ping_topic, self.client_name, qos=1,
+                local_namespace=self.client_name
+            )
+        elif status == 'dead':
+            logger.error(
+                'No response from broker within {:.3f} sec: {}'.format(
+                    self.liveness.timeout, self.liveness.stats()
+                )
+            )
+            self.on_disconnect(self.client, None, 1)
 
     def add_topic_handlers(self):
         """Add any topic handler message callbacks as needed."""
         pass
 
+    def add_topic_handler(self, topic, handler, local_namespace=None):
+        """Handle messages on a topic's paths with a message callback."""
+        self.router.add(topic, handler, [
+            get_namespace(topic_path, topic)
+            for topic_path in self.get_topic_paths(
+                topic, local_namespace=local_namespace
+            )
+        ])
+
+    def on_ping_topic(self, client, userdata, msg):
+        """Answer clock sync requests and record clock sync responses.
+
+        Plain pings are also published on this topic, and are ignored.
+        """
+        receive_time = time.time()
+        try:
+            message = json.loads(msg.payload.decode(message_string_encoding))
+            message_type = message['type']
+            sender = message['sender']
+        except (UnicodeDecodeError, ValueError, KeyError, TypeError):
+            return
+        if message_type == 'clock_request':
+            response = {
+                'type': 'clock_response',
+                'sender': self.client_name,
+                't0': message['t0'],
+                't1': receive_time,
+                't2': time.time()
+            }
+            self.publish_message(
+                ping_topic, json.dumps(response), qos=0,
+                local_namespace=sender
+            )
+        elif message_type == 'clock_response':
+            estimator = self.clock_offsets.setdefault(
+                sender, ClockOffsetEstimator()
+            )
+            estimator.add_sample(
+                message['t0'], message['t1'], message['t2'], receive_time
+            )
+            logger.debug('Clock offset of {}: {}'.format(
+                sender, estimator.summary()
+            ))
+
+    def request_clock_sync(self, target_name):
+        """Send a clock sync request to a target."""
+        request = {
+            'type': 'clock_request',
+            'sender': self.client_name,
+            't0': time.time()
+        }
+        self.publish_message(
+            ping_topic, json.dumps(request), qos=0,
+            local_namespace=target_name
+        )
+
+    def sync_clocks(self):
+        """Take a few clock sync samples from every target, periodically."""
+        if self.clock_sync_handle is not None:
+            self.clock_sync_handle.cancel()
+        for target_name in self.get_target_names(ping_topic):
+            if target_name == self.client_name:
+                continue
+            for i in range(self.clock_sync_samples):
+                # Spread out the samples so they don't queue behind each other
+                self.loop.call_later(
+                    0.05 * i, self.request_clock_sync, target_name
+                )
+        self.clock_sync_handle = self.loop.call_later(
+            self.clock_sync_interval, self.sync_clocks
+        )
+
+    def get_clock_offset(self, target_name):
+        """Get the clock offset estimator of a target, if there is one."""
+        estimator = self.clock_offsets.get(target_name)
+        if estimator is None or not estimator.has_estimate:
+            return None
+        return estimator
+
     def connect(self, reconnect=False):
         """Start the client connection."""
         if reconnect:
             self.client.reconnect()
         else:
             self.client.connect(self.hostname, self.port)
-        self.client.socket().setsockopt(
-            socket.SOL_SOCKET, socket.SO_SNDBUF, 2048
-        )
+        if self.socket_send_buffer is not None:
+            # A small send buffer makes publishers feel backpressure sooner
+            self.client.socket().setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_send_buffer
+            )
 
     def on_run(self):
         """When the client starts the run loop, handle it."""
         pass
 
+    async def finish_processing(self):
+        """Finish handling received messages before the client quits."""
+        pass
+
     def on_quit(self):
         """When the client quits the run loop, handle it."""
         pass
 
     async def attempt_reconnect(self):
-        """Prepare the system for a reconnection attempt."""
+        """Try to recover the network after repeated connection failures."""
         pass
 
     async def loop_until_connect(self, reconnect=False):
-        """Repeatedly attempt to connect until successful."""
+        """Repeatedly attempt to connect, backing off after failures."""
+        if reconnect:
+            delay = self.reconnection.on_disconnected()
+            logger.info('Reconnecting in {:.1f} sec...'.format(delay))
+            await asyncio.sleep(delay)
         while True:
+            self.reconnection.on_attempt()
             try:
                 self.connect(reconnect=reconnect)
                 self.disconnected = self.loop.create_future()
                 break
-            except socket.gaierror:
-                logger.error(
-                    'DNS lookup of hostname {} failed, trying again...'
-                    .format(self.hostname)
-                )
-            except (ConnectionRefusedError, TimeoutError):
-                logger.error(
-                    'Broker server not available, trying again in {} sec...'
-                    .format(self.ping_interval)
-                )
-                await asyncio.sleep(self.ping_interval)
-            except OSError:
+            except socket.gaierror as e:
+                failure = dns_failure
+                logger.error('DNS lookup of hostname {} failed: {}'.format(
+                    self.hostname, e
+                ))
+                error = e
+            except (ConnectionRefusedError, TimeoutError) as e:
+                failure = refused_failure
+                logger.error('Broker server not available: {}'.format(e))
+                error = e
+            except OSError as e:
+                failure = network_failure
                 logger.error(
-                    'Internet connection not available, trying again...'
-                    .format(self.ping_interval)
+                    'Internet connection not available: {}'.format(e)
                 )
+                error = e
+            (delay, escalate) = self.reconnection.on_failure(failure, error)
+            if escalate:
                 await self.attempt_reconnect()
+            logger.info('Trying again in {:.1f} sec...'.format(delay))
+            await asyncio.sleep(delay)
 
         logger.info('Connected to {}:{}.'.format(self.hostname, self.port))
 
@@ -215,29 +441,36 @@ class AsyncioClient(object):
             except asyncio.CancelledError:
                 break
 
+        if self.clock_sync_handle is not None:
+            self.clock_sync_handle.cancel()
+        if self.liveness_handle is not None:
+            self.liveness_handle.cancel()
+        logger.info('Liveness stats: {}'.format(self.liveness.stats()))
+        logger.info('Connection stats: {}'.format(self.reconnection.stats()))
         logger.info('Disconnecting...')
         self.client.disconnect()
         await self.disconnected
         logger.info('Disconnected!')
+        await self.finish_processing()
         self.on_quit()
 
     async def run_iteration(self):
         """Run one iteration of the run loop."""
-        await asyncio.sleep(self.ping_interval - self.ping_timeout)
-        message = self.publish_message(
-            ping_topic, self.client_name, qos=1,
-            local_namespace=self.client_name
-        )[0]
-        self.ping_mid = message.mid
-        await asyncio.sleep(self.ping_timeout)
-        if self.ping_mid is not None:
-            self.on_disconnect(self.client, None, 1)
-            self.ping_mid = None
+        # The connection is checked by check_liveness in the background
+        await asyncio.sleep(self.ping_interval)
 
     def get_target_names(self, topic):
         return self.target_names
 
     def get_topic_paths(self, topic, local_namespace=None):
+        key = (topic, local_namespace)
+        topic_paths = self.topic_paths.get(key)
+        if topic_paths is None:
+            topic_paths = self.make_topic_paths(topic, local_namespace)
+            self.topic_paths[key] = topic_paths
+        return topic_paths
+
+    def make_topic_paths(self, topic, local_namespace=None):
         if local_namespace is False:
             return [topic]
         elif local_namespace is True:
@@ -252,9 +485,108 @@ class AsyncioClient(object):
 
     def publish_message(self, topic, payload, qos=2, local_namespace=None):
         """Publish a message."""
-        return [
+        messages = [
             self.client.publish(topic_path, payload, qos)
             for topic_path in self.get_topic_paths(
                 topic, local_namespace=local_namespace
             )
         ]
+        if qos > 0:
+            # Acknowledgements of published messages are timed for liveness
+            for message in messages:
+                if message.rc == mqtt.MQTT_ERR_SUCCESS:
+                    self.liveness.sent(message.mid, qos)
+        return messages
+
+    async def publish(self, topic, payload, qos=2, local_namespace=None):
+        """Publish a message once there's room in the in-flight window.
+
+        At most publish_window messages, and at most publish_window_bytes of
+        payloads, can await acknowledgement at a time; a single message is
+        always allowed. Returns a future of the mids of the published
+        messages, which resolves when the broker acknowledges them (or when
+        they're sent, for QoS 0), and fails if the client disconnects first.
+        """
+        size = len(payload)
+        count = len(self.get_topic_paths(
+            topic, local_namespace=local_namespace
+        ))
+        await self.wait_for_window(count, size * count)
+        futures = []
+        for message in self.publish_message(
+            topic, payload, qos=qos, local_namespace=local_namespace
+        ):
+            future = self.loop.create_future()
+            futures.append(future)
+            # Messages with QoS 1 or 2 are sent once the client reconnects
+            if message.rc == mqtt.MQTT_ERR_SUCCESS or (
+                qos > 0 and message.rc == mqtt.MQTT_ERR_NO_CONN
+            ):
+                self.inflight[message.mid] = (future, size)
+                self.inflight_bytes += size
+            else:
+                future.set_exception(ConnectionError(
+                    'Could not publish to {}: {}'.format(
+                        topic, mqtt.error_string(message.rc)
+                    )
+                ))
+        return asyncio.gather(*futures)
+
+    def has_window(self, count, size):
+        """Check whether messages can be published within the window."""
+        if not self.inflight:
+            return True
+        if (
+            self.publish_window is not None
+            and len(self.inflight) + count > self.publish_window
+        ):
+            return False
+        if (
+            self.publish_window_bytes is not None
+            and self.inflight_bytes + size > self.publish_window_bytes
+        ):
+            return False
+        return True
+
+    async def wait_for_window(self, count, size):
+        while not self.has_window(count, size):
+            waiter = self.loop.create_future()
+            self.window_waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.window_waiters:
+                    self.window_waiters.remove(waiter)
+
+    def resolve_publish(self, mid):
+        """Resolve the future of an acknowledged message from publish."""
+        if mid not in self.inflight:
+            return
+        (future, size) = self.inflight.pop(mid)
+        self.inflight_bytes -= size
+        if not future.done():
+            future.set_result(mid)
+        self.wake_window_waiters()
+
+    def fail_publishes(self):
+        """Fail the futures of messages from publish which await an ack.
+
+        After a disconnection the broker may have dropped them, so their
+        acknowledgements can't be relied on to free up the window.
+        """
+        inflight = self.inflight
+        self.inflight = {}
+        self.inflight_bytes = 0
+        for (future, size) in inflight.values():
+            if not future.done():
+                future.set_exception(ConnectionError(
+                    'Disconnected before the message was acknowledged'
+                ))
+        self.wake_window_waiters()
+
+    def wake_window_waiters(self):
+        # Waiters check again whether there's room for them
+        while self.window_waiters:
+            waiter = self.window_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
@@ -6,3 +6,11 @@ params_topic = 'params'
 deployment_topic = 'deployment'
 ping_topic = 'ping'
 connect_topic = 'connect'
+chunk_topic = 'chunk'
+retransmit_topic = 'retransmit'
+preview_topic = 'preview'
+
+# Image message encodings, in order of preference
+binary_encoding = 'binary'
+json_encoding = 'json'
+image_encodings = [binary_encoding, json_encoding]
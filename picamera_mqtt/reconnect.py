@@ -0,0 +1,176 @@
+"""Connection state tracking with backoff between reconnection attempts."""
+import random
+import threading
+import time
+
+# Failure classes of connection attempts, and of lost connections
+dns_failure = 'dns'
+refused_failure = 'refused'
+network_failure = 'network'
+lost_connection = 'lost'
+
+default_policies = {
+    # DNS outages usually take a while to resolve
+    dns_failure: {'initial_delay': 2, 'max_delay': 60},
+    # The broker may be restarting, along with every client's connection
+    refused_failure: {'initial_delay': 1, 'max_delay': 60},
+    # The network interface may need to be restarted to recover
+    network_failure: {
+        'initial_delay': 2, 'max_delay': 120, 'escalate_every': 3
+    },
+    # Spread out the first attempts of clients which lost their connections
+    # at the same time, e.g. when the broker restarted
+    lost_connection: {'initial_delay': 5, 'max_delay': 60}
+}
+
+
+class BackoffPolicy(object):
+    """Exponential backoff with jitter for one class of failures.
+
+    The delay after the n-th consecutive failure is drawn uniformly from
+    the upper half of min(max_delay, initial_delay * multiplier ** n), so
+    that clients which fail together retry at different times, but never
+    immediately. If escalate_every is set, every escalate_every-th
+    consecutive failure should be escalated to a recovery action.
+    """
+
+    def __init__(
+        self, initial_delay=1, max_delay=60, multiplier=2,
+        escalate_every=None
+    ):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.escalate_every = escalate_every
+
+    def get_delay(self, failures, random_source=random):
+        delay = min(
+            self.max_delay,
+            self.initial_delay * self.multiplier ** max(0, failures - 1)
+        )
+        return random_source.uniform(delay / 2, delay)
+
+    def should_escalate(self, failures):
+        return (
+            self.escalate_every is not None
+            and failures % self.escalate_every == 0
+        )
+
+
+class ReconnectionTracker(object):
+    """Tracks the state of a connection and paces reconnection attempts.
+
+    The state is one of 'connecting', 'connected', 'waiting' (to retry
+    after a failed attempt), or 'disconnected'. Each class of failure has
+    its own backoff policy, and escalations to recovery actions are limited
+    to max_escalations per outage. Metrics of attempts, failures, and time
+    spent disconnected are kept for reporting.
+    """
+
+    def __init__(
+        self, policies=None, max_escalations=2, clock=time.monotonic,
+        random_source=None
+    ):
+        self.policies = {
+            failure_class: BackoffPolicy(**policy)
+            for (failure_class, policy) in default_policies.items()
+        }
+        for (failure_class, policy) in (policies or {}).items():
+            self.policies[failure_class] = BackoffPolicy(**policy)
+        self.max_escalations = max_escalations
+        self.clock = clock
+        self.random = random_source or random.Random()
+
+        self.lock = threading.Lock()
+        self.state = 'disconnected'
+        self.outage_start = self.clock()
+        self.attempts = 0
+        self.failures = {}
+        self.escalations = 0
+        self.last_error = None
+        self.counters = {
+            'connections': 0,
+            'disconnections': 0,
+            'attempts': 0,
+            'escalations': 0,
+            'disconnected_time': 0
+        }
+
+    def get_policy(self, failure_class):
+        return self.policies.get(
+            failure_class, self.policies[network_failure]
+        )
+
+    def on_disconnected(self, error=None):
+        """Record the loss of the connection.
+
+        Returns how long to wait before the first reconnection attempt.
+        """
+        with self.lock:
+            if self.state == 'connected':
+                self.outage_start = self.clock()
+                self.counters['disconnections'] += 1
+            self.state = 'disconnected'
+            if error is not None:
+                self.last_error = error
+            # Back off if connections keep getting lost right away, e.g.
+            # when the broker refuses them
+            return self.get_policy(lost_connection).get_delay(
+                self.attempts + 1, self.random
+            )
+
+    def on_attempt(self):
+        with self.lock:
+            self.state = 'connecting'
+            self.attempts += 1
+            self.counters['attempts'] += 1
+
+    def on_failure(self, failure_class, error):
+        """Record a failed connection attempt.
+
+        Returns how long to wait before the next attempt, and whether to
+        escalate to a recovery action first.
+        """
+        with self.lock:
+            self.state = 'waiting'
+            self.last_error = '{}: {}'.format(failure_class, error)
+            failures = self.failures.get(failure_class, 0) + 1
+            self.failures[failure_class] = failures
+            policy = self.get_policy(failure_class)
+            escalate = (
+                policy.should_escalate(failures)
+                and self.escalations < self.max_escalations
+            )
+            if escalate:
+                self.escalations += 1
+                self.counters['escalations'] += 1
+            return (policy.get_delay(failures, self.random), escalate)
+
+    def on_connected(self):
+        """Record a successful connection, ending any outage.
+
+        Returns the duration of the outage in seconds.
+        """
+        with self.lock:
+            outage = 0
+            if self.state != 'connected':
+                outage = self.clock() - self.outage_start
+                self.counters['disconnected_time'] += outage
+            self.state = 'connected'
+            self.counters['connections'] += 1
+            self.attempts = 0
+            self.failures = {}
+            self.escalations = 0
+            return outage
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['state'] = self.state
+            stats['outage_attempts'] = self.attempts
+            stats['last_error'] = self.last_error
+            if self.state != 'connected':
+                outage = self.clock() - self.outage_start
+                stats['outage_time'] = outage
+                stats['disconnected_time'] += outage
+        return stats
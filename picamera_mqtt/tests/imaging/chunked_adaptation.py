@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Test that chunked images which overshoot the budget are degraded.
+
+Images are published in chunks over a simulated link of fixed throughput,
+so that each image takes longer than the target latency to be sent.
+"""
+import argparse
+import asyncio
+import os
+
+from picamera_mqtt.imaging import imaging
+from picamera_mqtt.imaging.mqtt_client_camera import Imager, topics
+
+
+class LinkImager(Imager):
+    """Publishes over a simulated link instead of to a broker."""
+
+    def __init__(self, *args, link_rate=10000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.link_rate = link_rate
+        self.link_free_time = 0
+
+    def init_imaging(self):
+        """Initialize imaging support."""
+        self.camera = imaging.MockCamera()
+
+    def publish_message(self, topic, payload, qos=2, local_namespace=None):
+        """Drop messages which aren't flow-controlled."""
+        return []
+
+    async def publish(self, topic, payload, qos=2, local_namespace=None):
+        """Acknowledge each message once the link has sent it."""
+        self.link_free_time = (
+            max(self.link_free_time, self.loop.time())
+            + len(payload) / self.link_rate
+        )
+        published = self.loop.create_future()
+        self.loop.call_at(self.link_free_time, published.set_result, [0])
+        return published
+
+
+def main(image_size, chunk_size, link_rate, images):
+    loop = asyncio.get_event_loop()
+    imager = LinkImager(
+        loop, client_name='camera_1', target_names=['camera_1'],
+        topics=topics, transport_adaptation={'target_latency': 1.0},
+        link_rate=link_rate
+    )
+    capture = {'metadata': {'client_name': 'camera_1'}, 'format': 'jpeg'}
+    for image in range(images):
+        adaptation = imager.transport_adapter.choose(80)
+        print('Image {}: {}'.format(image, adaptation))
+        loop.run_until_complete(imager.publish_chunked(
+            capture, os.urandom(image_size), chunk_size
+        ))
+        # Wait for the last chunk to be acknowledged
+        loop.run_until_complete(asyncio.sleep(
+            imager.link_free_time - loop.time() + 0.01
+        ))
+    adaptation = imager.transport_adapter.choose(80)
+    print('Final: {}'.format(adaptation))
+    assert adaptation['budget'] < image_size
+    assert adaptation['quality'] < 80
+    print('Chunked images were degraded!')
+
+
+# Main program logic follows:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Test transport adaptation of chunked images.'
+    )
+    parser.add_argument(
+        '--image_size', type=int, default=20000,
+        help='Size of each image in bytes.'
+    )
+    parser.add_argument(
+        '--chunk_size', type=int, default=2000,
+        help='Size of each chunk in bytes.'
+    )
+    parser.add_argument(
+        '--link_rate', type=int, default=10000,
+        help='Throughput of the simulated link in bytes per second.'
+    )
+    parser.add_argument(
+        '--images', type=int, default=3, help='Number of images to send.'
+    )
+    args = parser.parse_args()
+
+    main(args.image_size, args.chunk_size, args.link_rate, args.images)
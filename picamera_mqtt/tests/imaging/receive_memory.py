@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Benchmark the memory used to receive and save an image message.
+
+Each receive path runs in its own subprocess, so that the peak RSS of each
+can be compared; the peak of Python allocations while handling each message
+is also measured with tracemalloc.
+"""
+import argparse
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from picamera_mqtt.imaging.mqtt_client_camera import encode_capture
+from picamera_mqtt.imaging.mqtt_client_host import parse_capture
+from picamera_mqtt.protocol import binary_encoding, json_encoding
+
+receive_paths = ['legacy_json', 'json', 'binary']
+
+
+def receive_legacy(payload, path):
+    """Receive an image the way the host did before the zero-copy path."""
+    capture = json.loads(payload.decode('utf-8'))
+    image = base64.b64decode(capture['image'])
+    with open(path, 'wb') as f:
+        f.write(image)
+
+
+def receive(payload, path):
+    capture = parse_capture(payload)
+    with open(path, 'wb') as f:
+        f.write(capture['image'])
+
+
+def build_payload(receive_path, image_size):
+    capture = {
+        'metadata': {
+            'client_name': 'camera_1',
+            'image_id': 1,
+            'capture_time': {
+                'time': time.time(), 'datetime': 'now'
+            }
+        },
+        'format': 'jpeg',
+        'camera_params_version': 'benchmark.1'
+    }
+    image_bytes = os.urandom(image_size)
+    if receive_path == 'binary':
+        return encode_capture(capture, image_bytes, binary_encoding)
+    return encode_capture(capture, image_bytes, json_encoding)
+
+
+def run(receive_path, image_size, count):
+    """Receive some messages, and report the memory used as json."""
+    payload = build_payload(receive_path, image_size)
+    handle = receive_legacy if receive_path == 'legacy_json' else receive
+    peaks = []
+    durations = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for i in range(count):
+            path = os.path.join(output_dir, '{}.jpg'.format(i))
+            tracemalloc.start()
+            start_time = time.time()
+            handle(payload, path)
+            durations.append(time.time() - start_time)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        'receive_path': receive_path,
+        'payload_size': len(payload),
+        'peak_allocated': max(peaks),
+        'peak_rss_increase': (peak_rss - baseline_rss) * 1024,
+        'mean_duration': sum(durations) / len(durations)
+    }))
+
+
+def main(image_size, count):
+    print(
+        '{:>12} {:>12} {:>16} {:>12} {:>10} {:>10}'.format(
+            'path', 'payload', 'peak allocated', 'RSS increase',
+            'per image', 'time (ms)'
+        )
+    )
+    for receive_path in receive_paths:
+        output = subprocess.run(
+            [
+                sys.executable, '-m', __spec__.name, '--run', receive_path,
+                '--size', str(image_size), '--count', str(count)
+            ],
+            stdout=subprocess.PIPE, check=True
+        ).stdout
+        result = json.loads(output.decode('utf-8'))
+        print('{:>12} {:>12} {:>16} {:>12} {:>9.2f}x {:>10.2f}'.format(
+            receive_path, result['payload_size'], result['peak_allocated'],
+            result['peak_rss_increase'],
+            result['peak_allocated'] / image_size,
+            result['mean_duration'] * 1000
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark memory use of image message receive paths.'
+    )
+    parser.add_argument(
+        '--size', '-s', type=int, default=4 * 1024 * 1024,
+        help='Size of each image in bytes. Default: 4 MiB'
+    )
+    parser.add_argument(
+        '--count', '-n', type=int, default=5,
+        help='Number of images to receive with each path. Default: 5'
+    )
+    parser.add_argument(
+        '--run', type=str, choices=receive_paths, default=None,
+        help='Run a single receive path and report its results as json.'
+    )
+    args = parser.parse_args()
+    if args.run is None:
+        main(args.size, args.count)
+    else:
+        run(args.run, args.size, args.count)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Test that disconnecting frees up a full in-flight publish window.
+
+Messages are published to a client which never connects, so that none of
+them are acknowledged until the client is disconnected.
+"""
+import asyncio
+import itertools
+import types
+
+import paho.mqtt.client as mqtt
+
+from picamera_mqtt.mqtt_clients import AsyncioClient
+
+topic = 'testing-publish'
+publish_window = 2
+
+
+def fake_publish(mids):
+    """Make a publish method which accepts every message."""
+    def publish(topic_path, payload, qos):
+        return types.SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS, mid=next(mids))
+    return publish
+
+
+async def fill_window(client):
+    published = [
+        await client.publish(topic, 'message {}'.format(i))
+        for i in range(publish_window)
+    ]
+    assert len(client.inflight) == publish_window
+    # Blocks until there's room in the window
+    blocked = client.loop.create_task(client.publish(topic, 'blocked'))
+    await asyncio.sleep(0.1)
+    assert not blocked.done()
+
+    client.on_disconnect(client.client, None, 1)
+    for future in published:
+        try:
+            await asyncio.wait_for(future, 1)
+        except ConnectionError as e:
+            print('Unacknowledged message failed: {}'.format(e))
+        else:
+            raise AssertionError('Unacknowledged message succeeded')
+    await asyncio.wait_for(blocked, 1)
+    print('Blocked message was published after disconnection!')
+    assert len(client.inflight) == 1
+    assert client.inflight_bytes == len('blocked')
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    client = AsyncioClient(
+        loop, topics={topic: {'qos': 2, 'local_namespace': False}},
+        publish_window=publish_window
+    )
+    client.client.publish = fake_publish(itertools.count(1))
+    loop.run_until_complete(fill_window(client))
+
+
+# Main program logic follows:
+if __name__ == '__main__':
+    main()
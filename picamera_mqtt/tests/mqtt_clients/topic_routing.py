@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Test that messages on multi-level topics are dispatched to handlers."""
+import asyncio
+import types
+
+from picamera_mqtt.mqtt_clients import AsyncioClient
+
+topics = {
+    'imaging/params': {'qos': 2, 'local_namespace': True},
+    'params': {'qos': 2, 'local_namespace': True},
+    'status/camera': {'qos': 2, 'local_namespace': False}
+}
+target_names = ['camera_1', 'site_a/camera_2']
+
+
+def dispatch(client, topic_path):
+    msg = types.SimpleNamespace(topic=topic_path, payload=b'')
+    return client.router.dispatch(client.client, None, msg)
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    client = AsyncioClient(loop, topics=topics, target_names=target_names)
+    received = []
+    for topic in topics:
+        client.add_topic_handler(
+            topic, lambda client, userdata, msg, topic=topic:
+            received.append((topic, msg.topic))
+        )
+
+    expected = [
+        ('imaging/params', 'camera_1/imaging/params'),
+        ('imaging/params', 'site_a/camera_2/imaging/params'),
+        ('params', 'camera_1/params'),
+        ('params', 'site_a/camera_2/params'),
+        ('status/camera', 'status/camera')
+    ]
+    for (topic, topic_path) in expected:
+        assert dispatch(client, topic_path), topic_path
+    assert received == expected, received
+    print('Messages on multi-level topics were dispatched!')
+
+    for topic_path in [
+        'camera_3/imaging/params', 'camera_1/imaging', 'site_a/params',
+        'camera_1/status/camera'
+    ]:
+        assert not dispatch(client, topic_path), topic_path
+    print('Messages from unknown namespaces were not dispatched!')
+
+
+# Main program logic follows:
+if __name__ == '__main__':
+    main()
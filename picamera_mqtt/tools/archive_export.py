@@ -0,0 +1,70 @@
+"""Export captures from an archive as separate image and metadata files."""
+
+import argparse
+import logging
+import logging.config
+
+from picamera_mqtt.imaging.archive import CaptureArchive
+from picamera_mqtt.imaging.capture_index import parse_time
+from picamera_mqtt.util.logging import logging_config
+
+# Set up logging
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger(__name__)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export captures from an archive to jpg+json files.'
+    )
+    parser.add_argument(
+        'archive_dir', type=str, help='Directory of the capture archive.'
+    )
+    parser.add_argument(
+        '--output_dir', '-o', type=str, required=True,
+        help='Directory to save exported images and metadata.'
+    )
+    parser.add_argument(
+        '--camera', '-c', type=str, action='append', default=None,
+        help='Only export captures from this camera; can be repeated.'
+    )
+    parser.add_argument(
+        '--image_id', type=int, default=None,
+        help=(
+            'Only export the captures with this image id, e.g. the frames '
+            'of a burst.'
+        )
+    )
+    parser.add_argument(
+        '--start', type=parse_time, default=None,
+        help='Only export captures at or after this time.'
+    )
+    parser.add_argument(
+        '--end', type=parse_time, default=None,
+        help='Only export captures at or before this time.'
+    )
+    args = parser.parse_args()
+
+    capture_archive = CaptureArchive(args.archive_dir, read_only=True)
+    if args.image_id is not None:
+        entries = [
+            entry
+            for camera in (args.camera or capture_archive.by_camera.keys())
+            for entry in capture_archive.get_entries(camera, args.image_id)
+            if (args.start is None or entry['time'] >= args.start)
+            and (args.end is None or entry['time'] <= args.end)
+        ]
+    elif args.camera is None:
+        entries = capture_archive.query(start_time=args.start, end_time=args.end)
+    else:
+        entries = []
+        for camera in args.camera:
+            entries.extend(capture_archive.query(
+                camera, start_time=args.start, end_time=args.end
+            ))
+    logger.info('Exporting {} captures to {}...'.format(
+        len(entries), args.output_dir
+    ))
+    count = capture_archive.export(args.output_dir, entries=entries)
+    capture_archive.close()
+    logger.info('Exported {} captures.'.format(count))
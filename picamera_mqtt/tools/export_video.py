@@ -0,0 +1,139 @@
+"""Export the saved captures of cameras as MJPEG AVI timelapse videos."""
+
+import argparse
+import concurrent.futures
+import logging
+import logging.config
+import os
+
+from picamera_mqtt.imaging import archive, video
+from picamera_mqtt.imaging.capture_index import CaptureIndex, parse_time
+from picamera_mqtt.util import files
+from picamera_mqtt.util.logging import logging_config
+
+# Set up logging
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger(__name__)
+
+
+def find_cameras(capture_dir, index_path=None):
+    """List the names of the cameras with saved captures."""
+    if index_path is not None:
+        capture_index = CaptureIndex(index_path)
+        rows = capture_index.query(order_by=None)
+        capture_index.close()
+        return sorted(set(row['client_name'] for row in rows))
+    if os.path.exists(os.path.join(capture_dir, archive.index_name)):
+        capture_archive = archive.CaptureArchive(capture_dir, read_only=True)
+        client_names = sorted(capture_archive.by_camera.keys())
+        capture_archive.close()
+        return client_names
+    client_names = set()
+    for (dir_path, dir_names, filenames) in os.walk(capture_dir):
+        dir_names[:] = [name for name in dir_names if name != '.partial']
+        for filename in filenames:
+            parsed = archive.parse_capture_filename(
+                os.path.splitext(filename)[0]
+            )
+            if parsed is not None:
+                client_names.add(parsed[0])
+    return sorted(client_names)
+
+
+def export_camera(
+    client_name, capture_dir, output_dir, index_path, start_time, end_time,
+    step, min_interval, fps
+):
+    """Export the video of one camera; runs in a worker process."""
+    frames = video.iter_frames(
+        capture_dir, client_name, start_time=start_time, end_time=end_time,
+        index_path=index_path
+    )
+    output_path = os.path.join(output_dir, '{}.avi'.format(client_name))
+    count = video.export_video(
+        output_path, video.decimate(frames, step, min_interval), fps=fps
+    )
+    logger.info('Exported {} frames from {} to {}'.format(
+        count, client_name, output_path
+    ))
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=(
+            'Export the saved JPEG captures of each camera as an MJPEG AVI '
+            'video, without re-encoding them.'
+        )
+    )
+    parser.add_argument(
+        'capture_dir', type=str,
+        help='Directory of saved captures, or of a capture archive.'
+    )
+    parser.add_argument(
+        '--output_dir', '-o', type=str, required=True,
+        help='Directory to save a video of each camera in.'
+    )
+    parser.add_argument(
+        '--camera', '-c', type=str, action='append', default=None,
+        help='Only export the video of this camera; can be repeated.'
+    )
+    parser.add_argument(
+        '--start', type=parse_time, default=None,
+        help='Only export captures at or after this time.'
+    )
+    parser.add_argument(
+        '--end', type=parse_time, default=None,
+        help='Only export captures at or before this time.'
+    )
+    parser.add_argument(
+        '--index_path', type=str, default=None,
+        help=(
+            'SQLite capture index to find captures with. '
+            'Default: find captures by their filenames'
+        )
+    )
+    parser.add_argument(
+        '--step', type=int, default=1,
+        help='Only export every step-th capture. Default: 1'
+    )
+    parser.add_argument(
+        '--min_interval', type=float, default=None,
+        help=(
+            'Minimum capture time in seconds between exported frames. '
+            'Default: none'
+        )
+    )
+    parser.add_argument(
+        '--fps', type=float, default=30,
+        help='Frame rate of the videos. Default: 30'
+    )
+    parser.add_argument(
+        '--workers', '-j', type=int, default=None,
+        help=(
+            'Number of cameras to export in parallel. '
+            'Default: number of CPUs'
+        )
+    )
+    args = parser.parse_args()
+
+    client_names = args.camera or find_cameras(
+        args.capture_dir, args.index_path
+    )
+    files.ensure_path(args.output_dir)
+    logger.info('Exporting videos of {} cameras to {}...'.format(
+        len(client_names), args.output_dir
+    ))
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.workers
+    ) as executor:
+        futures = [
+            executor.submit(
+                export_camera, client_name, args.capture_dir,
+                args.output_dir, args.index_path, args.start, args.end,
+                args.step, args.min_interval, args.fps
+            )
+            for client_name in client_names
+        ]
+        count = sum(future.result() for future in futures)
+    logger.info('Exported {} frames.'.format(count))
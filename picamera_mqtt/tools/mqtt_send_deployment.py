@@ -39,25 +39,17 @@ class Publisher(AsyncioClient):
         """Save the message to send."""
         super().__init__(loop, **kwargs)
         self.message = message
-        self.message_mid = None
-
-    def on_publish(self, client, userdata, mid):
-        """When the client publishes a message, handle it."""
-        if mid == self.message_mid:
-            logger.debug('Message {} published to broker'.format(message))
-            raise KeyboardInterrupt
 
     async def run_iteration(self):
         """Run one iteration of the run loop."""
-        if self.message_mid is None:
-            logger.info('Publishing message: {}'.format(self.message))
-            message = self.publish_message(
-                deployment_topic, self.message,
-                local_namespace=self.target_names[0]
-            )[0]
-            self.message_mid = message.mid
-        else:
-            await asyncio.sleep(0.5)
+        logger.info('Publishing message: {}'.format(self.message))
+        published = await self.publish(
+            deployment_topic, self.message,
+            local_namespace=self.target_names[0]
+        )
+        await published
+        logger.debug('Message {} published to broker'.format(self.message))
+        raise KeyboardInterrupt
 
 
 if __name__ == '__main__':
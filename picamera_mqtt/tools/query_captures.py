@@ -0,0 +1,103 @@
+"""Query or rebuild a SQLite index of captured image metadata."""
+
+import argparse
+import json
+import logging
+import logging.config
+
+from picamera_mqtt.imaging.capture_index import CaptureIndex, parse_time
+from picamera_mqtt.util.logging import logging_config
+
+# Set up logging
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger(__name__)
+
+
+def query(capture_index, args):
+    rows = capture_index.query(
+        client_names=args.camera, start_time=args.start, end_time=args.end,
+        where=args.where, order_by=args.order_by, limit=args.limit
+    )
+    for row in rows:
+        if args.output == 'path':
+            print(row['path'])
+        elif args.output == 'json':
+            print(json.dumps(row))
+        else:
+            print('{} {} {} {} {}'.format(
+                row['client_name'], row['image_id'], row['capture_time'],
+                row['shutter_speed'], row['path']
+            ))
+    logger.info('Found {} captures.'.format(len(rows)))
+
+
+def rebuild(capture_index, args):
+    count = capture_index.rebuild(args.capture_dir, workers=args.workers)
+    logger.info('Indexed {} captures; the index now has {} captures.'.format(
+        count, capture_index.count()
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Query or rebuild an index of captured image metadata.'
+    )
+    parser.add_argument(
+        'index_path', type=str, help='SQLite database of the index.'
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    query_parser = subparsers.add_parser(
+        'query', help='Find indexed captures.'
+    )
+    query_parser.set_defaults(function=query)
+    query_parser.add_argument(
+        '--camera', '-c', type=str, action='append', default=None,
+        help='Only find captures from this camera; can be repeated.'
+    )
+    query_parser.add_argument(
+        '--start', type=parse_time, default=None,
+        help='Only find captures at or after this time.'
+    )
+    query_parser.add_argument(
+        '--end', type=parse_time, default=None,
+        help='Only find captures at or before this time.'
+    )
+    query_parser.add_argument(
+        '--where', '-w', type=str, default=None,
+        help=(
+            'SQL condition on the index columns, e.g. "shutter_speed > 100". '
+            'Default: none'
+        )
+    )
+    query_parser.add_argument(
+        '--order_by', type=str, default='capture_time',
+        help='SQL ordering of the results. Default: capture_time'
+    )
+    query_parser.add_argument(
+        '--limit', '-n', type=int, default=None,
+        help='Maximum number of captures to find. Default: no limit'
+    )
+    query_parser.add_argument(
+        '--output', '-o', type=str, choices=['summary', 'path', 'json'],
+        default='summary', help='Output format. Default: summary'
+    )
+
+    rebuild_parser = subparsers.add_parser(
+        'rebuild', help='Index the captures saved in a directory.'
+    )
+    rebuild_parser.set_defaults(function=rebuild)
+    rebuild_parser.add_argument(
+        'capture_dir', type=str,
+        help='Directory of saved captures and archives to index.'
+    )
+    rebuild_parser.add_argument(
+        '--workers', '-j', type=int, default=None,
+        help='Number of parallel worker processes. Default: number of CPUs'
+    )
+    args = parser.parse_args()
+
+    capture_index = CaptureIndex(args.index_path)
+    args.function(capture_index, args)
+    capture_index.close()
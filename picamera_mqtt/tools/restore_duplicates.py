@@ -0,0 +1,32 @@
+"""Restore the images of deduplicated captures in a capture directory."""
+
+import argparse
+import logging
+import logging.config
+
+from picamera_mqtt.imaging.dedup import restore_duplicates
+from picamera_mqtt.util.logging import logging_config
+
+# Set up logging
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger(__name__)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=(
+            'Give each deduplicated capture its own copy of the image it '
+            'refers to.'
+        )
+    )
+    parser.add_argument(
+        'capture_dir', type=str, help='Directory of saved captures.'
+    )
+    parser.add_argument(
+        '--link', action='store_true',
+        help='Hard-link images instead of copying them.'
+    )
+    args = parser.parse_args()
+
+    count = restore_duplicates(args.capture_dir, link=args.link)
+    logger.info('Restored {} deduplicated captures.'.format(count))
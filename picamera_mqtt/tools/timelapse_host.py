@@ -95,6 +95,56 @@ if __name__ == '__main__':
             'Default: {}'.format(data_path)
         )
     )
+    parser.add_argument(
+        '--storage', '-s', type=str, choices=['files', 'archive'],
+        default='files',
+        help=(
+            'Save each capture as separate image and metadata files, or '
+            'append captures to an archive. Default: files'
+        )
+    )
+    parser.add_argument(
+        '--layout', '-l', type=str, choices=['flat', 'camera', 'camera_date'],
+        default='flat',
+        help=(
+            'Save files directly in the output directory, or in a '
+            'subdirectory per camera (and per date). Default: flat'
+        )
+    )
+    parser.add_argument(
+        '--durability', type=str,
+        choices=['none', 'file', 'batch', 'interval'], default='none',
+        help=(
+            'When to sync saved files to disk: never explicitly, after each '
+            'file, after each batch of files, or periodically. Default: none'
+        )
+    )
+    parser.add_argument(
+        '--dedup_threshold', type=int, default=None,
+        help=(
+            'Save images whose perceptual hashes differ from the last saved '
+            'image by at most this many bits as references to it. '
+            'Default: save all images'
+        )
+    )
+    parser.add_argument(
+        '--index_path', type=str, default=None,
+        help='SQLite database to index capture metadata in. Default: none'
+    )
+    parser.add_argument(
+        '--analytics_workers', type=int, default=None,
+        help=(
+            'Number of processes computing image quality metrics of saved '
+            'images. Default: no analytics'
+        )
+    )
+    parser.add_argument(
+        '--wildcard_subscriptions', action='store_true',
+        help=(
+            'Subscribe to the topics of all cameras with single wildcard '
+            'subscriptions, which is faster to set up for large fleets.'
+        )
+    )
     args = parser.parse_args()
     acquisition_interval = args.interval
     acquisition_length = args.number
@@ -107,7 +157,18 @@ if __name__ == '__main__':
     loop = asyncio.get_event_loop()
     mqttc = TimelapseHost(
         loop, **configuration['broker'], **configuration['host'],
-        topics=topics, capture_dir=capture_dir,
+        topics=topics, capture_dir=capture_dir, storage=args.storage,
+        index_path=args.index_path, storage_layout=args.layout,
+        storage_durability=args.durability,
+        deduplication=(
+            None if args.dedup_threshold is None
+            else {'threshold': args.dedup_threshold}
+        ),
+        analytics=(
+            None if args.analytics_workers is None
+            else {'workers': args.analytics_workers}
+        ),
+        wildcard_subscriptions=args.wildcard_subscriptions,
         acquisition_interval=acquisition_interval,
         acquisition_length=acquisition_length,
         camera_params=configuration['targets']
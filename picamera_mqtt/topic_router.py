@@ -0,0 +1,69 @@
+"""Dispatch of received messages to handlers by namespace and topic."""
+
+
+def get_namespace(topic_path, topic):
+    """Find the namespace of a path of a topic.
+
+    Topic paths without a namespace have an empty namespace.
+    """
+    if topic_path == topic:
+        return ''
+    return topic_path[:-len(topic) - 1]
+
+
+def split_topic_path(topic_path):
+    """Yield each way to split a topic path into a namespace and a topic.
+
+    Topics may have several levels themselves, so every level boundary is
+    tried, starting from an empty namespace.
+    """
+    yield ('', topic_path)
+    position = topic_path.find('/')
+    while position != -1:
+        yield (topic_path[:position], topic_path[position + 1:])
+        position = topic_path.find('/', position + 1)
+
+
+class TopicRouter(object):
+    """Finds the handler of a message in a table of namespaces and topics.
+
+    Unlike the paho client's message callbacks, which are matched against
+    every received topic path in turn, handlers are looked up by namespace
+    and topic at each level boundary of the topic path, so dispatch takes
+    time proportional to the depth of the topic path regardless of the
+    number of namespaces. Messages from namespaces without handlers, e.g.
+    from wildcard subscriptions, are not dispatched.
+    """
+
+    def __init__(self):
+        self.routes = {}
+
+    def add(self, topic, handler, namespaces):
+        """Handle a topic in each of the namespaces with the handler."""
+        routes = self.routes.setdefault(topic, {})
+        for namespace in namespaces:
+            routes[namespace] = handler
+
+    def remove(self, topic, namespaces=None):
+        """Stop handling a topic in the namespaces, or in all namespaces."""
+        if namespaces is None:
+            self.routes.pop(topic, None)
+            return
+        routes = self.routes.get(topic, {})
+        for namespace in namespaces:
+            routes.pop(namespace, None)
+
+    def get_handler(self, topic_path):
+        for (namespace, topic) in split_topic_path(topic_path):
+            routes = self.routes.get(topic)
+            if routes is not None and namespace in routes:
+                return routes[namespace]
+        return None
+
+    def dispatch(self, client, userdata, msg):
+        """Call the handler of a message, returning whether there was one."""
+        handler = self.get_handler(msg.topic)
+        if handler is None:
+            return False
+        handler(client, userdata, msg)
+        return True
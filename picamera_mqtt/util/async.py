@@ -1,6 +1,8 @@
 """Convenience code for running asyncio code."""
 import asyncio
+import concurrent.futures
 import contextlib
+import functools
 import logging
 import signal
 
@@ -50,3 +52,31 @@ def run_function(
                 cancel_task(task, loop)
         finally:
             loop.close()
+
+def make_executor(kind, max_workers=None):
+    """Make a thread or process pool executor, or None for inline execution."""
+    if kind is None:
+        return None
+    elif kind == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    elif kind == 'process':
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    raise ValueError('Unknown executor kind: {}'.format(kind))
+
+async def run_in_executor(loop, executor, function, *args, **kwargs):
+    """Run a function in an executor, or inline if the executor is None."""
+    if executor is None:
+        return function(*args, **kwargs)
+    return await loop.run_in_executor(
+        executor, functools.partial(function, *args, **kwargs)
+    )
+
+def log_task_exception(task):
+    """Log any exception raised by a finished task."""
+    if task.cancelled():
+        return
+    exception = task.exception()
+    if exception is not None:
+        logger.error('Task failed: {!r}'.format(exception), exc_info=(
+            type(exception), exception, exception.__traceback__
+        ))
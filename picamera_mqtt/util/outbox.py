@@ -0,0 +1,322 @@
+"""Disk-backed queue of messages to publish once a client is connected.
+
+Messages are appended to segment files, as records of a prelude, the topic,
+and the payload:
+
+    magic (4 bytes) | qos (1) | topic size (2) | payload size (4) | ...
+
+When a message has been published, its segment and offset are appended to
+a log of consumed records, so that it isn't published again after a
+restart; segment files are deleted once all their messages are consumed.
+"""
+import collections
+import logging
+import os
+import struct
+import threading
+
+from picamera_mqtt.util import files
+
+logger = logging.getLogger(__name__)
+
+record_prelude = struct.Struct('>4sBHI')
+record_magic = b'PCOB'
+consumed_record = struct.Struct('>IQ')
+segment_name_format = 'segment-{:06d}.outbox'
+consumed_name = 'consumed.log'
+topic_string_encoding = 'utf-8'
+orders = ['oldest', 'newest']
+eviction_policies = ['oldest', 'newest']
+
+
+class Outbox(object):
+    """A segmented on-disk queue of messages awaiting publishing.
+
+    Messages are taken oldest first or newest first, depending on order.
+    Taken messages stay in the queue until they're acknowledged as
+    published, or released to be taken again. If the queue would grow
+    beyond max_bytes, the eviction policy either drops the oldest messages
+    or rejects the new message. Only the locations of the messages are
+    kept in memory; their payloads are read from disk when they're taken.
+    """
+
+    def __init__(
+        self, path, max_bytes=256 * 1024 * 1024,
+        max_segment_size=16 * 1024 * 1024, order='oldest', eviction='oldest'
+    ):
+        if order not in orders:
+            raise ValueError('Unknown outbox order: {}'.format(order))
+        if eviction not in eviction_policies:
+            raise ValueError(
+                'Unknown outbox eviction policy: {}'.format(eviction)
+            )
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_segment_size = max_segment_size
+        self.order = order
+        self.eviction = eviction
+
+        self.lock = threading.Lock()
+        # Locations of unconsumed messages in order of age, with their sizes
+        self.entries = collections.OrderedDict()
+        self.taken = set()
+        self.bytes = 0
+        self.segment_counts = {}
+        self.consumed = {}
+        self.segment = 0
+        self.segment_file = None
+        self.counters = {
+            'stored': 0, 'published': 0, 'evicted': 0, 'rejected': 0
+        }
+
+        files.ensure_path(path)
+        self.load()
+        self.consumed_file = open(os.path.join(path, consumed_name), 'ab')
+
+    # Paths
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, segment_name_format.format(segment))
+
+    def list_segments(self):
+        """List the numbers of the segment files in the outbox."""
+        segments = []
+        for filename in os.listdir(self.path):
+            (name, extension) = os.path.splitext(filename)
+            if extension == '.outbox' and name.startswith('segment-'):
+                segments.append(int(name[len('segment-'):]))
+        return sorted(segments)
+
+    # Loading
+
+    def load(self):
+        """Find the unconsumed messages stored before a restart."""
+        consumed = set()
+        consumed_path = os.path.join(self.path, consumed_name)
+        if os.path.exists(consumed_path):
+            with open(consumed_path, 'rb') as f:
+                data = f.read()
+            for position in range(
+                0, len(data) - consumed_record.size + 1, consumed_record.size
+            ):
+                consumed.add(consumed_record.unpack_from(data, position))
+        segments = self.list_segments()
+        for segment in segments:
+            for (offset, size) in self.scan_segment(segment):
+                if (segment, offset) in consumed:
+                    self.consumed.setdefault(segment, set()).add(offset)
+                    continue
+                self.entries[(segment, offset)] = size
+                self.bytes += size
+                self.segment_counts[segment] = (
+                    self.segment_counts.get(segment, 0) + 1
+                )
+        if segments:
+            self.segment = segments[-1] + 1
+        for segment in segments:
+            if not self.segment_counts.get(segment):
+                self.delete_segment(segment)
+        # Drop the consumption records of deleted segments
+        self.compact_consumed()
+        if self.entries:
+            logger.info('Found {} stored messages ({} bytes) in {}'.format(
+                len(self.entries), self.bytes, self.path
+            ))
+
+    def scan_segment(self, segment):
+        """Yield the offsets and sizes of the records of a segment file.
+
+        Scanning stops at the first malformed or truncated record, which is
+        truncated away.
+        """
+        path = self.segment_path(segment)
+        file_size = os.path.getsize(path)
+        with open(path, 'r+b') as f:
+            offset = 0
+            while offset < file_size:
+                prelude = f.read(record_prelude.size)
+                error = None
+                if len(prelude) < record_prelude.size:
+                    error = 'incomplete prelude'
+                else:
+                    (magic, qos, topic_size, payload_size) = (
+                        record_prelude.unpack(prelude)
+                    )
+                    end = (
+                        offset + record_prelude.size + topic_size
+                        + payload_size
+                    )
+                    if magic != record_magic:
+                        error = 'bad magic bytes'
+                    elif end > file_size:
+                        error = 'incomplete record'
+                if error is not None:
+                    logger.warning('Truncating {} at offset {}: {}'.format(
+                        path, offset, error
+                    ))
+                    f.truncate(offset)
+                    return
+                yield (offset, end - offset)
+                offset = f.seek(end)
+
+    def compact_consumed(self):
+        """Rewrite the consumption log with only the live segments."""
+        consumed_path = os.path.join(self.path, consumed_name)
+        with open(consumed_path + '.tmp', 'wb') as f:
+            for (segment, offsets) in self.consumed.items():
+                for offset in offsets:
+                    f.write(consumed_record.pack(segment, offset))
+        os.replace(consumed_path + '.tmp', consumed_path)
+
+    # Writing
+
+    def open_segment(self, size):
+        """Get the segment file to append a record to, rolling over."""
+        if self.segment_file is not None and (
+            self.segment_file.tell() + size > self.max_segment_size
+        ):
+            self.segment_file.close()
+            self.segment_file = None
+            self.segment += 1
+        if self.segment_file is None:
+            self.segment_file = open(self.segment_path(self.segment), 'ab')
+        return self.segment_file
+
+    def put(self, topic, payload, qos=2):
+        """Store a message, evicting others if needed.
+
+        Returns whether the message was stored.
+        """
+        topic_bytes = topic.encode(topic_string_encoding)
+        if isinstance(payload, str):
+            payload = payload.encode(topic_string_encoding)
+        size = record_prelude.size + len(topic_bytes) + len(payload)
+        with self.lock:
+            if size > self.max_bytes or (
+                self.eviction == 'newest'
+                and self.bytes + size > self.max_bytes
+            ):
+                self.counters['rejected'] += 1
+                logger.warning(
+                    'Outbox is full, dropping message on {}'.format(topic)
+                )
+                return False
+            while self.bytes + size > self.max_bytes and self.evict_oldest():
+                pass
+            segment_file = self.open_segment(size)
+            offset = segment_file.tell()
+            segment_file.write(record_prelude.pack(
+                record_magic, qos, len(topic_bytes), len(payload)
+            ))
+            segment_file.write(topic_bytes)
+            segment_file.write(payload)
+            segment_file.flush()
+            self.entries[(self.segment, offset)] = size
+            self.bytes += size
+            self.segment_counts[self.segment] = (
+                self.segment_counts.get(self.segment, 0) + 1
+            )
+            self.counters['stored'] += 1
+        return True
+
+    def evict_oldest(self):
+        """Drop the oldest message which isn't being published."""
+        for key in self.entries:
+            if key not in self.taken:
+                self.consume(key)
+                self.counters['evicted'] += 1
+                logger.warning('Outbox is full, evicted its oldest message')
+                return True
+        return False
+
+    # Reading
+
+    def take(self):
+        """Take the next message to publish, or None if there are none.
+
+        Returns a dict of the message's key, topic, qos, and payload.
+        """
+        with self.lock:
+            keys = iter(self.entries)
+            if self.order == 'newest':
+                keys = reversed(self.entries)
+            key = next((key for key in keys if key not in self.taken), None)
+            if key is None:
+                return None
+            self.taken.add(key)
+            (segment, offset) = key
+            if segment == self.segment and self.segment_file is not None:
+                self.segment_file.flush()
+        with open(self.segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            (magic, qos, topic_size, payload_size) = record_prelude.unpack(
+                f.read(record_prelude.size)
+            )
+            topic = f.read(topic_size).decode(topic_string_encoding)
+            payload = f.read(payload_size)
+        return {'key': key, 'topic': topic, 'qos': qos, 'payload': payload}
+
+    def release(self, key):
+        """Return a taken message to the queue, e.g. if publishing failed."""
+        with self.lock:
+            self.taken.discard(key)
+
+    def release_all(self):
+        """Return all taken messages to the queue, e.g. on disconnection."""
+        with self.lock:
+            self.taken.clear()
+
+    def acknowledge(self, key):
+        """Remove a taken message from the queue once it's published."""
+        with self.lock:
+            if key in self.entries:
+                self.consume(key)
+                self.counters['published'] += 1
+
+    def consume(self, key):
+        (segment, offset) = key
+        self.bytes -= self.entries.pop(key)
+        self.taken.discard(key)
+        self.segment_counts[segment] -= 1
+        if not self.segment_counts[segment]:
+            if segment == self.segment and self.segment_file is not None:
+                self.segment_file.close()
+                self.segment_file = None
+                self.segment += 1
+            self.delete_segment(segment)
+            self.consumed_file.close()
+            self.compact_consumed()
+            self.consumed_file = open(
+                os.path.join(self.path, consumed_name), 'ab'
+            )
+            return
+        self.consumed.setdefault(segment, set()).add(offset)
+        self.consumed_file.write(consumed_record.pack(segment, offset))
+        self.consumed_file.flush()
+
+    def delete_segment(self, segment):
+        self.segment_counts.pop(segment, None)
+        self.consumed.pop(segment, None)
+        try:
+            os.remove(self.segment_path(segment))
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def close(self):
+        with self.lock:
+            if self.segment_file is not None:
+                self.segment_file.close()
+                self.segment_file = None
+            self.consumed_file.close()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['messages'] = len(self.entries)
+            stats['bytes'] = self.bytes
+            stats['segments'] = len(self.segment_counts)
+        return stats
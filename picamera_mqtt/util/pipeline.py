@@ -0,0 +1,253 @@
+"""Staged processing of received messages off the asyncio event loop."""
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+overflow_policies = ['pause', 'drop_oldest', 'drop_newest']
+
+
+class ReceivePipeline(object):
+    """A bounded queue of received payloads, processed by a pool of workers.
+
+    Each payload is parsed by parse_function and the result is handled by
+    handle_function along with the context it was queued with. The queue is
+    sharded across the workers by the key each payload is queued with, so
+    that payloads with the same key (e.g. from the same camera) are always
+    processed one at a time, in the order they were received. Parsing runs
+    in a thread or process pool, and handling runs in a thread pool, so
+    neither blocks the event loop; parse_function must be picklable to run in
+    a process pool.
+
+    When the queue is full, the overflow policy decides what happens:
+    'pause' stops reading from the network until the queue has drained by
+    half, so that backpressure propagates to the broker; 'drop_oldest'
+    discards the oldest queued payload; and 'drop_newest' discards the
+    incoming payload. The queue size bounds all the shards together.
+
+    Before quitting, drain processes the queued items and stops accepting
+    new ones, and stop waits for any running handlers to finish.
+    """
+
+    def __init__(
+        self, loop, parse_function, handle_function,
+        max_queue_size=16, workers=2, parse_executor='thread',
+        overflow='pause', pause_reading=None, resume_reading=None
+    ):
+        if overflow not in overflow_policies:
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
+        self.loop = loop
+        self.parse_function = parse_function
+        self.handle_function = handle_function
+        self.max_queue_size = max_queue_size
+        self.workers = workers
+        self.overflow = overflow
+        self.pause_reading = pause_reading
+        self.resume_reading = resume_reading
+
+        self.handle_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers
+        )
+        if parse_executor == 'process':
+            self.parse_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers
+            )
+        elif parse_executor in ('thread', None):
+            # Parse and handle in a single thread pool job
+            self.parse_executor = None
+        else:
+            raise ValueError(
+                'Unknown executor kind: {}'.format(parse_executor)
+            )
+
+        # One queue per worker, with items in the order they were received
+        self.queues = [collections.deque() for i in range(workers)]
+        self.queues_ready = []
+        self.queue_length = 0
+        self.sequence = 0
+        self.worker_tasks = []
+        self.paused = False
+        self.accepting = True
+
+        self.counters = {
+            'received': 0,
+            'received_bytes': 0,
+            'dropped': 0,
+            'processed': 0,
+            'processed_bytes': 0,
+            'failed': 0,
+            'pauses': 0,
+            'max_queue_depth': 0
+        }
+        self.start_time = None
+
+    @property
+    def queue_depth(self):
+        return self.queue_length
+
+    def start(self):
+        """Start the worker tasks, if they aren't running."""
+        if self.worker_tasks:
+            return
+        self.start_time = time.time()
+        self.queues_ready = [asyncio.Event() for i in range(self.workers)]
+        self.worker_tasks = [
+            self.loop.create_task(self.run_worker(shard))
+            for shard in range(self.workers)
+        ]
+
+    async def drain(self):
+        """Stop accepting items, and wait for the queued items to finish."""
+        self.accepting = False
+        if not self.worker_tasks:
+            return
+        # Each worker finishes when it takes a sentinel after its queue
+        for (queue, queue_ready) in zip(self.queues, self.queues_ready):
+            queue.append(None)
+            queue_ready.set()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+
+    def stop(self):
+        """Stop the worker tasks and shut down the executors.
+
+        Handlers which are already running are waited for.
+        """
+        self.accepting = False
+        for task in self.worker_tasks:
+            task.cancel()
+        self.worker_tasks = []
+        self.handle_executor.shutdown(wait=True)
+        if self.parse_executor is not None:
+            self.parse_executor.shutdown(wait=True)
+
+    def put(self, payload, context=None, key=None):
+        """Queue a received payload for parsing and handling.
+
+        Payloads without a key go to the shortest queue. Returns whether the
+        payload was queued.
+        """
+        self.counters['received'] += 1
+        self.counters['received_bytes'] += len(payload)
+        return self.enqueue((True, payload, context), key)
+
+    def put_parsed(self, parsed, context=None, key=None):
+        """Queue an already-parsed item for handling."""
+        return self.enqueue((False, parsed, context), key)
+
+    def get_shard(self, key):
+        if key is None:
+            return min(
+                range(self.workers), key=lambda shard: len(self.queues[shard])
+            )
+        return hash(key) % self.workers
+
+    def drop_oldest(self):
+        """Discard the oldest queued item across all the queues."""
+        queues = [queue for queue in self.queues if queue]
+        oldest = min(queues, key=lambda queue: queue[0][0])
+        oldest.popleft()
+        self.queue_length -= 1
+
+    def enqueue(self, item, key=None):
+        if not self.accepting:
+            self.counters['dropped'] += 1
+            logger.warning('Receive pipeline is stopping, dropping message')
+            return False
+        self.start()
+        if self.queue_length >= self.max_queue_size:
+            if self.overflow == 'drop_newest':
+                self.counters['dropped'] += 1
+                logger.warning('Receive queue is full, dropping new message')
+                return False
+            elif self.overflow == 'drop_oldest':
+                self.counters['dropped'] += 1
+                logger.warning('Receive queue is full, dropping old message')
+                self.drop_oldest()
+        shard = self.get_shard(key)
+        self.sequence += 1
+        self.queues[shard].append((self.sequence, item))
+        self.queue_length += 1
+        self.counters['max_queue_depth'] = max(
+            self.counters['max_queue_depth'], self.queue_length
+        )
+        if (
+            self.overflow == 'pause' and not self.paused
+            and self.queue_length >= self.max_queue_size
+            and self.pause_reading is not None
+        ):
+            logger.warning('Receive queue is full, pausing network reads')
+            self.paused = True
+            self.counters['pauses'] += 1
+            self.pause_reading()
+        self.queues_ready[shard].set()
+        return True
+
+    async def run_worker(self, shard):
+        """Process the items of a queue until cancelled or drained."""
+        queue = self.queues[shard]
+        queue_ready = self.queues_ready[shard]
+        while True:
+            while not queue:
+                queue_ready.clear()
+                await queue_ready.wait()
+            entry = queue.popleft()
+            if entry is None:
+                return
+            self.queue_length -= 1
+            (sequence, (needs_parsing, data, context)) = entry
+            if self.paused and self.queue_length <= self.max_queue_size // 2:
+                logger.info('Receive queue drained, resuming network reads')
+                self.paused = False
+                self.resume_reading()
+            try:
+                await self.process(needs_parsing, data, context)
+            except asyncio.CancelledError:
+                raise
+            except ValueError as e:
+                self.counters['failed'] += 1
+                logger.error('Malformed received message: {}'.format(e))
+                continue
+            except Exception:
+                self.counters['failed'] += 1
+                logger.exception('Failed to process received message')
+                continue
+            self.counters['processed'] += 1
+            if needs_parsing:
+                self.counters['processed_bytes'] += len(data)
+
+    async def process(self, needs_parsing, data, context):
+        if not needs_parsing:
+            await self.loop.run_in_executor(
+                self.handle_executor, self.handle_function, data, context
+            )
+        elif self.parse_executor is None:
+            await self.loop.run_in_executor(
+                self.handle_executor, self.parse_and_handle, data, context
+            )
+        else:
+            parsed = await self.loop.run_in_executor(
+                self.parse_executor, self.parse_function, data
+            )
+            await self.loop.run_in_executor(
+                self.handle_executor, self.handle_function, parsed, context
+            )
+
+    def parse_and_handle(self, payload, context):
+        self.handle_function(self.parse_function(payload), context)
+
+    def stats(self):
+        """Report queue depth, message counts, and throughput."""
+        stats = dict(self.counters)
+        stats['queue_depth'] = self.queue_length
+        stats['paused'] = self.paused
+        elapsed = time.time() - self.start_time if self.start_time else 0
+        if elapsed > 0:
+            stats['throughput_messages'] = self.counters['processed'] / elapsed
+            stats['throughput_bytes'] = (
+                self.counters['processed_bytes'] / elapsed
+            )
+        return stats
@@ -0,0 +1,248 @@
+"""Write-behind storage of files with configurable durability."""
+import collections
+import datetime
+import errno
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+durability_modes = ['none', 'file', 'batch', 'interval']
+layouts = ['flat', 'camera', 'camera_date']
+
+
+def build_layout_dir(root_dir, layout, client_name, timestamp):
+    """Build the directory for a camera's file in a directory layout.
+
+    The flat layout puts all files in the root directory; the camera layout
+    puts each camera's files in a subdirectory; and the camera_date layout
+    further shards each camera's files by date.
+    """
+    if layout == 'flat':
+        return root_dir
+    if layout == 'camera':
+        return os.path.join(root_dir, client_name)
+    if layout == 'camera_date':
+        date = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+        return os.path.join(root_dir, client_name, date)
+    raise ValueError('Unknown directory layout: {}'.format(layout))
+
+
+class StorageWriter(object):
+    """Writes and moves files in a background thread.
+
+    Writes are queued and performed in order by a single writer thread, so
+    that callers don't block on disk I/O unless the queue is full. Created
+    directories are remembered, and a handle to each is cached, so that
+    files are opened relative to their directory and directories are made
+    only once.
+
+    If the disk is full, disk_full_callback is called (in the writer thread)
+    to free space, and the operation is then retried once.
+
+    Durability decides when written data is flushed to disk with fsync:
+    'none' leaves it to the OS; 'file' syncs each file (and its directory)
+    as it is written; 'batch' syncs all files written since the queue was
+    last empty, up to max_pending files; and 'interval' syncs pending files
+    every sync_interval seconds, or sooner if max_pending files are pending.
+
+    Handles to the most recently-used max_open_dirs directories are kept
+    open, so that files can be created and directories synced without
+    looking up their paths again.
+    """
+
+    def __init__(
+        self, durability='none', sync_interval=5, max_pending=64,
+        max_queue_size=64, disk_full_callback=None, max_open_dirs=16
+    ):
+        if durability not in durability_modes:
+            raise ValueError(
+                'Unknown durability mode: {}'.format(durability)
+            )
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.max_pending = max_pending
+        self.disk_full_callback = disk_full_callback
+        self.max_open_dirs = max_open_dirs
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.dir_fds = collections.OrderedDict()
+        self.pending_files = []
+        self.pending_dirs = set()
+        self.last_sync = time.time()
+        self.counters = {
+            'written': 0,
+            'written_bytes': 0,
+            'moved': 0,
+            'failed': 0,
+            'syncs': 0
+        }
+        self.thread = threading.Thread(
+            target=self.run, name='storage_writer', daemon=True
+        )
+        self.thread.start()
+
+    # Interface
+
+    def write_bytes(self, path, data):
+        """Queue bytes to be written to a file."""
+        self.queue.put(('write', path, data))
+
+    def move(self, source_path, destination_path):
+        """Queue a file to be moved, replacing any file at the destination."""
+        self.queue.put(('move', source_path, destination_path))
+
+    def flush(self):
+        """Block until all queued operations are done and synced."""
+        self.queue.join()
+
+    def close(self):
+        """Finish queued operations and stop the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['queue_depth'] = self.queue.qsize()
+        return stats
+
+    # Writer thread
+
+    def run(self):
+        while True:
+            try:
+                operation = self.queue.get(timeout=self.get_timeout())
+            except queue.Empty:
+                self.sync_pending()
+                continue
+            if operation is None:
+                self.sync_pending()
+                self.close_dirs()
+                self.queue.task_done()
+                return
+            try:
+                self.perform_with_retry(*operation)
+            except OSError:
+                self.counters['failed'] += 1
+                logger.exception('Failed to {} {}'.format(
+                    operation[0], operation[1]
+                ))
+            if self.should_sync():
+                self.sync_pending()
+            self.queue.task_done()
+
+    def get_timeout(self):
+        if not self.pending_files and not self.pending_dirs:
+            return None
+        if self.durability == 'interval':
+            return max(0, self.last_sync + self.sync_interval - time.time())
+        return 0
+
+    def should_sync(self):
+        if not self.pending_files and not self.pending_dirs:
+            return False
+        if len(self.pending_files) >= self.max_pending:
+            return True
+        if self.durability == 'batch':
+            return self.queue.empty()
+        if self.durability == 'interval':
+            return time.time() - self.last_sync >= self.sync_interval
+        return False
+
+    def perform_with_retry(self, *operation):
+        try:
+            self.perform(*operation)
+        except OSError as e:
+            if e.errno != errno.ENOSPC or self.disk_full_callback is None:
+                raise
+            logger.warning('Disk is full, trying to free space')
+            self.disk_full_callback()
+            self.perform(*operation)
+
+    def perform(self, kind, path, argument):
+        if kind == 'write':
+            (dir_path, filename) = os.path.split(path)
+            dir_path = dir_path or '.'
+            dir_fd = self.get_dir_fd(dir_path)
+            with open(filename, 'wb', opener=dir_opener(dir_fd)) as f:
+                f.write(argument)
+                self.finish_file(f, dir_path)
+            self.counters['written'] += 1
+            self.counters['written_bytes'] += len(argument)
+        elif kind == 'move':
+            dir_path = os.path.dirname(argument) or '.'
+            self.get_dir_fd(dir_path)
+            if self.durability != 'none':
+                # Sync the contents before the file appears at its destination
+                with open(path, 'rb') as f:
+                    os.fsync(f.fileno())
+            os.replace(path, argument)
+            if self.durability == 'file':
+                os.fsync(self.dir_fds[dir_path])
+            elif self.durability != 'none':
+                self.pending_dirs.add(dir_path)
+            self.counters['moved'] += 1
+
+    def finish_file(self, f, dir_path):
+        if self.durability == 'none':
+            return
+        f.flush()
+        if self.durability == 'file':
+            os.fsync(f.fileno())
+            os.fsync(self.dir_fds[dir_path])
+            return
+        # Keep the file open so it can be synced with the rest of the batch
+        self.pending_files.append(os.dup(f.fileno()))
+        self.pending_dirs.add(dir_path)
+
+    def sync_pending(self):
+        """Sync all pending files and the directories containing them."""
+        if not self.pending_files and not self.pending_dirs:
+            return
+        for fd in self.pending_files:
+            try:
+                os.fsync(fd)
+            except OSError:
+                self.counters['failed'] += 1
+                logger.exception('Failed to sync a written file')
+            finally:
+                os.close(fd)
+        for dir_path in self.pending_dirs:
+            os.fsync(self.dir_fds[dir_path])
+        self.pending_files = []
+        self.pending_dirs = set()
+        self.last_sync = time.time()
+        self.counters['syncs'] += 1
+
+    # Directories
+
+    def get_dir_fd(self, dir_path):
+        """Get a cached handle to a directory, making it if necessary."""
+        if dir_path in self.dir_fds:
+            self.dir_fds.move_to_end(dir_path)
+            return self.dir_fds[dir_path]
+        while len(self.dir_fds) >= max(1, self.max_open_dirs):
+            (evicted_path, fd) = next(iter(self.dir_fds.items()))
+            if evicted_path in self.pending_dirs:
+                # Pending directories are synced with their handles
+                self.sync_pending()
+            del self.dir_fds[evicted_path]
+            os.close(fd)
+        os.makedirs(dir_path, exist_ok=True)
+        self.dir_fds[dir_path] = os.open(dir_path, os.O_RDONLY)
+        return self.dir_fds[dir_path]
+
+    def close_dirs(self):
+        for fd in self.dir_fds.values():
+            os.close(fd)
+        self.dir_fds = collections.OrderedDict()
+
+
+def dir_opener(dir_fd):
+    """Make an opener which opens files relative to a directory handle."""
+    def opener(path, flags):
+        return os.open(path, flags, 0o666, dir_fd=dir_fd)
+    return opener